@@ -1,15 +1,40 @@
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
 import os
 import json
 import uuid
 import logging
+import logging.handlers
+import shutil
+import atexit
+import hashlib
+import math
+import re
+import socket
+import statistics
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait, CancelledError, TimeoutError as FutureTimeoutError
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 from typing import List, Dict, Any
 
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
 # LangChain imports
 from langchain_openai import ChatOpenAI
 from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate, SystemMessagePromptTemplate
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.outputs import ChatGeneration, ChatResult
 from langchain.agents import Tool, AgentExecutor
 from langchain.memory import ConversationBufferMemory
 from langchain.chains import LLMChain, ConversationChain
@@ -80,7 +105,37 @@ ui_text = {
         "view_your_evals": "View Your Evaluations",
         "no_evals_yet": "No evaluations available yet. Submit an assignment to get evaluated.",
         "report_for": "Evaluation Report for ",
-        "report_label": "Report"
+        "report_label": "Report",
+        "model_routes_label": "Model Routing Overrides (Advanced)",
+        "model_routes_help": "Optional JSON mapping agent stages (e.g. \"evaluation.objectives\") to a model, max_tokens and timeout.",
+        "model_routes_error": "Model routing overrides must be a JSON object mapping stages to settings.",
+        "profile_summary_label": "Show rerun profile",
+        "plagiarism_flag": "Possible plagiarism detected in this submission.",
+        "load_detail_label": "Load full evaluation data",
+        "objective_fanout_label": "Evaluate each learning objective separately",
+        "objective_fanout_help": "Scores every objective in its own concurrent call, so evaluation time does not grow with the number of objectives.",
+        "reference_digest_label": "Digest used in the prompts ({tokens} tokens)",
+        "batch_grading_label": "Grade submissions in offline batches",
+        "batch_grading_help": "Evaluations run later through batch files (batch_grading.py) at a lower cost, instead of right after each conversation.",
+        "evaluation_deferred": "Your answers have been saved. Your evaluation will be available once your teacher runs the batch grading.",
+        "course_label": "Course",
+        "term_label": "Term (optional)",
+        "session_memory_label": "Show session memory",
+        "partial_report_warning": "Partial evaluation: these stages did not finish in time and are not included: {stages}",
+        "search_label": "Search reports, feedback and student answers",
+        "all_assignments": "All assignments",
+        "search_dates_label": "Date range",
+        "search_results": "{count} results in {ms} ms",
+        "search_results_label": "Results",
+        "llm_backend_caption": "LLM backend: {backend}",
+        "usage_tab": "Usage",
+        "usage_title": "API Usage and Quotas",
+        "usage_empty": "No LLM calls have been metered yet.",
+        "usage_admitted": "Admitted",
+        "usage_queued": "Queued",
+        "usage_rejected": "Rejected",
+        "usage_mean_wait": "Mean wait (s)",
+        "quota_exceeded": "The {scope} usage quota is exhausted right now. Please try again in about {minutes} minute(s)."
     },
     "Español": {
         "app_title": "Sistema de Evaluación de Tareas Educativas",
@@ -145,7 +200,37 @@ ui_text = {
         "view_your_evals": "Ver Tus Evaluaciones",
         "no_evals_yet": "Aún no hay evaluaciones disponibles. Entrega una tarea para ser evaluado.",
         "report_for": "Informe de Evaluación para ",
-        "report_label": "Informe"
+        "report_label": "Informe",
+        "model_routes_label": "Modelos por Etapa (Avanzado)",
+        "model_routes_help": "JSON opcional que asigna a cada etapa de los agentes (p. ej. \"evaluation.objectives\") un modelo, max_tokens y timeout.",
+        "model_routes_error": "La configuración de modelos debe ser un objeto JSON que asigne ajustes a cada etapa.",
+        "profile_summary_label": "Mostrar perfil de ejecuciones",
+        "plagiarism_flag": "Se detectó posible plagio en esta entrega.",
+        "load_detail_label": "Cargar datos completos de evaluación",
+        "objective_fanout_label": "Evaluar cada objetivo de aprendizaje por separado",
+        "objective_fanout_help": "Puntúa cada objetivo en su propia llamada concurrente, para que el tiempo de evaluación no crezca con el número de objetivos.",
+        "reference_digest_label": "Resumen usado en los prompts ({tokens} tokens)",
+        "batch_grading_label": "Evaluar las entregas en lotes diferidos",
+        "batch_grading_help": "Las evaluaciones se ejecutan más tarde mediante archivos por lotes (batch_grading.py) a menor costo, en lugar de justo después de cada conversación.",
+        "evaluation_deferred": "Tus respuestas se han guardado. Tu evaluación estará disponible cuando tu profesor ejecute la evaluación por lotes.",
+        "course_label": "Curso",
+        "term_label": "Periodo (opcional)",
+        "session_memory_label": "Mostrar memoria por sesión",
+        "partial_report_warning": "Evaluación parcial: estas etapas no terminaron a tiempo y no se incluyen: {stages}",
+        "search_label": "Buscar en informes, retroalimentación y respuestas de estudiantes",
+        "all_assignments": "Todas las tareas",
+        "search_dates_label": "Rango de fechas",
+        "search_results": "{count} resultados en {ms} ms",
+        "search_results_label": "Resultados",
+        "llm_backend_caption": "Backend de LLM: {backend}",
+        "usage_tab": "Uso",
+        "usage_title": "Uso de la API y Cuotas",
+        "usage_empty": "Aún no se ha medido ninguna llamada al LLM.",
+        "usage_admitted": "Admitidas",
+        "usage_queued": "En cola",
+        "usage_rejected": "Rechazadas",
+        "usage_mean_wait": "Espera media (s)",
+        "quota_exceeded": "La cuota de uso ({scope}) está agotada en este momento. Inténtalo de nuevo en unos {minutes} minuto(s)."
     }
 }
 
@@ -160,9 +245,15 @@ def get_text(key, language="English"):
 # Setup directory structure
 def setup_directories():
     """Create necessary directories for storing files and data"""
-    dirs = ["data", "data/assignments", "data/submissions", "data/evaluations"]
+    dirs = [
+        "data", "data/assignments", "data/submissions", "data/evaluations", "data/sessions", "data/cassettes",
+        SHARDS_DIR, SESSION_SPILL_DIR
+    ]
     for dir_path in dirs:
         os.makedirs(dir_path, exist_ok=True)
+    
+    # Data stored before course shards existed is split into shards once
+    migrate_legacy_stores_once()
 
 # File handling functions
 def save_uploaded_file(uploaded_file, directory):
@@ -172,646 +263,4427 @@ def save_uploaded_file(uploaded_file, directory):
         f.write(uploaded_file.getbuffer())
     return file_path
 
-def read_file(file_path):
-    """Read file contents with error handling and UTF-8 encoding"""
+def read_document(file_path):
+    """Text of an uploaded PDF, DOCX or text file, or None if it cannot be read"""
+    extension = os.path.splitext(file_path)[1].lower()
     try:
+        if extension == ".pdf":
+            from pypdf import PdfReader
+            # Pages are separated by form feeds, so headers and footers can be found (see strip_page_furniture)
+            return "\f".join(page.extract_text() or "" for page in PdfReader(file_path).pages)
+        if extension == ".docx":
+            import docx
+            return "\n\n".join(paragraph.text for paragraph in docx.Document(file_path).paragraphs)
         with open(file_path, "r", encoding="utf-8") as f:
             return f.read()
+    except ImportError as e:
+        logging.error(f"Falta la dependencia para leer {file_path}: {e}")
     except Exception as e:
-        return f"Error reading file: {e}"
+        logging.error(f"Error leyendo el documento {file_path}: {e}")
+    return None
+
+def build_submission_text(submission_data, file_content=None):
+    """Combine the written submission with the content of the uploaded file, if any.
+    
+    file_content is the file's text as read by read_document (None if it could not be read).
+    """
+    submission_text = submission_data["text_submission"]
+    if submission_data["file_path"]:
+        if file_content is not None:
+            submission_text += f"\n\n[Uploaded File Content]:\n{file_content}"
+        else:
+            submission_text += "\n\n[Uploaded File: Could not read content]"
+    return submission_text
+
+def file_version(file_path):
+    """(mtime, inode, size) of a file, or None if it doesn't exist; changes whenever the file is replaced"""
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+
+@contextmanager
+def file_lock(file_path):
+    """Exclusive lock on a data file, shared by every thread and process using the data directory"""
+    lock_path = f"{file_path}.lock"
+    os.makedirs(os.path.dirname(lock_path) or ".", exist_ok=True)
+    with open(lock_path, "a+") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
 
 def save_json(data, file_path):
     """Save data as JSON"""
     try:
-        with open(file_path, "w", encoding="utf-8") as f:
+        # Write to a temporary file first so readers (in any process) never see a partial file
+        tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
             json.dump(data, f, indent=4)
+        os.replace(tmp_path, file_path)
         logging.info(f"Datos guardados en {file_path}")
     except Exception as e:
         logging.error(f"Error al guardar JSON en {file_path}: {e}")
 
-@st.cache_data(show_spinner=False)
-def load_json(file_path):
-    """Load data from JSON with caching"""
-    if os.path.exists(file_path):
+@st.cache_data(show_spinner=False, max_entries=256)
+def _load_json_cached(file_path, version):
+    if version is not None:
         with open(file_path, "r", encoding="utf-8") as f:
             return json.load(f)
     return {}
 
+def load_json(file_path):
+    """Load data from JSON, cached until the file changes on disk (e.g. written by another process)"""
+    with profile_section(f"store:{os.path.basename(file_path)}"):
+        return _load_json_cached(file_path, file_version(file_path))
 
-# Agent definitions
-class QuestionGeneratorAgent:
-    """Agent responsible for generating questions based on the assignment and learning objectives"""
+# Text normalization before prompting. The submission (with any uploaded file content) is pasted
+# into every evaluation and report prompt, so whitespace runs and duplicated paragraphs are removed
+# once per submission. Page headers, footers and page numbers are only removed from uploaded
+# documents, at the top and bottom of their pages. Answers only have their whitespace normalized.
+PROMPT_TEXT_MAX_CHARS = 3000  # Longer submissions are truncated in the prompts
+BOILERPLATE_MIN_REPEATS = 3
+BOILERPLATE_MAX_CHARS = 80
+PAGE_EDGE_LINES = 2  # Lines at the top and at the bottom of a page that may be a header or footer
+DUPLICATE_PARAGRAPH_MIN_CHARS = 40
+PAGE_NUMBER_PATTERN = re.compile(r"^(page|p[aá]gina|p\.)?\s*\d+(\s*(of|de|/)\s*\d+)?$", re.IGNORECASE)
+
+@st.cache_resource(show_spinner=False)
+def get_token_encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # Without tiktoken (or its encoding files) token counts are estimated
+        return None
+
+def count_tokens(text):
+    """Tokens of a text for the OpenAI models, or an estimate of 4 characters per token"""
+    encoding = get_token_encoding()
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+def _normalized_paragraphs(text):
+    """Paragraphs of a text with whitespace runs collapsed; indentation is kept"""
+    text = unicodedata.normalize("NFC", text).replace("\r\n", "\n").replace("\r", "\n")
+    lines = [re.sub(r"(?<=\S)[ \t\u00a0]+", " ", line).rstrip() for line in text.split("\n")]
+    paragraphs = (paragraph.strip("\n") for paragraph in re.split(r"\n\s*\n", "\n".join(lines)))
+    return [paragraph for paragraph in paragraphs if paragraph.strip()]
+
+def normalize_whitespace(text):
+    """Collapse whitespace runs and blank lines without removing anything else, e.g. for answers"""
+    return "\n\n".join(_normalized_paragraphs(text))
+
+def normalize_text(text):
+    """Normalize whitespace and drop repeated paragraphs, keeping the first occurrence.
     
-    def __init__(self, llm):
-        self.llm = llm
-        self.system_prompts = {
-            "English": """You are an expert educational assessment agent. 
-            Your task is to generate thoughtful questions based on assignment instructions and learning objectives.
-            The questions should help evaluate the student's understanding and achievement of learning objectives.
-            Generate questions that are clear, specific, and directly related to the learning objectives.""",
-            
-            "Español": """Eres un agente experto en evaluación educativa.
-            Tu tarea es generar preguntas reflexivas basadas en las instrucciones de la tarea y los objetivos de aprendizaje.
-            Las preguntas deben ayudar a evaluar la comprensión del estudiante y el logro de los objetivos de aprendizaje.
-            Genera preguntas claras, específicas y directamente relacionadas con los objetivos de aprendizaje."""
+    Returns {"text", "duplicate_paragraphs_removed"}.
+    Indentation is kept, so code in a submission keeps its structure.
+    """
+    paragraphs, seen, duplicates_removed = [], set(), 0
+    for paragraph in _normalized_paragraphs(text):
+        key = " ".join(paragraph.casefold().split())
+        if len(key) >= DUPLICATE_PARAGRAPH_MIN_CHARS and key in seen:
+            duplicates_removed += 1
+            continue
+        seen.add(key)
+        paragraphs.append(paragraph)
+    
+    return {
+        "text": "\n\n".join(paragraphs),
+        "duplicate_paragraphs_removed": duplicates_removed
+    }
+
+def strip_page_furniture(document_text):
+    """Drop page headers, footers and page numbers from a document whose pages are separated by form feeds.
+    
+    Only the first and last PAGE_EDGE_LINES non-blank lines of each page are looked at,
+    from the edge inwards, stopping at the first line that is kept. There, page numbers
+    are dropped, and a short line found on BOILERPLATE_MIN_REPEATS pages or more is
+    kept the first time only. A document without page breaks is returned as is.
+    Returns (text, lines_removed).
+    """
+    pages = [page.split("\n") for page in document_text.split("\f")]
+    if len(pages) < 2:
+        return document_text, 0
+    
+    def edges(lines):
+        # Header lines top-down and footer lines bottom-up
+        filled = [i for i, line in enumerate(lines) if line.strip()]
+        return filled[:PAGE_EDGE_LINES], filled[::-1][:PAGE_EDGE_LINES]
+    
+    def repeatable(line):
+        return len(line) <= BOILERPLATE_MAX_CHARS and re.search(r"[^\W\d_]", line)
+    
+    page_edges = [edges(lines) for lines in pages]
+    counts = Counter()
+    for lines, (header, footer) in zip(pages, page_edges):
+        counts.update({" ".join(lines[i].split()) for i in header + footer})
+    
+    kept_pages, seen, removed = [], set(), 0
+    for lines, (header, footer) in zip(pages, page_edges):
+        dropped = set()
+        for positions in (header, footer):
+            for i in positions:
+                line = " ".join(lines[i].split())
+                boilerplate = repeatable(line) and counts[line] >= BOILERPLATE_MIN_REPEATS
+                if PAGE_NUMBER_PATTERN.match(line) or (boilerplate and line in seen):
+                    dropped.add(i)
+                    continue
+                if boilerplate:
+                    seen.add(line)
+                break
+        removed += len(dropped)
+        kept_pages.append("\n".join(line for i, line in enumerate(lines) if i not in dropped))
+    return "\n\n".join(kept_pages), removed
+
+def normalize_submission(submission_data):
+    """Normalized prompt text of a submission and its token counts, computed once and kept on the record"""
+    if "normalized_text" not in submission_data:
+        file_content = read_document(submission_data["file_path"]) if submission_data["file_path"] else None
+        raw_text = build_submission_text(submission_data, file_content)
+        # Page furniture only comes from the uploaded document, never from what the student typed
+        boilerplate_removed = 0
+        if file_content is not None:
+            file_content, boilerplate_removed = strip_page_furniture(file_content)
+        normalized = normalize_text(build_submission_text(submission_data, file_content))
+        submission_data["normalized_text"] = normalized["text"]
+        submission_data["normalization"] = {
+            "tokens_before": count_tokens(raw_text),
+            "tokens_after": count_tokens(normalized["text"]),
+            # What one prompt actually contains after truncation
+            "prompt_tokens_before": count_tokens(raw_text[:PROMPT_TEXT_MAX_CHARS]),
+            "prompt_tokens_after": count_tokens(normalized["text"][:PROMPT_TEXT_MAX_CHARS]),
+            "boilerplate_lines_removed": boilerplate_removed,
+            "duplicate_paragraphs_removed": normalized["duplicate_paragraphs_removed"]
         }
+    return submission_data["normalized_text"], submission_data["normalization"]
+
+# Rerun profiling, enabled with PROFILE_RERUNS=1. Each rerun's named sections are timed
+# and appended as one JSON line to a rolling log.
+PROFILE_LOG = "data/profiling/reruns.jsonl"
+
+_profiler_context = threading.local()
+
+class RerunProfiler:
+    """Times the named sections of one Streamlit rerun"""
+    
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.started = time.perf_counter()
+        self.sections = {}
+        self._lap_name = None
+        self._lap_start = None
         
-    def generate_questions(self, assignment_text, learning_objectives, num_questions=5, language="English"):
-        """Generate questions based on assignment and learning objectives"""
+    def add(self, name, seconds):
+        self.sections[name] = self.sections.get(name, 0.0) + seconds
         
-        system_prompt = self.system_prompts.get(language, self.system_prompts["English"])
+    def lap(self, name):
+        """End the current top-level section and start the next one"""
+        now = time.perf_counter()
+        if self._lap_name is not None:
+            self.add(self._lap_name, now - self._lap_start)
+        self._lap_name, self._lap_start = name, now
         
-        prompt_templates = {
-            "English": "Assignment Instructions:\n{assignment_text}\n\n"
-                      "Learning Objectives:\n{learning_objectives}\n\n"
-                      "Generate {num_questions} questions that will help assess if a student has met these learning objectives.",
-                      
-            "Español": "Instrucciones de la tarea:\n{assignment_text}\n\n"
-                      "Objetivos de aprendizaje:\n{learning_objectives}\n\n"
-                      "Genera {num_questions} preguntas que ayuden a evaluar si un estudiante ha alcanzado estos objetivos de aprendizaje."
-        }
+    def finish(self):
+        """Close the open section and write the rerun to the profile log"""
+        self.lap(None)
+        get_profile_logger().info(json.dumps({
+            "session_id": self.session_id,
+            "timestamp": datetime.now().isoformat(),
+            "total_seconds": round(time.perf_counter() - self.started, 4),
+            "sections": {name: round(seconds, 4) for name, seconds in self.sections.items()}
+        }))
+
+@st.cache_resource(show_spinner=False)
+def get_profile_logger():
+    """Logger writing rerun profiles to a size-bounded rolling log"""
+    os.makedirs(os.path.dirname(PROFILE_LOG), exist_ok=True)
+    logger = logging.getLogger("rerun_profiler")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = logging.handlers.RotatingFileHandler(PROFILE_LOG, maxBytes=5_000_000, backupCount=3, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    return logger
+
+def profiling_enabled():
+    return os.environ.get("PROFILE_RERUNS", "").lower() in ("1", "true", "yes")
+
+def start_rerun_profile(session_id):
+    """Start profiling the current rerun (a no-op unless profiling is enabled)"""
+    _profiler_context.profiler = RerunProfiler(session_id) if profiling_enabled() else None
+    return _profiler_context.profiler
+
+def profile_lap(name):
+    """Mark the start of the next top-level section of the current rerun"""
+    profiler = getattr(_profiler_context, "profiler", None)
+    if profiler is not None:
+        profiler.lap(name)
+
+@contextmanager
+def profile_section(name):
+    """Time a nested section (e.g. a store load) of the current rerun"""
+    profiler = getattr(_profiler_context, "profiler", None)
+    if profiler is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.add(name, time.perf_counter() - start)
+
+@contextmanager
+def profile_fragment(name):
+    """Profile a fragment: as a section of the full rerun, or as a rerun of its own when run alone"""
+    if getattr(_profiler_context, "profiler", None) is not None:
+        profile_lap(name)
+        yield
+        return
+    # A fragment rerun is activity on the session even though run_app does not run
+    if "state_session_key" in st.session_state:
+        get_session_state_manager().touch(st.session_state.state_session_key)
+    start_rerun_profile(st.session_state.get("profiling_session_id", "unknown"))
+    profile_lap(name)
+    try:
+        yield
+    finally:
+        finish_rerun_profile()
+
+def finish_rerun_profile():
+    profiler = getattr(_profiler_context, "profiler", None)
+    _profiler_context.profiler = None
+    if profiler is not None:
+        profiler.finish()
+
+def summarize_rerun_profiles(log_path=PROFILE_LOG):
+    """Slowest sections and rerun rate per session from the rolling profile log"""
+    records = []
+    for path in [f"{log_path}.{i}" for i in range(3, 0, -1)] + [log_path]:
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                records.extend(json.loads(line) for line in f if line.strip())
+    
+    section_times = {}
+    sessions = {}
+    for record in records:
+        for name, seconds in record["sections"].items():
+            section_times.setdefault(name, []).append(seconds)
+        sessions.setdefault(record["session_id"], []).append(datetime.fromisoformat(record["timestamp"]))
+    
+    sections = []
+    for name, times in section_times.items():
+        times.sort()
+        sections.append({
+            "section": name,
+            "count": len(times),
+            "mean_ms": round(1000 * sum(times) / len(times), 2),
+            "p95_ms": round(1000 * times[min(len(times) - 1, int(0.95 * len(times)))], 2),
+            "max_ms": round(1000 * times[-1], 2)
+        })
+    sections.sort(key=lambda row: row["p95_ms"], reverse=True)
+    
+    rates = []
+    for session_id, timestamps in sessions.items():
+        minutes = (max(timestamps) - min(timestamps)).total_seconds() / 60
+        rates.append({
+            "session_id": session_id,
+            "reruns": len(timestamps),
+            "reruns_per_minute": round(len(timestamps) / minutes, 2) if minutes > 0 else None
+        })
+    rates.sort(key=lambda row: row["reruns"], reverse=True)
+    
+    return {"reruns": len(records), "sections": sections, "sessions": rates}
+
+@st.cache_resource(show_spinner=False)
+def get_background_executor():
+    """Thread pool shared by all sessions for work that runs while the student is busy"""
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="background")
+
+@st.cache_resource(show_spinner=False)
+def get_stage_executor():
+    """Thread pool running LLM calls that have a deadline (see run_llm_stage)"""
+    return ThreadPoolExecutor(max_workers=32, thread_name_prefix="stage")
+
+
+# Course shards: assignments, submissions and evaluations are stored per course (and optionally
+# term) under data/courses/<shard>/, so a page only parses the history of the course it shows.
+# Shards are loaded on first access and kept in a bounded LRU cache. The catalog maps each
+# assignment to its shard.
+SHARDS_DIR = "data/courses"
+SHARD_CATALOG_FILE = "data/courses/catalog.json"
+SHARD_KINDS = ["assignments", "submissions", "evaluations"]
+DEFAULT_COURSE = "general"
+
+def shard_key(course, term=None):
+    """Directory name of a course/term shard"""
+    parts = [course or DEFAULT_COURSE] + ([term] if term else [])
+    slug = "__".join(part.strip().lower() for part in parts)
+    return "".join(c if c.isalnum() or c in "-_" else "-" for c in slug)
+
+class ShardCache:
+    """LRU cache of loaded shard files, reloaded when the file changes on disk"""
+    
+    def __init__(self, max_entries=12, root=SHARDS_DIR):
+        self.max_entries = max_entries
+        self.root = root
+        self._entries = OrderedDict()  # (shard, kind) -> (version, data)
+        self._lock = threading.Lock()
         
-        prompt_template = prompt_templates.get(language, prompt_templates["English"])
+    def _path(self, shard, kind):
+        return os.path.join(self.root, shard, f"{kind}.json")
         
-        prompt = ChatPromptTemplate.from_messages([
-            SystemMessagePromptTemplate.from_template(system_prompt),
-            HumanMessagePromptTemplate.from_template(prompt_template)
-        ])
+    def _load(self, shard, kind):
+        path = self._path(shard, kind)
+        mtime = file_version(path)
+        cached = self._entries.get((shard, kind))
+        if cached is not None and cached[0] == mtime:
+            self._entries.move_to_end((shard, kind))
+            return cached[1]
+        
+        with profile_section(f"shard:{shard}/{kind}"):
+            data = {}
+            if mtime is not None:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+        self._remember(shard, kind, mtime, data)
+        return data
+        
+    def _remember(self, shard, kind, mtime, data):
+        # Most recently used last; the least recently used shard file is evicted first
+        self._entries[(shard, kind)] = (mtime, data)
+        self._entries.move_to_end((shard, kind))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        
+    def get(self, shard, kind):
+        """Records of one shard file (a copy; use update to change them)"""
+        with self._lock:
+            return dict(self._load(shard, kind))
+        
+    def exists(self, shard, kind):
+        return os.path.exists(self._path(shard, kind))
+        
+    def update(self, shard, kind, key, value):
+        """Insert or delete (value=None) one record of a shard file"""
+        self.update_many(shard, kind, {key: value})
+        
+    def update_many(self, shard, kind, records):
+        """Insert or delete (value None) several records of a shard file in one write"""
+        path = self._path(shard, kind)
+        # The file lock serializes writers in other processes; the file is read again under it
+        with self._lock, file_lock(path):
+            data = dict(self._load(shard, kind))
+            for key, value in records.items():
+                if value is None:
+                    data.pop(key, None)
+                else:
+                    data[key] = value
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=4)
+            os.replace(tmp_path, path)
+            self._remember(shard, kind, file_version(path), data)
+
+@st.cache_resource(show_spinner=False)
+def get_shard_cache():
+    return ShardCache(max_entries=int(os.environ.get("SHARD_CACHE_SIZE", "12")))
+
+def load_shard_catalog(catalog_path=SHARD_CATALOG_FILE):
+    """{"courses": {shard: {course, term}}, "assignments": {assignment_id: shard}}"""
+    # load_json is cached per version of the file, so writes by other processes are seen
+    catalog = load_json(catalog_path)
+    return {"courses": catalog.get("courses", {}), "assignments": catalog.get("assignments", {})}
+
+def find_assignment_shard(assignment_id):
+    shard = load_shard_catalog()["assignments"].get(assignment_id)
+    if shard is None:
+        raise KeyError(assignment_id)
+    return shard
+
+def evaluation_index_entry(report_data, shard):
+    """What a shard's evaluation index records about one evaluation"""
+    return {
+        "assignment_id": report_data["evaluation_data"]["assignment_id"],
+        "timestamp": report_data["timestamp"],
+        "shard": shard
+    }
+
+def load_evaluation_index(shard):
+    """Evaluation ID -> {assignment_id, timestamp, shard} of one course shard, built from the shard if missing"""
+    cache = get_shard_cache()
+    if not cache.exists(shard, "index"):
+        cache.update_many(shard, "index", {
+            evaluation_id: evaluation_index_entry(report_data, shard)
+            for evaluation_id, report_data in cache.get(shard, "evaluations").items()
+        })
+    return cache.get(shard, "index")
+
+def find_evaluation_shard(evaluation_id):
+    """Course shard of a stored evaluation, from its report view or else from the shard indexes"""
+    view_path = os.path.join(EVALUATION_VIEWS_DIR, f"{evaluation_id}.view.json")
+    if os.path.exists(view_path):
+        with open(view_path, "r", encoding="utf-8") as f:
+            assignment_id = json.load(f).get("assignment_id")
+        shard = load_shard_catalog()["assignments"].get(assignment_id)
+        if shard is not None and evaluation_id in load_evaluation_index(shard):
+            return shard
+    for shard in load_shard_catalog()["courses"]:
+        if evaluation_id in load_evaluation_index(shard):
+            return shard
+    raise KeyError(evaluation_id)
+
+def load_stored_evaluation(evaluation_id, shard=None):
+    """Load one stored evaluation from its course shard"""
+    if shard is None:
+        shard = find_evaluation_shard(evaluation_id)
+    evaluations = get_shard_cache().get(shard, "evaluations")
+    if evaluation_id not in evaluations:
+        raise KeyError(evaluation_id)
+    return evaluations[evaluation_id]
+
+@st.cache_resource(show_spinner=False)
+def migrate_legacy_stores_once():
+    """Run the legacy store migration once per process, not on every rerun"""
+    return migrate_legacy_stores()
+
+def migrate_legacy_stores(data_dir="data", dry_run=False):
+    """Split <data_dir>/assignments.json, submissions.json and evaluations.json into course shards.
+    
+    The shards are written under <data_dir>/courses. Assignments without a course go to
+    the DEFAULT_COURSE shard. The legacy files (and the old institution-wide evaluation
+    index) are renamed to *.migrated once split, so running this again does nothing.
+    Returns the number of records moved per shard and kind.
+    """
+    legacy = {kind: os.path.join(data_dir, f"{kind}.json") for kind in SHARD_KINDS}
+    legacy["index"] = os.path.join(data_dir, "evaluations", "index.json")
+    if not any(os.path.exists(path) for path in legacy.values()):
+        return {}
+    shards_dir = os.path.join(data_dir, "courses")
+    catalog_path = os.path.join(shards_dir, "catalog.json")
+    if dry_run:
+        return _split_legacy_stores(legacy, load_shard_catalog(catalog_path))[0]
+    
+    os.makedirs(shards_dir, exist_ok=True)
+    # Under the catalog lock, so concurrent startups migrate once and keep each other's catalog entries
+    with file_lock(catalog_path):
+        if not any(os.path.exists(path) for path in legacy.values()):
+            return {}
+        catalog = load_shard_catalog(catalog_path)
+        counts, shards = _split_legacy_stores(legacy, catalog)
+        if os.path.normpath(shards_dir) == os.path.normpath(SHARDS_DIR):
+            cache = get_shard_cache()
+        else:
+            cache = ShardCache(root=shards_dir)
+        for shard, kinds in shards.items():
+            catalog["courses"].setdefault(shard, {"course": DEFAULT_COURSE, "term": None})
+            for kind, records in kinds.items():
+                if kind == "index" and not cache.exists(shard, "index"):
+                    # A new index lists the shard's earlier evaluations too
+                    records = {
+                        evaluation_id: evaluation_index_entry(report_data, shard)
+                        for evaluation_id, report_data in cache.get(shard, "evaluations").items()
+                    }
+                cache.update_many(shard, kind, records)
+        save_json(catalog, catalog_path)
         
-        chain = LLMChain(llm=self.llm, prompt=prompt)
+        for path in legacy.values():
+            if os.path.exists(path):
+                os.replace(path, f"{path}.migrated")
+    logging.info(f"Datos migrados a {len(shards)} cursos en {shards_dir}")
+    return counts
+
+def _split_legacy_stores(legacy, catalog):
+    """(counts, {shard: {kind: records}}) of the legacy stores, recording assignments in catalog"""
+    def read(path):
+        if not os.path.exists(path):
+            return {}
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    
+    shards = {}
+    
+    def add(shard, kind, record_id, record):
+        shards.setdefault(shard, {}).setdefault(kind, {})[record_id] = record
+    
+    for assignment_id, assignment in read(legacy["assignments"]).items():
+        shard = shard_key(assignment.get("course"), assignment.get("term"))
+        catalog["courses"][shard] = {"course": assignment.get("course") or DEFAULT_COURSE, "term": assignment.get("term")}
+        catalog["assignments"][assignment_id] = shard
+        add(shard, "assignments", assignment_id, assignment)
+    
+    def shard_of(assignment_id):
+        # Records of deleted assignments are kept in the default shard
+        return catalog["assignments"].get(assignment_id, shard_key(DEFAULT_COURSE))
+    
+    for submission_id, submission in read(legacy["submissions"]).items():
+        add(shard_of(submission.get("assignment_id")), "submissions", submission_id, submission)
+    
+    for evaluation_id, report_data in read(legacy["evaluations"]).items():
+        shard = shard_of(report_data["evaluation_data"]["assignment_id"])
+        add(shard, "evaluations", evaluation_id, report_data)
+        add(shard, "index", evaluation_id, evaluation_index_entry(report_data, shard))
+    
+    counts = {
+        shard: {kind: len(records) for kind, records in kinds.items() if kind != "index"}
+        for shard, kinds in shards.items()
+    }
+    return counts, shards
+
+
+# Model routing: which model, output limit and timeout each agent stage uses.
+# Routes are looked up as "agent.stage", then "agent", then "default".
+DEFAULT_MODEL_ROUTES = {
+    "default": {"model": "gpt-3.5-turbo-16k", "max_tokens": None, "timeout": 120},
+    "assignment": {"model": "gpt-4o-mini", "max_tokens": 800, "timeout": 120},
+    "questions": {"model": "gpt-4o-mini", "max_tokens": 800, "timeout": 30},
+    "conversation": {"model": "gpt-4o-mini", "max_tokens": 600, "timeout": 30},
+    "evaluation.structuring": {"model": "gpt-4o-mini", "max_tokens": 2000, "timeout": 60},
+    "evaluation.objective": {"model": "gpt-4o-mini", "max_tokens": 500, "timeout": 60},
+    "evaluation.structuring_repair": {"model": "gpt-4o-mini", "max_tokens": 1000, "timeout": 60}
+}
+
+# USD per million tokens (prompt, completion), used to estimate the cost of each stage.
+# Prompt tokens served from the provider's cache are billed at CACHED_PROMPT_DISCOUNT of the price.
+MODEL_PRICING = {
+    "gpt-3.5-turbo-16k": (3.00, 4.00),
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00)
+}
+CACHED_PROMPT_DISCOUNT = 0.5
+# Calls answered through a batch file are billed at BATCH_DISCOUNT of the price
+BATCH_DISCOUNT = 0.5
+
+def load_model_routes():
+    """Load the routing configuration, merging MODEL_ROUTES_FILE (if set) over the defaults"""
+    routes = {key: dict(route) for key, route in DEFAULT_MODEL_ROUTES.items()}
+    routes_file = os.environ.get("MODEL_ROUTES_FILE")
+    if routes_file:
         try:
-            response = chain.run(
-                assignment_text=assignment_text,
-                learning_objectives="\n".join([f"- {obj}" for obj in learning_objectives]),
-                num_questions=num_questions
-            )
+            with open(routes_file, "r", encoding="utf-8") as f:
+                for key, route in json.load(f).items():
+                    routes.setdefault(key, {}).update(route)
         except Exception as e:
-            # Loggear el error y devolver una lista vacía
-            logging.error(f"Error generando preguntas: {e}")
-            response = ""
+            logging.error(f"Error cargando la configuración de modelos {routes_file}: {e}")
+    return routes
+
+# Fake local LLM for load tests (LLM_BACKEND=fake): answers every stage with a canned response
+# of the right shape after FAKE_LLM_LATENCY seconds, without calling any API.
+FAKE_LLM_RESPONSES = {
+    "questions": "\n".join(f"{i}. Explain, with an example from your work, how you approached point {i}." for i in range(1, 6)),
+    "evaluation.structuring": json.dumps({
+        **{criterion: {"score": 70, "examples": "Fake example", "feedback": "Fake feedback"} for criterion in [
+            "comprehension", "authenticity", "relational_skills", "argumentation", "bibliography_use", "overall_quality"
+        ]},
+        "learning_objectives": [{"objective": "Fake objective", "score": 70, "examples": "Fake example", "feedback": "Fake feedback"}],
+        "plagiarism_detected": False,
+        "plagiarism_evidence": "None",
+        "summary": "Fake evaluation summary."
+    }),
+    "evaluation.objective": json.dumps({"score": 70, "examples": "Fake example", "feedback": "Fake feedback"}),
+    "assignment": "## Key points\n- Fake key point\n\n## Expected answers\n- Fake expected answer\n\n## Rubric hints\n- Fake rubric hint",
+    "report": "# Executive Summary\nFake report.\n\n# Recommendations\nKeep practicing.",
+    "default": "Fake response with a few sentences of analysis of the student's work."
+}
+
+# Re-requested structuring fields are answered with the same object
+FAKE_LLM_RESPONSES["evaluation.structuring_repair"] = FAKE_LLM_RESPONSES["evaluation.structuring"]
+
+def fake_llm_response(stage):
+    """Canned response of the right shape for an "agent.stage" name"""
+    agent = stage.split(".")[0]
+    return FAKE_LLM_RESPONSES.get(stage) or FAKE_LLM_RESPONSES.get(agent) or FAKE_LLM_RESPONSES["default"]
+
+class FakeChatModel(BaseChatModel):
+    """Chat model returning FAKE_LLM_RESPONSES for its stage after a fixed latency"""
+    
+    stage: str = "default"
+    latency: float = 0.0
+    
+    @property
+    def _llm_type(self):
+        return "fake"
         
-        # Parse the questions from the response
-        questions = []
-        for line in response.split("\n"):
-            line = line.strip()
-            if line and (line.startswith("- ") or line.startswith("Q") or line[0].isdigit() and line[1] in [".", ")"]):
-                # Clean up the question format
-                question = line
-                if line.startswith("- "):
-                    question = line[2:]
-                elif line[0].isdigit() and line[1] in [".", ")"]:
-                    question = line[2:].strip()
-                elif line.startswith("Q") and ":" in line:
-                    question = line.split(":", 1)[1].strip()
-                
-                questions.append(question)
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        content = fake_llm_response(self.stage)
+        prompt_tokens = sum(len(str(message.content)) for message in messages) // 4
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=content))],
+            llm_output={"token_usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(content) // 4}}
+        )
+
+# The LLM backend is configured by the deployment, not in the sidebar. LLM_BACKEND=openai (the
+# default) calls the OpenAI API, or any OpenAI-compatible server at LLM_BASE_URL (e.g. the
+# local stand-in llm_server.py) with LLM_API_KEY; LLM_BACKEND=fake uses FakeChatModel in-process.
+def configured_llm_api_key():
+    """API key of a backend configured outside the app, or None if users enter their OpenAI key"""
+    if os.environ.get("LLM_BACKEND") == "fake":
+        return "fake"
+    if os.environ.get("LLM_BASE_URL"):
+        return os.environ.get("LLM_API_KEY", "local")
+    return None
+
+class ModelRouter:
+    """Resolves the chat model used by each agent stage from the routing configuration"""
+    
+    def __init__(self, openai_api_key, routes=None, temperature=0.2, _models=None, cassette=None, batch=None,
+                 usage_scopes=()):
+        self.openai_api_key = openai_api_key
+        self.routes = routes if routes is not None else load_model_routes()
+        self.temperature = temperature
+        self._models = _models if _models is not None else {}
+        # LLMCassette that records or replays every call made through this router
+        self.cassette = cassette
+        # LLMBatch that queues calls for offline batch grading instead of running them
+        self.batch = batch
+        # UsageMeter scopes ("key:…", "assignment:…", "session:…") charged for every call
+        self.usage_scopes = tuple(usage_scopes)
+        # "openai", or "fake" for the canned FakeChatModel used by load tests
+        self.backend = os.environ.get("LLM_BACKEND", "openai")
+        # OpenAI-compatible server used instead of the OpenAI API, if set
+        self.base_url = os.environ.get("LLM_BASE_URL")
         
-        return questions[:num_questions]  # Ensure we only return the requested number
+    def with_cassette(self, cassette):
+        """Return a router that records to / replays from the given cassette"""
+        return ModelRouter(
+            self.openai_api_key, self.routes, self.temperature, self._models, cassette, self.batch, self.usage_scopes
+        )
+        
+    def with_batch(self, batch):
+        """Return a router that queues calls in / answers them from the given batch"""
+        return ModelRouter(
+            self.openai_api_key, self.routes, self.temperature, self._models, self.cassette, batch, self.usage_scopes
+        )
+        
+    def with_usage_scopes(self, assignment_id=None, session_id=None):
+        """Return a router that charges its calls to the API key and the given assignment and session"""
+        scopes = [f"key:{hashlib.sha256((self.openai_api_key or '').encode('utf-8')).hexdigest()[:12]}"]
+        if assignment_id:
+            scopes.append(f"assignment:{assignment_id}")
+        if session_id:
+            scopes.append(f"session:{session_id}")
+        return ModelRouter(
+            self.openai_api_key, self.routes, self.temperature, self._models, self.cassette, self.batch, scopes
+        )
+        
+    def with_overrides(self, overrides):
+        """Return a router with per-stage overrides (e.g. from the assignment settings) applied"""
+        if not overrides:
+            return self
+        routes = {key: dict(route) for key, route in self.routes.items()}
+        for key, route in overrides.items():
+            routes.setdefault(key, {}).update(route)
+        return ModelRouter(
+            self.openai_api_key, routes, self.temperature, self._models, self.cassette, self.batch, self.usage_scopes
+        )
+        
+    def route(self, stage):
+        """Get the resolved route (model, max_tokens, timeout) for an "agent.stage" name"""
+        agent = stage.split(".")[0]
+        route = dict(self.routes.get("default", {}))
+        route.update(self.routes.get(agent, {}))
+        route.update(self.routes.get(stage, {}))
+        return route
+        
+    def for_stage(self, stage):
+        """Get the chat model for a stage, reusing clients with the same settings"""
+        route = self.route(stage)
+        if self.backend == "fake":
+            key = ("fake", stage)
+            if key not in self._models:
+                self._models[key] = FakeChatModel(stage=stage, latency=float(os.environ.get("FAKE_LLM_LATENCY", "0.5")))
+            return self._models[key]
+        
+        key = (route["model"], route.get("max_tokens"), route.get("timeout"))
+        if self.base_url:
+            # One client per stage, whose header tells a stand-in server which format to answer in
+            key += (stage,)
+        if key not in self._models:
+            self._models[key] = ChatOpenAI(
+                model_name=route["model"],
+                temperature=self.temperature,
+                max_tokens=route.get("max_tokens"),
+                request_timeout=route.get("timeout"),
+                openai_api_key=self.openai_api_key,
+                openai_api_base=self.base_url,
+                default_headers={"X-Agent-Stage": stage} if self.base_url else None
+            )
+        return self._models[key]
 
-class ConversationAgent:
-    """Agent that converses with the student, asking questions and recording responses"""
+# Record/replay of LLM interactions. With LLM_CASSETTE_MODE=record every evaluation writes
+# its rendered prompts, responses, latencies and token counts to data/cassettes/<session_id>.json.
+CASSETTES_DIR = "data/cassettes"
+
+class LLMCassette:
+    """Recorded LLM interactions of one evaluation, written in record mode and read in replay mode"""
     
-    def __init__(self, llm):
-        self.llm = llm
-        self.memory = ConversationBufferMemory(return_messages=True)
-        self.system_prompts = {
-            "English": """You are a friendly educational assistant conducting an assessment conversation.
-            Ask questions in a supportive and encouraging manner. Listen carefully to student responses.
-            Your goal is to understand the student's comprehension and thought process, not to judge or evaluate at this stage.""",
+    def __init__(self, path, mode="record", replay_latency="original"):
+        self.path = path
+        self.mode = mode
+        # "original" sleeps for the recorded latency on replay, "zero" returns immediately
+        self.replay_latency = replay_latency
+        # Inputs needed to rerun the evaluation and the outputs it produced
+        self.inputs = {}
+        self.outputs = {}
+        self.entries = []
+        self._lock = threading.Lock()
+        self._replayed = set()
+        if mode == "replay":
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.inputs = data.get("inputs", {})
+            self.outputs = data.get("outputs", {})
+            self.entries = data.get("entries", [])
             
-            "Español": """Eres un asistente educativo amigable que realiza una conversación de evaluación.
-            Haz preguntas de manera solidaria y alentadora. Escucha atentamente las respuestas de los estudiantes.
-            Tu objetivo es comprender la comprensión y el proceso de pensamiento del estudiante, no juzgar o evaluar en esta etapa."""
-        }
+    @staticmethod
+    def prompt_hash(messages):
+        return hashlib.sha256(json.dumps(messages, ensure_ascii=False).encode("utf-8")).hexdigest()
         
-        self.intro_messages = {
-            "English": "I'd like to ask you a few questions about your assignment to understand your thought process better.",
-            "Español": "Me gustaría hacerte algunas preguntas sobre tu tarea para entender mejor tu proceso de pensamiento."
-        }
+    def record(self, stage, model, messages, response, latency, usage):
+        with self._lock:
+            self.entries.append({
+                "stage": stage,
+                "model": model,
+                "prompt_hash": self.prompt_hash(messages),
+                "messages": messages,
+                "response": response,
+                "latency_seconds": round(latency, 3),
+                "prompt_tokens": usage.prompt_tokens,
+                "cached_prompt_tokens": usage.cached_prompt_tokens,
+                "completion_tokens": usage.completion_tokens
+            })
+            
+    def replay(self, stage, messages):
+        """Find the recorded entry for a call: same prompt if possible, else the next one of the stage"""
+        prompt_hash = self.prompt_hash(messages)
+        with self._lock:
+            candidates = [
+                i for i, entry in enumerate(self.entries)
+                if entry["stage"] == stage and i not in self._replayed
+            ]
+            if not candidates:
+                raise KeyError(f"No recorded response for stage {stage} in {self.path}")
+            index = next((i for i in candidates if self.entries[i]["prompt_hash"] == prompt_hash), candidates[0])
+            self._replayed.add(index)
+            entry = self.entries[index]
         
-        self.response_acknowledgments = {
-            "English": "Thank you for your response.",
-            "Español": "Gracias por tu respuesta."
-        }
+        if entry["prompt_hash"] != prompt_hash:
+            logging.warning(f"El prompt de {stage} no coincide con el grabado; se reproduce la respuesta en orden")
+        if self.replay_latency == "original":
+            time.sleep(entry["latency_seconds"])
+        return entry
         
-        self.completion_messages = {
-            "English": "Thank you for answering all the questions. I'll now analyze your responses.",
-            "Español": "Gracias por responder todas las preguntas. Ahora analizaré tus respuestas."
-        }
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._lock:
+            data = {"inputs": self.inputs, "outputs": self.outputs, "entries": list(self.entries)}
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=4, ensure_ascii=False)
+
+# Offline batch grading: with a batch attached to the router, a stage does not call the API.
+# Its rendered prompt is queued as a batch request (OpenAI Batch API JSONL) and the stage raises
+# BatchPending, unless its response was already ingested from a batch results file. Rerunning
+# an evaluation after each ingest advances it by one wave: the stages whose inputs are known.
+BATCHES_DIR = "data/batches"
+
+class BatchPending(Exception):
+    """A stage's response is waiting in a batch; the evaluation resumes after the next ingest"""
+
+class LLMBatch:
+    """Requests queued for the next batch file and the responses ingested from earlier ones"""
+    
+    ROLES = {"human": "user", "ai": "assistant"}
+    
+    def __init__(self, results=None):
+        # custom_id -> {"response", "model", "prompt_tokens", "cached_prompt_tokens", "completion_tokens"} or {"error"}
+        self.results = results if results is not None else {}
+        # custom_id -> request line of the next batch file
+        self.requests = {}
+        self._lock = threading.Lock()
         
-    def start_conversation(self, questions, language="English"):
-        """Initialize the conversation with the student"""
-        self.questions = questions
-        self.current_question_idx = 0
-        self.conversation_history = []
-        self.student_responses = {}
-        self.language = language
-        self.timestamps = []  # Add timestamps to track response times
-        self.timestamps.append(datetime.now().isoformat())  # Initial timestamp
+    @staticmethod
+    def custom_id(stage, messages):
+        # Identical prompts get the same ID, so they are requested (and paid for) once
+        return f"{stage}:{LLMCassette.prompt_hash(messages)[:32]}"
         
-        return {
-            "message": self.intro_messages.get(language, self.intro_messages["English"]),
-            "question": questions[0],
-            "done": False
+    def lookup(self, stage, messages):
+        return self.results.get(self.custom_id(stage, messages))
+        
+    def request(self, stage, route, messages, temperature):
+        custom_id = self.custom_id(stage, messages)
+        body = {
+            "model": route["model"],
+            "messages": [{"role": self.ROLES.get(m["role"], m["role"]), "content": m["content"]} for m in messages],
+            "temperature": temperature
         }
+        if route.get("max_tokens"):
+            body["max_tokens"] = route["max_tokens"]
+        with self._lock:
+            self.requests[custom_id] = {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}
+            
+    @staticmethod
+    def parse_result(line):
+        """(custom_id, result) of one line of a batch results file"""
+        record = json.loads(line)
+        response = record.get("response") or {}
+        body = response.get("body") or {}
+        if record.get("error") or response.get("status_code", 200) != 200 or not body.get("choices"):
+            error = record.get("error") or body.get("error") or f"status {response.get('status_code')}"
+            return record["custom_id"], {"error": str(error)}
+        usage = body.get("usage") or {}
+        return record["custom_id"], {
+            "response": body["choices"][0]["message"]["content"],
+            "model": body.get("model"),
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "cached_prompt_tokens": (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0)
+        }
+
+class UsageCallbackHandler(BaseCallbackHandler):
+    """Collects the token usage reported by the model for one call"""
     
-    def continue_conversation(self, student_response):
-        """Process student response and continue conversation"""
-        # Record timestamp for this response
-        self.timestamps.append(datetime.now().isoformat())
-        
-        # Record response
-        current_question = self.questions[self.current_question_idx]
-        self.student_responses[current_question] = student_response
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_prompt_tokens = 0
         
-        # Update conversation history
-        self.conversation_history.append({"question": current_question, "response": student_response})
+    def on_llm_end(self, response, **kwargs):
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        self.prompt_tokens += token_usage.get("prompt_tokens", 0)
+        self.completion_tokens += token_usage.get("completion_tokens", 0)
         
-        # Move to next question or finish
-        self.current_question_idx += 1
-        if self.current_question_idx < len(self.questions):
-            next_question = self.questions[self.current_question_idx]
-            return {
-                "message": self.response_acknowledgments.get(self.language, self.response_acknowledgments["English"]),
-                "question": next_question,
-                "done": False
-            }
-        else:
-            return {
-                "message": self.completion_messages.get(self.language, self.completion_messages["English"]),
-                "question": None,
-                "done": True
-            }
+        # Prompt tokens served from the provider's prefix cache
+        cached = (token_usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+        if cached is None:
+            # Newer clients only report it on the message usage metadata
+            cached = 0
+            for generations in response.generations:
+                for generation in generations:
+                    usage_metadata = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                    cached += (usage_metadata.get("input_token_details") or {}).get("cache_read", 0) or 0
+        self.cached_prompt_tokens += cached
+
+def estimate_cost(model_name, prompt_tokens, completion_tokens, cached_prompt_tokens=0):
+    """Estimate the USD cost of a call, or None for models without known pricing"""
+    if model_name not in MODEL_PRICING:
+        return None
+    prompt_price, completion_price = MODEL_PRICING[model_name]
+    billed_prompt_tokens = prompt_tokens - cached_prompt_tokens * (1 - CACHED_PROMPT_DISCOUNT)
+    return (billed_prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+# Hedged requests, opt-in with LLM_HEDGING=1: when a call takes longer than the HEDGE_PERCENTILE
+# of its stage's recent latencies, a duplicate request is sent and the first response wins.
+# Duplicates stop firing while their tokens exceed HEDGE_MAX_EXTRA_SPEND of the tokens spent.
+class HedgingPolicy:
+    """Learns per-stage latency percentiles and decides when a duplicate request may be sent"""
     
-    def get_conversation_summary(self, language="English"):
-        """Generate a summary of the conversation"""
-        system_prompt_templates = {
-            "English": "You are an educational assessment expert. Summarize the following student responses to questions.",
-            "Español": "Eres un experto en evaluación educativa. Resume las siguientes respuestas del estudiante a las preguntas."
-        }
+    def __init__(self, percentile=95, max_extra_spend=0.1, min_samples=20, window=200):
+        self.percentile = percentile
+        self.max_extra_spend = max_extra_spend
+        self.min_samples = min_samples
+        self.window = window
+        self._latencies = {}  # stage -> recent latencies in seconds
+        self._lock = threading.Lock()
+        self.primary_tokens = 0
+        self.hedge_tokens = 0
+        self.fired = 0
+        self.won = 0
         
-        human_prompt_templates = {
-            "English": "Here are the questions and student responses:\n{conversation}\n\n"
-                    "Provide a concise summary of the conversation highlighting key points from the student's responses.",
-            "Español": "Aquí están las preguntas y las respuestas del estudiante:\n{conversation}\n\n"
-                     "Proporciona un resumen conciso de la conversación destacando los puntos clave de las respuestas del estudiante."
-        }
+    def hedge_delay(self, stage):
+        """Seconds after which a call of this stage is hedged, or None without enough history"""
+        with self._lock:
+            samples = sorted(self._latencies.get(stage, []))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * self.percentile / 100))]
         
-        system_prompt = system_prompt_templates.get(language, system_prompt_templates["English"])
-        human_prompt = human_prompt_templates.get(language, human_prompt_templates["English"])
+    def record_latency(self, stage, seconds):
+        with self._lock:
+            samples = self._latencies.setdefault(stage, [])
+            samples.append(seconds)
+            del samples[:-self.window]
         
-        prompt = ChatPromptTemplate.from_messages([
-            SystemMessagePromptTemplate.from_template(system_prompt),
-            HumanMessagePromptTemplate.from_template(human_prompt)
-        ])
+    def allow_hedge(self):
+        with self._lock:
+            return self.hedge_tokens < self.max_extra_spend * self.primary_tokens
         
-        conversation_text = "\n\n".join([
-            f"Question: {item['question']}\nResponse: {item['response']}" 
-            for item in self.conversation_history
-        ])
+    def record_tokens(self, tokens, hedge=False):
+        with self._lock:
+            if hedge:
+                self.hedge_tokens += tokens
+            else:
+                self.primary_tokens += tokens
         
-        chain = LLMChain(llm=self.llm, prompt=prompt)
+    def record_hedge(self, won):
+        with self._lock:
+            self.fired += 1
+            self.won += int(won)
+        
+    def stats(self):
+        with self._lock:
+            return {
+                "hedges_fired": self.fired,
+                "hedges_won": self.won,
+                "extra_token_ratio": round(self.hedge_tokens / self.primary_tokens, 3) if self.primary_tokens else None
+            }
+
+def hedging_enabled():
+    return os.environ.get("LLM_HEDGING") == "1"
+
+@st.cache_resource(show_spinner=False)
+def get_hedging_policy():
+    return HedgingPolicy(
+        percentile=float(os.environ.get("HEDGE_PERCENTILE", "95")),
+        max_extra_spend=float(os.environ.get("HEDGE_MAX_EXTRA_SPEND", "0.1"))
+    )
+
+# Usage quotas: tokens and calls are metered per API key, assignment and session over sliding
+# windows. New submissions are admitted only while every scope has room for a typical
+# evaluation; otherwise they wait up to QUOTA_MAX_WAIT_SECONDS for room, or are rejected.
+# An admitted submission reserves that room until its evaluation finishes. The meter is kept
+# in USAGE_METER_FILE, so every process sharing the data directory counts against the same quotas;
+# each process buffers the charges of its LLM calls and writes them every USAGE_FLUSH_SECONDS.
+DEFAULT_QUOTAS = {
+    "key": {"tokens": 2000000, "calls": None, "window_seconds": 3600},
+    "assignment": {"tokens": 500000, "calls": None, "window_seconds": 3600},
+    "session": {"tokens": 60000, "calls": 60, "window_seconds": 3600}
+}
+QUOTA_MAX_WAIT_SECONDS = float(os.environ.get("QUOTA_MAX_WAIT_SECONDS", "30"))
+# Expected usage of one submission until enough evaluations have been metered
+EVALUATION_TOKEN_ESTIMATE = 8000
+EVALUATION_CALL_ESTIMATE = 8
+USAGE_METER_FILE = "data/usage/meter.json"
+# A reservation left by a conversation that was never finished is dropped after this long
+QUOTA_RESERVATION_SECONDS = int(os.environ.get("QUOTA_RESERVATION_SECONDS", "3600"))
+QUOTA_POLL_SECONDS = 1.0  # Reservations can be released at any time, so waiting admissions check this often
+USAGE_FLUSH_SECONDS = float(os.environ.get("USAGE_FLUSH_SECONDS", "1"))
+
+def load_quotas():
+    """Load the quotas, merging QUOTAS_FILE (if set) over the defaults; a limit of null is unlimited"""
+    quotas = {kind: dict(quota) for kind, quota in DEFAULT_QUOTAS.items()}
+    quotas_file = os.environ.get("QUOTAS_FILE")
+    if quotas_file:
         try:
-            summary = chain.run(conversation=conversation_text)
+            with open(quotas_file, "r", encoding="utf-8") as f:
+                for kind, quota in json.load(f).items():
+                    quotas.setdefault(kind, {}).update(quota)
         except Exception as e:
-            logging.error(f"Error generando resumen de conversación: {e}")
-            summary = "No se pudo generar el resumen de la conversación."
+            logging.error(f"Error cargando la configuración de cuotas {quotas_file}: {e}")
+    return quotas
+
+class QuotaExceeded(Exception):
+    """A scope has no room for a new evaluation within the admission wait"""
+    
+    def __init__(self, scope, retry_after, message=None):
+        super().__init__(message or f"Usage quota of {scope} exhausted; retry in {retry_after:.0f}s")
+        self.scope = scope
+        self.retry_after = retry_after
+
+class UsageMeter:
+    """Sliding-window token and call counts per scope, and admission control against the quotas.
+    
+    The counts live in a JSON file updated under its file lock, so they are shared by every
+    process. Usage is added up in buckets of 1/60 of the scope's window, which keeps the
+    file small. Times are wall-clock times, the same in every process. Charges are buffered
+    in memory and written at most every flush_seconds, so LLM calls don't wait on the file;
+    this process's checks see its own buffered charges, other processes' once written.
+    """
+    
+    def __init__(self, quotas, path=USAGE_METER_FILE, history=50, flush_seconds=USAGE_FLUSH_SECONDS):
+        self.quotas = quotas
+        self.path = path
+        self.history = history
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending = {}  # (scope, bucket start) -> [tokens, calls] not yet written
+        self._pending_sessions = {}  # session ID -> assignment ID of buffered charges
+        self._flush_timer = None
+        atexit.register(self.flush)
+        
+    def _quota(self, scope):
+        return self.quotas.get(scope.split(":")[0]) or {}
+        
+    def _window(self, scope):
+        return self._quota(scope).get("window_seconds", 3600)
+        
+    def _bucket_seconds(self, scope):
+        return max(1, self._window(scope) // 60)
+        
+    def _read(self):
+        state = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    state = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error(f"Error leyendo el contador de uso {self.path}: {e}")
+        state.setdefault("buckets", {})  # scope -> [[bucket start, tokens, calls], ...], oldest first
+        state.setdefault("reservations", {})  # session ID -> {scopes, tokens, calls, used_tokens, used_calls, expires_at}
+        state.setdefault("evaluations", [])  # [tokens, calls] of recent evaluations
+        state.setdefault("sessions", {})  # session ID -> assignment ID, to show a course only its sessions
+        state.setdefault("stats", {"admitted": 0, "queued": 0, "rejected": 0, "wait_seconds": 0.0})
+        return state
+        
+    def _prune(self, state, now):
+        for scope in list(state["buckets"]):
+            cutoff = now - self._window(scope) - self._bucket_seconds(scope)
+            state["buckets"][scope] = [bucket for bucket in state["buckets"][scope] if bucket[0] > cutoff]
+            if not state["buckets"][scope]:
+                del state["buckets"][scope]
+        for reservation_id, reservation in list(state["reservations"].items()):
+            if reservation["expires_at"] <= now:
+                del state["reservations"][reservation_id]
+        for session_id in list(state["sessions"]):
+            if f"session:{session_id}" not in state["buckets"] and session_id not in state["reservations"]:
+                del state["sessions"][session_id]
+        return state
+        
+    @staticmethod
+    def _link_session(sessions, scopes):
+        """Note the assignment of the session among scopes, if both are there"""
+        ids = dict(scope.split(":", 1) for scope in scopes)
+        if "session" in ids and "assignment" in ids:
+            sessions[ids["session"]] = ids["assignment"]
+        
+    def _apply_pending(self, state, clear=False):
+        """Add the buffered charges to state (taking them out of the buffer if clear)"""
+        with self._pending_lock:
+            pending, sessions = self._pending, self._pending_sessions
+            if clear:
+                self._pending, self._pending_sessions = {}, {}
+        for (scope, start), (tokens, calls) in pending.items():
+            buckets = state["buckets"].setdefault(scope, [])
+            # Buckets are oldest first; another process may already have written a later one
+            index = len(buckets)
+            while index > 0 and buckets[index - 1][0] > start:
+                index -= 1
+            if index > 0 and buckets[index - 1][0] == start:
+                buckets[index - 1][1] += tokens
+                buckets[index - 1][2] += calls
+            else:
+                buckets.insert(index, [start, tokens, calls])
+            if scope.startswith("session:"):
+                reservation = state["reservations"].get(scope[len("session:"):])
+                if reservation is not None:
+                    reservation["used_tokens"] += tokens
+                    reservation["used_calls"] += calls
+        state["sessions"].update(sessions)
+        return state
+        
+    def _snapshot(self):
+        """The meter as written, plus this process's buffered charges"""
+        return self._apply_pending(self._prune(self._read(), time.time()))
+        
+    @contextmanager
+    def _update(self):
+        """Read, change and write the meter, with no other thread or process in between.
         
+        The buffered charges are written with it.
+        """
+        with self._lock, file_lock(self.path):
+            state = self._apply_pending(self._prune(self._read(), time.time()), clear=True)
+            yield state
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.path)
+        
+    def record(self, scopes, tokens, calls=1):
+        """Charge tokens and calls to scopes; calls=0 adds tokens of a call already counted.
+        
+        Usage charged to a session is taken out of the reservation made when it was admitted.
+        The charge is buffered and written by the next flush.
+        """
+        now = time.time()
+        with self._pending_lock:
+            for scope in scopes:
+                charge = self._pending.setdefault((scope, now - now % self._bucket_seconds(scope)), [0, 0])
+                charge[0] += tokens
+                charge[1] += calls
+            self._link_session(self._pending_sessions, scopes)
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.flush_seconds, self._flush_later)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+        
+    def _flush_later(self):
+        with self._pending_lock:
+            self._flush_timer = None
+        self.flush()
+        
+    def flush(self):
+        """Write the buffered charges to the meter file"""
+        with self._pending_lock:
+            if not self._pending and not self._pending_sessions:
+                return
+        try:
+            with self._update():
+                pass
+        except Exception as e:
+            logging.error(f"Error guardando el contador de uso {self.path}: {e}")
+        
+    def record_evaluation(self, tokens, calls):
+        with self._update() as state:
+            state["evaluations"] = (state["evaluations"] + [[tokens, calls]])[-self.history:]
+        
+    def release(self, reservation_id):
+        """Drop a session's reservation once its evaluation is over; what it used stays counted"""
+        with self._update() as state:
+            state["reservations"].pop(reservation_id, None)
+        
+    def expected_evaluation(self):
+        """(tokens, calls) of a typical evaluation, from recent ones"""
+        evaluations = self._read()["evaluations"]  # Not buffered
+        if not evaluations:
+            return EVALUATION_TOKEN_ESTIMATE, EVALUATION_CALL_ESTIMATE
+        return (
+            sum(tokens for tokens, _ in evaluations) // len(evaluations),
+            sum(calls for _, calls in evaluations) // len(evaluations)
+        )
+        
+    def _blocked(self, state, scopes, expected_tokens, expected_calls, now):
+        """None if every scope has room for the expected usage, else (scope, seconds until it has)"""
+        for scope in scopes:
+            quota = self._quota(scope)
+            window = self._window(scope)
+            # (time it stops counting, tokens, calls): used buckets leave the window, reservations expire
+            held = [
+                (start + self._bucket_seconds(scope) + window, tokens, calls)
+                for start, tokens, calls in state["buckets"].get(scope, [])
+            ] + [
+                (
+                    reservation["expires_at"],
+                    max(0, reservation["tokens"] - reservation["used_tokens"]),
+                    max(0, reservation["calls"] - reservation["used_calls"])
+                )
+                for reservation in state["reservations"].values() if scope in reservation["scopes"]
+            ]
+            for index, (limit_name, expected) in enumerate([("tokens", expected_tokens), ("calls", expected_calls)], 1):
+                limit = quota.get(limit_name)
+                if limit is None:
+                    continue
+                used = sum(item[index] for item in held)
+                if used + expected <= limit:
+                    continue
+                # Room appears as the oldest usage leaves the window (never, if expected alone is over the limit)
+                excess, freed, retry_after = used + expected - limit, 0, math.inf
+                for item in sorted(held):
+                    freed += item[index]
+                    if freed >= excess:
+                        retry_after = item[0] - now
+                        break
+                return scope, max(0.0, retry_after)
+        return None
+        
+    def check(self, scopes, expected_tokens=0, expected_calls=0):
+        """None if every scope has room for the expected usage, else (scope, seconds until it has)"""
+        return self._blocked(self._snapshot(), scopes, expected_tokens, expected_calls, time.time())
+        
+    def admit(self, scopes, reservation_id=None, max_wait=QUOTA_MAX_WAIT_SECONDS):
+        """Wait (up to max_wait seconds) until every scope has room for a typical evaluation.
+        
+        The room is reserved under reservation_id (the session ID) until release()
+        is called or QUOTA_RESERVATION_SECONDS pass. Raises QuotaExceeded if the
+        room would not appear in time.
+        """
+        expected_tokens, expected_calls = self.expected_evaluation()
+        start = time.time()
+        waited = False
+        while True:
+            rejected = None
+            with self._update() as state:
+                now = time.time()
+                blocked = self._blocked(state, scopes, expected_tokens, expected_calls, now)
+                if blocked is None:
+                    if reservation_id is not None:
+                        self._link_session(state["sessions"], list(scopes) + [f"session:{reservation_id}"])
+                        state["reservations"][reservation_id] = {
+                            "scopes": list(scopes),
+                            "tokens": expected_tokens,
+                            "calls": expected_calls,
+                            "used_tokens": 0,
+                            "used_calls": 0,
+                            "expires_at": now + QUOTA_RESERVATION_SECONDS
+                        }
+                    state["stats"]["admitted"] += 1
+                    state["stats"]["wait_seconds"] += now - start
+                    return
+                scope, retry_after = blocked
+                if now + retry_after > start + max_wait:
+                    state["stats"]["rejected"] += 1
+                    rejected = scope, retry_after
+                elif not waited:
+                    waited = True
+                    state["stats"]["queued"] += 1
+            if rejected is not None:
+                scope, retry_after = rejected
+                if math.isinf(retry_after):
+                    retry_after = self._window(scope)
+                raise QuotaExceeded(scope, retry_after)
+            time.sleep(min(retry_after, QUOTA_POLL_SECONDS) + 0.01)
+        
+    def report(self, assignment_ids=None):
+        """Current usage of every metered scope against its quota.
+        
+        With assignment_ids, only those assignments and their sessions.
+        """
+        state = self._snapshot()
+        rows = []
+        for scope, buckets in state["buckets"].items():
+            if assignment_ids is not None:
+                kind, _, scope_id = scope.partition(":")
+                if kind == "session":
+                    scope_id = state["sessions"].get(scope_id)
+                if kind not in ["assignment", "session"] or scope_id not in assignment_ids:
+                    continue
+            quota = self._quota(scope)
+            tokens = sum(bucket[1] for bucket in buckets)
+            calls = sum(bucket[2] for bucket in buckets)
+            shares = [0.0]
+            if quota.get("tokens"):
+                shares.append(tokens / quota["tokens"])
+            if quota.get("calls"):
+                shares.append(calls / quota["calls"])
+            rows.append({
+                "scope": scope,
+                "calls": calls,
+                "tokens": tokens,
+                "token_quota": quota.get("tokens"),
+                "call_quota": quota.get("calls"),
+                "percent_used": round(max(shares) * 100, 1)
+            })
+        return sorted(rows, key=lambda row: row["percent_used"], reverse=True)
+        
+    def stats(self):
+        state = self._snapshot()
+        stats = state["stats"]
         return {
-            "conversation_history": self.conversation_history,
-            "summary": summary,
-            "responses": self.student_responses,
-            "language": language,
-            "timestamps": self.timestamps  # Include timestamps for response time analysis
+            "admitted": stats["admitted"],
+            "queued": stats["queued"],
+            "rejected": stats["rejected"],
+            "reserved": len(state["reservations"]),
+            "mean_wait_seconds": round(stats["wait_seconds"] / stats["admitted"], 2) if stats["admitted"] else None
         }
 
-class EvaluationAgent:
-    """Agent that evaluates the student's work and conversation responses"""
+@st.cache_resource(show_spinner=False)
+def get_usage_meter():
+    return UsageMeter(load_quotas())
+
+def _run_chain(chain, stage, usage, stage_inputs, timeout=None, record_late_usage=None):
+    """Run a chain, within timeout seconds and hedged if enabled.
+    
+    Returns (response, hedged, hedge_won); the winning call's token usage is added to usage.
+    A call whose response is discarded (a losing hedge, or a call that missed the
+    deadline) still spends tokens: record_late_usage(call_usage, extra_call) is called
+    with them once it completes. extra_call is False for the primary call of a stage
+    that timed out, which the caller has already counted.
+    """
+    policy = get_hedging_policy() if hedging_enabled() else None
+    hedge_delay = policy.hedge_delay(stage) if policy is not None else None
+    if timeout is None and hedge_delay is None and policy is None:
+        return chain.run(callbacks=[usage], **stage_inputs), False, False
+    
+    start = time.monotonic()
+    end = start + timeout if timeout is not None else None
+    
+    def remaining():
+        return None if end is None else max(0, end - time.monotonic())
+    
+    def submit():
+        call_usage = UsageCallbackHandler()
+        return get_stage_executor().submit(chain.run, callbacks=[call_usage], **stage_inputs), call_usage
+    
+    primary, primary_usage = submit()
+    calls = {primary: primary_usage}
+    hedge = None
+    if hedge_delay is not None:
+        done, _ = wait([primary], timeout=hedge_delay if end is None else min(hedge_delay, remaining()))
+        if not done and policy.allow_hedge() and remaining() != 0:
+            hedge, hedge_usage = submit()
+            calls[hedge] = hedge_usage
+    
+    # The first successful response wins
+    pending, winner, error = set(calls), None, None
+    while pending and winner is None:
+        done, pending = wait(pending, timeout=remaining(), return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            if future.exception() is None and winner is None:
+                winner = future
+            elif future.exception() is not None:
+                error = future.exception()
+    
+    def account_loser(future):
+        # The call's tokens are spent even though its response is discarded
+        if future.cancelled() or future.exception() is not None:
+            return
+        loser_usage = calls[future]
+        if hedge is not None:
+            policy.record_tokens(loser_usage.prompt_tokens + loser_usage.completion_tokens, hedge=True)
+        if record_late_usage is not None:
+            record_late_usage(loser_usage, winner is not None or future is not primary)
+    
+    for future in calls:
+        if future is not winner:
+            # A request already in flight can't be interrupted; its result is ignored
+            future.cancel()
+            future.add_done_callback(account_loser)
+    
+    if hedge is not None:
+        policy.record_hedge(won=winner is hedge)
+    if winner is None:
+        if error is not None:
+            raise error
+        raise TimeoutError(f"{stage} missed its deadline of {timeout:.0f}s")
+    
+    winner_usage = calls[winner]
+    usage.prompt_tokens += winner_usage.prompt_tokens
+    usage.cached_prompt_tokens += winner_usage.cached_prompt_tokens
+    usage.completion_tokens += winner_usage.completion_tokens
+    if policy is not None:
+        policy.record_latency(stage, time.monotonic() - start)
+        policy.record_tokens(winner_usage.prompt_tokens + winner_usage.completion_tokens)
+    return winner.result(), hedge is not None, winner is hedge
+
+def run_llm_stage(llm, stage, prompt, metrics=None, deadline=None, **inputs):
+    """Run a prompt for an agent stage and record its latency, tokens and cost.
+    
+    llm may be a ModelRouter, in which case the stage's routed model is used
+    and the call is recorded to / replayed from the router's cassette, or a
+    plain chat model. Only the inputs used by the prompt are passed on.
+    With a deadline (a time.monotonic() value, usually the end of the evaluation
+    budget), the call raises TimeoutError once the deadline or the stage's own
+    route timeout passes, whichever comes first. Slow calls are hedged when
+    LLM_HEDGING=1 (see HedgingPolicy). With a batch on the router, the call is
+    answered from the batch or queued in it (raising BatchPending). Calls made
+    to the provider are charged to the router's usage scopes.
+    """
+    router = llm if isinstance(llm, ModelRouter) else None
+    cassette = router.cassette if router is not None else None
+    batch = router.batch if router is not None else None
+    model_name = router.route(stage)["model"] if router is not None else getattr(llm, "model_name", type(llm).__name__)
+    stage_inputs = {name: inputs[name] for name in prompt.input_variables}
+    usage = UsageCallbackHandler()
+    
+    messages = None
+    if cassette is not None or batch is not None:
+        messages = [{"role": m.type, "content": m.content} for m in prompt.format_messages(**stage_inputs)]
+    
+    start = time.perf_counter()
+    error = None
+    hedged = hedge_won = False
+    queued = called = False
+    try:
+        if cassette is not None and cassette.mode == "replay":
+            entry = cassette.replay(stage, messages)
+            model_name = entry["model"]
+            usage.prompt_tokens = entry["prompt_tokens"]
+            usage.cached_prompt_tokens = entry.get("cached_prompt_tokens", 0)
+            usage.completion_tokens = entry["completion_tokens"]
+            return entry["response"]
+        
+        if batch is not None:
+            result = batch.lookup(stage, messages)
+            if result is None:
+                batch.request(stage, router.route(stage), messages, router.temperature)
+                queued = True
+                raise BatchPending(stage)
+            if "error" in result:
+                raise RuntimeError(f"Batch request for {stage} failed: {result['error']}")
+            model_name = result.get("model") or model_name
+            usage.prompt_tokens = result["prompt_tokens"]
+            usage.cached_prompt_tokens = result["cached_prompt_tokens"]
+            usage.completion_tokens = result["completion_tokens"]
+            return result["response"]
+        
+        model = router.for_stage(stage) if router is not None else llm
+        chain = LLMChain(llm=model, prompt=prompt)
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+            if router is not None and router.route(stage).get("timeout"):
+                timeout = min(timeout, router.route(stage)["timeout"])
+            if timeout <= 0:
+                raise TimeoutError(f"No time left in the evaluation budget for {stage}")
+        def record_late_usage(late_usage, extra_call):
+            # Recorded on its own: this stage's entry was written when it returned or gave up
+            if router is not None and router.usage_scopes:
+                get_usage_meter().record(
+                    router.usage_scopes, late_usage.prompt_tokens + late_usage.completion_tokens, calls=int(extra_call)
+                )
+            if metrics is not None:
+                metrics.append({
+                    "stage": stage,
+                    "model": model_name,
+                    "latency_seconds": round(time.perf_counter() - start, 3),
+                    "prompt_tokens": late_usage.prompt_tokens,
+                    "cached_prompt_tokens": late_usage.cached_prompt_tokens,
+                    "completion_tokens": late_usage.completion_tokens,
+                    "cost_usd": estimate_cost(
+                        model_name, late_usage.prompt_tokens, late_usage.completion_tokens, late_usage.cached_prompt_tokens
+                    ),
+                    "error": "discarded",
+                    "hedged": False,
+                    "hedge_won": False
+                })
+        
+        # A call that overruns keeps running in its thread, but the pipeline moves on
+        called = True
+        response, hedged, hedge_won = _run_chain(chain, stage, usage, stage_inputs, timeout, record_late_usage)
+        if cassette is not None:
+            cassette.record(stage, model_name, messages, response, time.perf_counter() - start, usage)
+        return response
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        # Replayed and batch calls don't use the live rate limits the quotas protect
+        if called and router is not None and router.usage_scopes:
+            get_usage_meter().record(router.usage_scopes, usage.prompt_tokens + usage.completion_tokens)
+        # Queued calls are recorded once their response is ingested
+        if metrics is not None and not queued:
+            cost = estimate_cost(model_name, usage.prompt_tokens, usage.completion_tokens, usage.cached_prompt_tokens)
+            if batch is not None and cost is not None:
+                cost *= BATCH_DISCOUNT
+            metrics.append({
+                "stage": stage,
+                "model": model_name,
+                "latency_seconds": round(time.perf_counter() - start, 3),
+                "prompt_tokens": usage.prompt_tokens,
+                "cached_prompt_tokens": usage.cached_prompt_tokens,
+                "completion_tokens": usage.completion_tokens,
+                "cost_usd": cost,
+                "error": error,
+                "hedged": hedged,
+                "hedge_won": hedge_won
+            })
+            if batch is not None:
+                metrics[-1]["batch_request"] = LLMBatch.custom_id(stage, messages)
+
+def stage_memo_key(llm, stage, prompt, inputs, ignored_inputs=()):
+    """Hash identifying a stage's output: its prompt template (the prompt version), model and inputs.
+    
+    A memoized output is reused as long as the key is unchanged (see EvaluationService.regrade_evaluation).
+    """
+    model_name = llm.route(stage)["model"] if isinstance(llm, ModelRouter) else getattr(llm, "model_name", type(llm).__name__)
+    payload = {
+        "stage": stage,
+        "model": model_name,
+        "prompt": [message.prompt.template for message in prompt.messages],
+        "inputs": {name: inputs[name] for name in prompt.input_variables if name not in ignored_inputs}
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:32]
+
+def summarize_stage_metrics(metrics):
+    """Aggregate per-stage metrics into per-evaluation totals"""
+    # Later batch waves look up earlier responses again; each batch request counts once
+    metrics = list({m.get("batch_request") or i: m for i, m in enumerate(metrics)}.values())
+    costs = [m["cost_usd"] for m in metrics if m["cost_usd"] is not None]
+    prompt_tokens = sum(m["prompt_tokens"] for m in metrics)
+    cached_prompt_tokens = sum(m.get("cached_prompt_tokens", 0) for m in metrics)
+    return {
+        "calls": len(metrics),
+        "llm_seconds": round(sum(m["latency_seconds"] for m in metrics), 3),
+        "prompt_tokens": prompt_tokens,
+        "cached_prompt_tokens": cached_prompt_tokens,
+        "cache_hit_ratio": round(cached_prompt_tokens / prompt_tokens, 3) if prompt_tokens else None,
+        "completion_tokens": sum(m["completion_tokens"] for m in metrics),
+        "cost_usd": round(sum(costs), 6) if costs else None,
+        "hedges_fired": sum(1 for m in metrics if m.get("hedged")),
+        "hedges_won": sum(1 for m in metrics if m.get("hedge_won")),
+        "stages": list(metrics)
+    }
+
+
+# Every LLM call about one submission (evaluation stages, structuring, report) starts with the
+# same system prompt and the same prefix, followed by a stage-specific suffix. Keeping the long
+# part identical and first lets the provider serve it from its prompt cache.
+SUBMISSION_SYSTEM_PROMPTS = {
+    "English": """You are an expert educational evaluator.
+    Your task is to assess student work and conversation responses against specific learning objectives.
+    Provide a fair, balanced, and constructive evaluation. Back up your assessments with specific evidence from the student's work and responses.""",
+    
+    "Español": """Eres un evaluador educativo experto.
+    Tu tarea es evaluar el trabajo del estudiante y las respuestas de la conversación en relación con objetivos de aprendizaje específicos.
+    Proporciona una evaluación justa, equilibrada y constructiva. Respalda tus evaluaciones con ejemplos específicos del trabajo y las respuestas del estudiante.
+    Debes analizar cuidadosamente la autenticidad del trabajo, detectando posible plagio o contenido copiado."""
+}
+
+SUBMISSION_PREFIX_TEMPLATES = {
+    "English": "Assignment Instructions:\n{assignment_text}\n\n"
+             "Learning Objectives:\n{learning_objectives}\n\n"
+             "Reference Material (digest of the teacher's document):\n{reference_digest}\n\n"
+             "Student Submission:\n{submission_text}\n\n",
+             
+    "Español": "Instrucciones de la tarea:\n{assignment_text}\n\n"
+              "Objetivos de aprendizaje:\n{learning_objectives}\n\n"
+              "Material de referencia (resumen del documento del profesor):\n{reference_digest}\n\n"
+              "Entrega del estudiante:\n{submission_text}\n\n"
+}
+
+NO_REFERENCE_DIGEST = {
+    "English": "(no reference document)",
+    "Español": "(sin documento de referencia)"
+}
+
+def reference_digest_text(digest, language):
+    """The digest as it goes into prompts, with a placeholder for assignments without a document"""
+    return digest or NO_REFERENCE_DIGEST.get(language, NO_REFERENCE_DIGEST["Español"])
+
+def build_submission_prompt(suffix_template, language):
+    """Build a prompt made of the shared per-submission prefix and a stage-specific suffix"""
+    system_prompt = SUBMISSION_SYSTEM_PROMPTS.get(language, SUBMISSION_SYSTEM_PROMPTS["Español"])
+    prefix_template = SUBMISSION_PREFIX_TEMPLATES.get(language, SUBMISSION_PREFIX_TEMPLATES["Español"])
+    return ChatPromptTemplate.from_messages([
+        SystemMessagePromptTemplate.from_template(system_prompt),
+        HumanMessagePromptTemplate.from_template(prefix_template + suffix_template)
+    ])
+
+
+# Structured output parsing. LLM JSON is repaired locally (code fences and prose around it, single
+# quotes, unquoted keys, Python literals, trailing commas, truncation) and validated against the
+# evaluation schema, so one malformed field no longer costs the whole structured evaluation.
+JSON_LITERALS = {"True": "true", "False": "false", "None": "null", "true": "true", "false": "false", "null": "null"}
+
+def repair_json(text):
+    """Parse the first JSON object in an LLM response, repairing common defects; None if impossible"""
+    start = (text or "").find("{")
+    if start == -1:
+        return None
+    text = text[start:]
+    try:
+        value, _ = json.JSONDecoder().raw_decode(text)
+        return value if isinstance(value, dict) else None
+    except json.JSONDecodeError:
+        pass
+    
+    out, closers = [], []
+    quote = None  # delimiter of the string being read
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if quote:
+            if char == "\\" and i + 1 < len(text):
+                # \' is not a JSON escape
+                out.append("'" if text[i + 1] == "'" else text[i:i + 2])
+                i += 2
+                continue
+            if char == quote:
+                out.append('"')
+                quote = None
+            elif char == '"':
+                out.append('\\"')
+            elif ord(char) < 32:
+                out.append(json.dumps(char)[1:-1])
+            else:
+                out.append(char)
+        elif char in "\"'":
+            quote = char
+            out.append('"')
+        elif char in "{[":
+            closers.append("}" if char == "{" else "]")
+            out.append(char)
+        elif char in "}]":
+            # Trailing comma before the closer
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            if closers:
+                closers.pop()
+            out.append(char)
+            if not closers:
+                # End of the object; any prose after it is ignored
+                break
+        elif char.isdigit():
+            # A whole number token, so the exponent of e.g. 1e5 isn't read as a word
+            number = re.match(r"\d+(?:\.\d*)?(?:[eE][+-]?\d*)?", text[i:]).group()
+            out.append(number)
+            i += len(number)
+            continue
+        elif char.isalpha() or char == "_":
+            word = re.match(r"\w+", text[i:]).group()
+            if re.match(r"\s*:", text[i + len(word):]):
+                out.append(f'"{word}"')  # unquoted key
+            else:
+                # Anything else (e.g. NaN or an unquoted word) can't be kept as a value
+                if word not in JSON_LITERALS and out and out[-1] == "-":
+                    out.pop()  # -Infinity
+                out.append(JSON_LITERALS.get(word, "null"))
+            i += len(word)
+            continue
+        else:
+            out.append(char)
+        i += 1
+    
+    repaired = "".join(out)
+    if quote:
+        # Truncated inside a string
+        repaired += '"'
+    if closers:
+        # Truncated: drop a dangling comma or key, then close what is still open
+        while True:
+            stripped = repaired.rstrip()
+            if stripped.endswith(","):
+                repaired = stripped[:-1]
+                continue
+            dangling_key = re.search(r'([{,])\s*"(?:[^"\\]|\\.)*"\s*:?$', stripped) if closers[-1] == "}" else None
+            if dangling_key:
+                repaired = stripped[:dangling_key.start() + 1]
+                continue
+            if stripped.endswith(":"):
+                repaired = stripped[:-1]
+                continue
+            partial_number = re.search(r"\d(?:\.|[eE][+-]?)$", stripped)
+            if partial_number:
+                repaired = stripped[:partial_number.start() + 1]
+                continue
+            break
+        repaired += "".join(reversed(closers))
+    try:
+        value, _ = json.JSONDecoder().raw_decode(repaired)
+    except json.JSONDecodeError:
+        return None
+    return value if isinstance(value, dict) else None
+
+def salvage_json_fields(text, keys):
+    """Recover individual top-level fields from a response that doesn't parse as a whole"""
+    fields = {}
+    for key in keys:
+        match = re.search(rf"[\"']?{re.escape(key)}[\"']?\s*:", text or "")
+        if match is None:
+            continue
+        # Parse from the key on; whatever follows its value is ignored
+        data = repair_json("{" + text[match.start():])
+        if data and key in data:
+            fields[key] = data[key]
+    return fields
+
+def _coerce_score(value):
+    """A 0-100 score from a number or a string such as "85" or "85/100"; None if invalid"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str):
+        match = re.search(r"\d+(?:[.,]\d+)?", value)
+        if match is None:
+            return None
+        value = float(match.group().replace(",", "."))
+    if not isinstance(value, (int, float)) or not 0 <= value <= 100:
+        return None
+    return int(value) if float(value).is_integer() else value
+
+def _validate_scored_entry(value):
+    """A {score, examples, feedback} entry with a valid score, or None"""
+    if not isinstance(value, dict):
+        return None
+    score = _coerce_score(value.get("score"))
+    if score is None:
+        return None
+    entry = dict(value, score=score)
+    for field in ["examples", "feedback"]:
+        if isinstance(entry.get(field), list):
+            entry[field] = "\n".join(str(item) for item in entry[field])
+        elif not entry.get(field):
+            entry[field] = "No disponible"
+    return entry
+
+def validate_structured_evaluation(data, learning_objectives=None):
+    """Check structuring output against the evaluation schema.
+    
+    Returns (fields, invalid): the valid fields (coerced where needed) and the
+    names of the missing or invalid ones. With learning_objectives=None the
+    objectives are not checked (they are scored separately in fan-out mode).
+    """
+    fields, invalid = {}, []
+    for criterion in SCORE_CRITERIA:
+        entry = _validate_scored_entry(data.get(criterion))
+        if entry is None:
+            invalid.append(criterion)
+        else:
+            fields[criterion] = entry
+    
+    if learning_objectives is not None:
+        objectives = data.get("learning_objectives")
+        entries = [_validate_scored_entry(obj) for obj in objectives] if isinstance(objectives, list) else []
+        if isinstance(objectives, list) and all(entries) and (entries or not learning_objectives):
+            for i, entry in enumerate(entries):
+                if not entry.get("objective"):
+                    entry["objective"] = learning_objectives[i] if i < len(learning_objectives) else "No disponible"
+            fields["learning_objectives"] = entries
+        else:
+            invalid.append("learning_objectives")
+    
+    plagiarism = data.get("plagiarism_detected")
+    if isinstance(plagiarism, str):
+        plagiarism = {"true": True, "yes": True, "sí": True, "si": True, "false": False, "no": False}.get(plagiarism.strip().lower())
+    if isinstance(plagiarism, bool):
+        fields["plagiarism_detected"] = plagiarism
+    else:
+        invalid.append("plagiarism_detected")
+    
+    for key in ["plagiarism_evidence", "summary"]:
+        if isinstance(data.get(key), str):
+            fields[key] = data[key]
+        else:
+            invalid.append(key)
+    return fields, invalid
+
+
+# Response-time analysis, computed locally instead of asking the LLM to judge a table of times.
+# Typing speed is compared with the assignment's history (running mean/variance per assignment),
+# and long answers that arrive faster than anyone types are flagged as paste-like.
+RESPONSE_TIME_STATS_FILE = "data/response_time_stats.json"
+
+PASTE_CHARS_PER_SECOND = 10  # ~120 wpm sustained, including time spent thinking
+PASTE_MIN_CHARS = 150
+OUTLIER_Z_SCORE = 3
+MIN_BASELINE_RESPONSES = 10
+
+RESPONSE_TIME_VERDICTS = {
+    "English": {
+        "unavailable": "Not available",
+        "paste": "{paste}/{total} answers arrived faster than typing allows (median {cps} chars/s, {wpm} wpm).",
+        "outlier": "{outliers}/{total} answers were unusually fast for this assignment (median {cps} chars/s, {wpm} wpm).",
+        "normal": "Response times are consistent with the amount of content (median {cps} chars/s, {wpm} wpm)."
+    },
+    "Español": {
+        "unavailable": "No disponible",
+        "paste": "{paste}/{total} respuestas llegaron más rápido de lo que se puede escribir (mediana {cps} caracteres/s, {wpm} ppm).",
+        "outlier": "{outliers}/{total} respuestas fueron inusualmente rápidas para esta tarea (mediana {cps} caracteres/s, {wpm} ppm).",
+        "normal": "Los tiempos de respuesta son coherentes con la cantidad de contenido (mediana {cps} caracteres/s, {wpm} ppm)."
+    }
+}
+
+def analyze_response_times(conversation_data, baseline=None, language="Español"):
+    """Typing speed per answer, z-scores against the assignment baseline and paste-like flags.
+    
+    baseline is the assignment's running {count, mean, m2} of characters per second.
+    Returns a compact numeric result with a one-line verdict for the prompt.
+    """
+    verdicts = RESPONSE_TIME_VERDICTS.get(language, RESPONSE_TIME_VERDICTS["Español"])
+    timestamps = conversation_data.get("timestamps") or []
+    history = conversation_data.get("conversation_history") or []
+    
+    std = None
+    if baseline and baseline["count"] >= MIN_BASELINE_RESPONSES:
+        std = (baseline["m2"] / (baseline["count"] - 1)) ** 0.5
     
-    def __init__(self, llm):
+    responses = []
+    for i in range(1, min(len(timestamps), len(history) + 1)):
+        seconds = (datetime.fromisoformat(timestamps[i]) - datetime.fromisoformat(timestamps[i-1])).total_seconds()
+        text = history[i-1]["response"]
+        chars_per_second = len(text) / seconds if seconds > 0 else None
+        z_score = None
+        if std and chars_per_second is not None:
+            z_score = round((chars_per_second - baseline["mean"]) / std, 2)
+        responses.append({
+            "seconds": round(seconds, 1),
+            "chars": len(text),
+            "words": len(text.split()),
+            "chars_per_second": round(chars_per_second, 2) if chars_per_second is not None else None,
+            "words_per_minute": round(len(text.split()) / seconds * 60, 1) if seconds > 0 else None,
+            "z_score": z_score,
+            "paste_like": len(text) >= PASTE_MIN_CHARS and (chars_per_second is None or chars_per_second > PASTE_CHARS_PER_SECOND)
+        })
+    
+    if not responses:
+        return {"responses": [], "verdict": verdicts["unavailable"]}
+    
+    def median(values):
+        values = [v for v in values if v is not None]
+        return round(statistics.median(values), 2) if values else None
+    
+    paste_like = sum(1 for r in responses if r["paste_like"])
+    outliers = sum(1 for r in responses if r["z_score"] is not None and r["z_score"] >= OUTLIER_Z_SCORE)
+    counts = {
+        "paste": paste_like,
+        "outliers": outliers,
+        "total": len(responses),
+        "cps": median(r["chars_per_second"] for r in responses),
+        "wpm": median(r["words_per_minute"] for r in responses)
+    }
+    if paste_like:
+        verdict = verdicts["paste"].format(**counts)
+    elif outliers:
+        verdict = verdicts["outlier"].format(**counts)
+    else:
+        verdict = verdicts["normal"].format(**counts)
+    
+    return {
+        "responses": responses,
+        "median_chars_per_second": counts["cps"],
+        "median_words_per_minute": counts["wpm"],
+        "paste_like_count": paste_like,
+        "outlier_count": outliers,
+        "baseline_responses": baseline["count"] if baseline else 0,
+        "verdict": verdict
+    }
+
+def update_response_time_baseline(baseline, analysis):
+    """Fold an evaluation's typing speeds into the running baseline (Welford's algorithm)"""
+    baseline = dict(baseline or {"count": 0, "mean": 0.0, "m2": 0.0})
+    for response in analysis["responses"]:
+        if response["chars_per_second"] is None:
+            continue
+        baseline["count"] += 1
+        delta = response["chars_per_second"] - baseline["mean"]
+        baseline["mean"] += delta / baseline["count"]
+        baseline["m2"] += delta * (response["chars_per_second"] - baseline["mean"])
+    return baseline
+
+
+# Agent definitions
+# The teacher's reference document is digested once per assignment into key points, expected
+# answers and rubric hints; prompts get the digest instead of the document.
+REFERENCE_DOCUMENT_MAX_CHARS = 40000
+REFERENCE_DIGEST_MAX_TOKENS = 600
+REFERENCE_DIGEST_RETRY_SECONDS = 60  # After a failed digest; doubles with each further failure
+REFERENCE_DIGEST_MAX_RETRY_SECONDS = 6 * 3600
+
+class ReferenceDigestAgent:
+    """Agent that condenses an assignment's reference document into a compact digest"""
+    
+    def __init__(self, llm, metrics=None):
         self.llm = llm
+        self.stage_metrics = metrics if metrics is not None else []
         self.system_prompts = {
-            "English": """You are an expert educational evaluator.
-            Your task is to assess student work and conversation responses against specific learning objectives.
-            Provide a fair, balanced, and constructive evaluation. Back up your assessments with specific evidence from the student's work and responses.""",
-            
-            "Español": """Eres un evaluador educativo experto.
-            Tu tarea es evaluar el trabajo del estudiante y las respuestas de la conversación en relación con objetivos de aprendizaje específicos.
-            Proporciona una evaluación justa, equilibrada y constructiva. Respalda tus evaluaciones con ejemplos específicos del trabajo y las respuestas del estudiante.
-            Debes analizar cuidadosamente la autenticidad del trabajo, detectando posible plagio o contenido copiado."""
-        }
-        
-        self.prompt_part1_templates = {
-            "English": "Assignment Instructions:\n{assignment_text}\n\n"
-                     "Student Submission:\n{submission_text}\n\n"
-                     "Conversation Summary:\n{conversation_summary}\n\n"
-                     "Evaluate the student's work on the following criteria:\n"
-                     "1. Comprehension - How well does the student understand the core concepts?\n"
-                     "2. Authenticity - Is the work original and does it show the student's own thinking?\n\n"
-                     "For each criterion, provide:\n"
-                     "- A score (0-100, where 100 is excellent)\n"
-                     "- Specific examples from the work or conversation\n"
-                     "- Constructive feedback",
-                     
-            "Español": "Instrucciones de la tarea:\n{assignment_text}\n\n"
-                      "Entrega del estudiante:\n{submission_text}\n\n"
-                      "Resumen de la conversación:\n{conversation_summary}\n\n"
-                      "Tiempos de respuesta: {response_times}\n\n"
-                      "Evalúa el trabajo del estudiante según los siguientes criterios:\n"
-                      "1. Comprensión (0-100) - ¿Qué tan bien comprende el estudiante los conceptos centrales?\n"
-                      "2. Autenticidad (0-100) - ¿Es el trabajo original y muestra el propio pensamiento del estudiante? Detecta si hay contenido copiado o plagiado.\n"
-                      "3. Habilidades relacionales (0-100) - ¿Cómo conecta el estudiante diferentes conceptos e ideas?\n"
-                      "4. Argumentación (0-100) - ¿Qué tan bien estructurados y fundamentados están sus argumentos?\n"
-                      "5. Uso de bibliografía (0-100) - ¿Cita o hace referencia a bibliografía adecuada?\n\n"
-                      "Para cada criterio, proporciona:\n"
-                      "- Una puntuación (0-100, donde 100 es excelente)\n"
-                      "- Ejemplos específicos del trabajo o la conversación\n"
-                      "- Retroalimentación constructiva\n\n"
-                      "Analiza también:\n"
-                      "- Consistencia entre el trabajo escrito y las respuestas en la conversación\n"
-                      "- Si los tiempos de respuesta son coherentes con la cantidad de contenido (respuestas muy elaboradas en tiempos muy cortos podrían indicar uso de contenido pregenerado)\n"
-                      "- Indica claramente si detectas copypaste o plagio, proporcionando evidencia"
+            "English": "You are an expert teaching assistant. You prepare compact grading notes from a teacher's reference material.",
+            "Español": "Eres un asistente docente experto. Preparas notas de evaluación compactas a partir del material de referencia del profesor."
         }
-        
-        self.prompt_part2_templates = {
+        self.prompt_templates = {
             "English": "Assignment Instructions:\n{assignment_text}\n\n"
                      "Learning Objectives:\n{learning_objectives}\n\n"
-                     "Student Submission:\n{submission_text}\n\n"
-                     "Conversation Summary:\n{conversation_summary}\n\n"
-                     "Evaluate how well the student's work achieves each of the following learning objectives. "
-                     "For each objective, provide:\n"
-                     "- A score (0-100, where 100 is excellent)\n" 
-                     "- Specific examples from the work or conversation\n"
-                     "- Constructive feedback",
+                     "Reference Document:\n{document}\n\n"
+                     "Write a digest of the reference document in at most {max_words} words, with three sections:\n"
+                     "## Key points - the concepts and facts a good submission should cover\n"
+                     "## Expected answers - what correct answers to the assignment look like\n"
+                     "## Rubric hints - what distinguishes excellent, adequate and weak work\n"
+                     "Only include what is useful to ask about and grade this assignment.",
                      
             "Español": "Instrucciones de la tarea:\n{assignment_text}\n\n"
                       "Objetivos de aprendizaje:\n{learning_objectives}\n\n"
-                      "Entrega del estudiante:\n{submission_text}\n\n"
-                      "Resumen de la conversación:\n{conversation_summary}\n\n"
-                      "Conversación completa:\n{conversation_details}\n\n"
-                      "Evalúa qué tan bien el trabajo del estudiante logra cada uno de los siguientes objetivos de aprendizaje. "
-                      "Para cada objetivo, proporciona:\n"
-                      "- Una puntuación (0-100, donde 100 es excelente)\n"
-                      "- Ejemplos específicos del trabajo o la conversación\n"
-                      "- Retroalimentación constructiva"
-        }
-        
-        self.prompt_part3_templates = {
-            "English": "Assignment Instructions:\n{assignment_text}\n\n"
-                     "Student Submission:\n{submission_text}\n\n"
-                     "Evaluate the overall quality of the student's work, considering clarity, organization, and depth of thought.\n"
-                     "Provide:\n"
-                     "- A score (0-100, where 100 is excellent)\n"
-                     "- Specific examples from the work\n"
-                     "- Constructive feedback",
-                     
-            "Español": "Instrucciones de la tarea:\n{assignment_text}\n\n"
-                      "Entrega del estudiante:\n{submission_text}\n\n"
-                      "Conversación completa:\n{conversation_details}\n\n"
-                      "Evalúa la calidad general del trabajo del estudiante, considerando claridad, organización y profundidad de pensamiento.\n"
-                      "Proporciona:\n"
-                      "- Una puntuación global (0-100, donde 100 es excelente)\n"
-                      "- Ejemplos específicos del trabajo\n"
-                      "- Retroalimentación constructiva\n\n"
-                      "Realiza también un análisis final sobre la originalidad del trabajo y la coherencia entre la entrega escrita y las respuestas durante la conversación."
+                      "Documento de referencia:\n{document}\n\n"
+                      "Escribe un resumen del documento de referencia de como máximo {max_words} palabras, con tres secciones:\n"
+                      "## Puntos clave - los conceptos y datos que una buena entrega debe cubrir\n"
+                      "## Respuestas esperadas - cómo son las respuestas correctas a la tarea\n"
+                      "## Pautas de evaluación - qué distingue un trabajo excelente, adecuado y débil\n"
+                      "Incluye solo lo útil para preguntar sobre esta tarea y evaluarla."
         }
         
-        self.section_headers = {
-            "English": {
-                "comprehension": "# Comprehension and Authenticity Evaluation",
-                "objectives": "# Learning Objectives Evaluation",
-                "overall": "# Overall Quality Evaluation"
-            },
-            "Español": {
-                "comprehension": "# Evaluación de comprensión, autenticidad y habilidades",
-                "objectives": "# Evaluación de objetivos de aprendizaje",
-                "overall": "# Evaluación de calidad general y análisis de originalidad"
-            }
-        }
+    def digest(self, document_text, assignment_text, learning_objectives, language="English"):
+        """Digest of the document, bounded to REFERENCE_DIGEST_MAX_TOKENS"""
+        prompt = ChatPromptTemplate.from_messages([
+            SystemMessagePromptTemplate.from_template(self.system_prompts.get(language, self.system_prompts["English"])),
+            HumanMessagePromptTemplate.from_template(self.prompt_templates.get(language, self.prompt_templates["English"]))
+        ])
         
-    def evaluate_submission(self, assignment_text, assignment_file_path, submission_text, 
-                          learning_objectives, conversation_data):
-        """Evaluate the student's submission against learning objectives"""
-        # Get the language from conversation data
-        language = conversation_data.get("language", "Español")
+        document = normalize_text(strip_page_furniture(document_text)[0])["text"]
+        if len(document) > REFERENCE_DOCUMENT_MAX_CHARS:
+            document = document[:REFERENCE_DOCUMENT_MAX_CHARS] + "... [truncated]"
         
-        # Truncate long inputs to avoid context length issues
-        max_chars = 3000  # Approximate limit to avoid exceeding token limits
+        digest = run_llm_stage(
+            self.llm, "assignment.digest", prompt, metrics=self.stage_metrics,
+            assignment_text=assignment_text,
+            learning_objectives="\n".join([f"- {obj}" for obj in learning_objectives]),
+            document=document,
+            # Roughly 0.75 words per token
+            max_words=int(REFERENCE_DIGEST_MAX_TOKENS * 0.75)
+        ).strip()
         
-        if len(assignment_text) > max_chars:
-            assignment_text = assignment_text[:max_chars] + "... [truncated]"
-            
-        if len(submission_text) > max_chars:
-            submission_text = submission_text[:max_chars] + "... [truncated]"
-        
-        # Calculate response times if available in conversation_data
-        response_times_text = "No disponible"
-        if "timestamps" in conversation_data:
-            response_times = []
-            for i, timestamp in enumerate(conversation_data["timestamps"]):
-                if i > 0:
-                    prev_time = datetime.fromisoformat(conversation_data["timestamps"][i-1])
-                    curr_time = datetime.fromisoformat(timestamp)
-                    response_time = (curr_time - prev_time).total_seconds()
-                    question = conversation_data["conversation_history"][i-1]["question"]
-                    response = conversation_data["conversation_history"][i-1]["response"]
-                    response_times.append({
-                        "question": question[:50] + "..." if len(question) > 50 else question,
-                        "response_length": len(response),
-                        "time_seconds": response_time
-                    })
+        # The model's word limit is approximate; the token bound is not
+        while count_tokens(digest) > REFERENCE_DIGEST_MAX_TOKENS:
+            digest = digest[:int(len(digest) * 0.9)].rsplit("\n", 1)[0]
+        return digest
+
+class QuestionGeneratorAgent:
+    """Agent responsible for generating questions based on the assignment and learning objectives"""
+    
+    def __init__(self, llm, metrics=None):
+        self.llm = llm
+        self.stage_metrics = metrics if metrics is not None else []
+        self.system_prompts = {
+            "English": """You are an expert educational assessment agent. 
+            Your task is to generate thoughtful questions based on assignment instructions and learning objectives.
+            The questions should help evaluate the student's understanding and achievement of learning objectives.
+            Generate questions that are clear, specific, and directly related to the learning objectives.""",
             
-            if response_times:
-                response_times_text = "\n".join([
-                    f"Pregunta {i+1}: {rt['time_seconds']:.1f} segundos para {rt['response_length']} caracteres" 
-                    for i, rt in enumerate(response_times)
-                ])
+            "Español": """Eres un agente experto en evaluación educativa.
+            Tu tarea es generar preguntas reflexivas basadas en las instrucciones de la tarea y los objetivos de aprendizaje.
+            Las preguntas deben ayudar a evaluar la comprensión del estudiante y el logro de los objetivos de aprendizaje.
+            Genera preguntas claras, específicas y directamente relacionadas con los objetivos de aprendizaje."""
+        }
         
-        # We'll do the evaluation in steps to avoid context length issues
-        system_prompt = self.system_prompts.get(language, self.system_prompts["Español"])
+    def generate_questions(self, assignment_text, learning_objectives, num_questions=5, language="English",
+                           reference_digest=None):
+        """Generate questions based on assignment, learning objectives and the reference digest"""
         
-        # Extract conversation details
-        conversation_details = "\n\n".join([
-            f"Pregunta: {item['question']}\nRespuesta: {item['response']}" 
-            for item in conversation_data["conversation_history"]
-        ])
+        system_prompt = self.system_prompts.get(language, self.system_prompts["English"])
         
-        # Step 1: Evaluate comprehension, authenticity and other skills
-        prompt_part1 = ChatPromptTemplate.from_messages([
+        prompt_templates = {
+            "English": "Assignment Instructions:\n{assignment_text}\n\n"
+                      "Learning Objectives:\n{learning_objectives}\n\n"
+                      "Reference Material (digest of the teacher's document):\n{reference_digest}\n\n"
+                      "Generate {num_questions} questions that will help assess if a student has met these learning objectives.",
+                      
+            "Español": "Instrucciones de la tarea:\n{assignment_text}\n\n"
+                      "Objetivos de aprendizaje:\n{learning_objectives}\n\n"
+                      "Material de referencia (resumen del documento del profesor):\n{reference_digest}\n\n"
+                      "Genera {num_questions} preguntas que ayuden a evaluar si un estudiante ha alcanzado estos objetivos de aprendizaje."
+        }
+        
+        prompt_template = prompt_templates.get(language, prompt_templates["English"])
+        
+        prompt = ChatPromptTemplate.from_messages([
             SystemMessagePromptTemplate.from_template(system_prompt),
-            HumanMessagePromptTemplate.from_template(
-                self.prompt_part1_templates.get(language, self.prompt_part1_templates["Español"])
-            )
+            HumanMessagePromptTemplate.from_template(prompt_template)
         ])
         
-        chain_part1 = LLMChain(llm=self.llm, prompt=prompt_part1)
         try:
-            evaluation_part1 = chain_part1.run(
+            response = run_llm_stage(
+                self.llm, "questions.generate", prompt, metrics=self.stage_metrics,
                 assignment_text=assignment_text,
-                submission_text=submission_text,
-                conversation_summary=conversation_data["summary"],
-                response_times=response_times_text
+                learning_objectives="\n".join([f"- {obj}" for obj in learning_objectives]),
+                reference_digest=reference_digest_text(reference_digest, language),
+                num_questions=num_questions
             )
         except Exception as e:
-            logging.error(f"Error en evaluación parte 1: {e}")
-            evaluation_part1 = "Error en evaluación de comprensión y autenticidad."
-
+            # Loggear el error y devolver una lista vacía
+            logging.error(f"Error generando preguntas: {e}")
+            response = ""
         
-        # Step 2: Evaluate learning objectives
-        learning_obj_text = "\n".join([f"- {obj}" for obj in learning_objectives])
+        # Parse the questions from the response
+        questions = []
+        for line in response.split("\n"):
+            line = line.strip()
+            if line and (line.startswith("- ") or line.startswith("Q") or line[0].isdigit() and line[1] in [".", ")"]):
+                # Clean up the question format
+                question = line
+                if line.startswith("- "):
+                    question = line[2:]
+                elif line[0].isdigit() and line[1] in [".", ")"]:
+                    question = line[2:].strip()
+                elif line.startswith("Q") and ":" in line:
+                    question = line.split(":", 1)[1].strip()
+                
+                questions.append(question)
+        
+        return questions[:num_questions]  # Ensure we only return the requested number
+
+class ConversationAgent:
+    """Agent that converses with the student, asking questions and recording responses"""
+    
+    def __init__(self, llm, metrics=None, deadline=None):
+        self.llm = llm
+        self.stage_metrics = metrics if metrics is not None else []
+        self.deadline = deadline
+        self.memory = ConversationBufferMemory(return_messages=True)
+        self.system_prompts = {
+            "English": """You are a friendly educational assistant conducting an assessment conversation.
+            Ask questions in a supportive and encouraging manner. Listen carefully to student responses.
+            Your goal is to understand the student's comprehension and thought process, not to judge or evaluate at this stage.""",
+            
+            "Español": """Eres un asistente educativo amigable que realiza una conversación de evaluación.
+            Haz preguntas de manera solidaria y alentadora. Escucha atentamente las respuestas de los estudiantes.
+            Tu objetivo es comprender la comprensión y el proceso de pensamiento del estudiante, no juzgar o evaluar en esta etapa."""
+        }
+        
+        self.intro_messages = {
+            "English": "I'd like to ask you a few questions about your assignment to understand your thought process better.",
+            "Español": "Me gustaría hacerte algunas preguntas sobre tu tarea para entender mejor tu proceso de pensamiento."
+        }
+        
+        self.response_acknowledgments = {
+            "English": "Thank you for your response.",
+            "Español": "Gracias por tu respuesta."
+        }
+        
+        self.completion_messages = {
+            "English": "Thank you for answering all the questions. I'll now analyze your responses.",
+            "Español": "Gracias por responder todas las preguntas. Ahora analizaré tus respuestas."
+        }
+        
+    def start_conversation(self, questions, language="English"):
+        """Initialize the conversation with the student"""
+        self.questions = questions
+        self.current_question_idx = 0
+        self.conversation_history = []
+        self.student_responses = {}
+        self.language = language
+        self.timestamps = []  # Add timestamps to track response times
+        self.timestamps.append(datetime.now().isoformat())  # Initial timestamp
+        
+        return {
+            "message": self.intro_messages.get(language, self.intro_messages["English"]),
+            "question": questions[0],
+            "done": False
+        }
+    
+    def continue_conversation(self, student_response):
+        """Process student response and continue conversation"""
+        # Record timestamp for this response
+        self.timestamps.append(datetime.now().isoformat())
+        
+        # Record response
+        current_question = self.questions[self.current_question_idx]
+        self.student_responses[current_question] = student_response
+        
+        # Update conversation history
+        self.conversation_history.append({"question": current_question, "response": student_response})
+        
+        # Move to next question or finish
+        self.current_question_idx += 1
+        if self.current_question_idx < len(self.questions):
+            next_question = self.questions[self.current_question_idx]
+            return {
+                "message": self.response_acknowledgments.get(self.language, self.response_acknowledgments["English"]),
+                "question": next_question,
+                "done": False
+            }
+        else:
+            return {
+                "message": self.completion_messages.get(self.language, self.completion_messages["English"]),
+                "question": None,
+                "done": True
+            }
+    
+    def update_summary(self, previous_summary, question, response, language="English"):
+        """Fold a single question and response into the rolling conversation summary"""
+        system_prompt_templates = {
+            "English": "You are an educational assessment expert. You keep a running summary of a student's responses to questions.",
+            "Español": "Eres un experto en evaluación educativa. Mantienes un resumen continuo de las respuestas del estudiante a las preguntas."
+        }
+        
+        human_prompt_templates = {
+            "English": "Summary of the conversation so far:\n{summary}\n\n"
+                    "New question and student response:\nQuestion: {question}\nResponse: {response}\n\n"
+                    "Update the summary so it also covers the key points of this response. Keep it concise.",
+            "Español": "Resumen de la conversación hasta ahora:\n{summary}\n\n"
+                     "Nueva pregunta y respuesta del estudiante:\nPregunta: {question}\nRespuesta: {response}\n\n"
+                     "Actualiza el resumen para que incluya también los puntos clave de esta respuesta. Mantenlo conciso."
+        }
+        
+        empty_summaries = {
+            "English": "(no responses yet)",
+            "Español": "(aún no hay respuestas)"
+        }
+        
+        system_prompt = system_prompt_templates.get(language, system_prompt_templates["English"])
+        human_prompt = human_prompt_templates.get(language, human_prompt_templates["English"])
         
-        prompt_part2 = ChatPromptTemplate.from_messages([
+        prompt = ChatPromptTemplate.from_messages([
             SystemMessagePromptTemplate.from_template(system_prompt),
-            HumanMessagePromptTemplate.from_template(
-                self.prompt_part2_templates.get(language, self.prompt_part2_templates["Español"])
-            )
+            HumanMessagePromptTemplate.from_template(human_prompt)
+        ])
+        
+        return run_llm_stage(
+            self.llm, "conversation.summary_update", prompt, metrics=self.stage_metrics,
+            summary=previous_summary or empty_summaries.get(language, empty_summaries["English"]),
+            question=question,
+            response=normalize_whitespace(response)
+        )
+    
+    def get_conversation_summary(self, language="English", rolling_summary=None):
+        """Generate a summary of the conversation.
+        
+        If a rolling summary that already covers every response is given, it is
+        used as is and no LLM call is made.
+        """
+        if rolling_summary is not None:
+            return {
+                "conversation_history": self.conversation_history,
+                "summary": rolling_summary,
+                "responses": self.student_responses,
+                "language": language,
+                "timestamps": self.timestamps
+            }
+        
+        system_prompt_templates = {
+            "English": "You are an educational assessment expert. Summarize the following student responses to questions.",
+            "Español": "Eres un experto en evaluación educativa. Resume las siguientes respuestas del estudiante a las preguntas."
+        }
+        
+        human_prompt_templates = {
+            "English": "Here are the questions and student responses:\n{conversation}\n\n"
+                    "Provide a concise summary of the conversation highlighting key points from the student's responses.",
+            "Español": "Aquí están las preguntas y las respuestas del estudiante:\n{conversation}\n\n"
+                     "Proporciona un resumen conciso de la conversación destacando los puntos clave de las respuestas del estudiante."
+        }
+        
+        system_prompt = system_prompt_templates.get(language, system_prompt_templates["English"])
+        human_prompt = human_prompt_templates.get(language, human_prompt_templates["English"])
+        
+        prompt = ChatPromptTemplate.from_messages([
+            SystemMessagePromptTemplate.from_template(system_prompt),
+            HumanMessagePromptTemplate.from_template(human_prompt)
+        ])
+        
+        conversation_text = "\n\n".join([
+            f"Question: {item['question']}\nResponse: {normalize_whitespace(item['response'])}" 
+            for item in self.conversation_history
         ])
         
-        chain_part2 = LLMChain(llm=self.llm, prompt=prompt_part2)
-        evaluation_part2 = chain_part2.run(
-            assignment_text=assignment_text,
-            learning_objectives=learning_obj_text,
-            submission_text=submission_text,
-            conversation_summary=conversation_data["summary"],
-            conversation_details=conversation_details
-        )
+        try:
+            summary = run_llm_stage(
+                self.llm, "conversation.summary", prompt, metrics=self.stage_metrics,
+                deadline=self.deadline, conversation=conversation_text
+            )
+        except BatchPending:
+            raise
+        except Exception as e:
+            logging.error(f"Error generando resumen de conversación: {e}")
+            summary = "No se pudo generar el resumen de la conversación."
+        
+        return {
+            "conversation_history": self.conversation_history,
+            "summary": summary,
+            "responses": self.student_responses,
+            "language": language,
+            "timestamps": self.timestamps  # Include timestamps for response time analysis
+        }
+
+class EvaluationAgent:
+    """Agent that evaluates the student's work and conversation responses"""
+    
+    def __init__(self, llm, metrics=None, deadline=None):
+        self.llm = llm
+        self.stage_metrics = metrics if metrics is not None else []
+        # time.monotonic() by which every stage must be done (the evaluation budget)
+        self.deadline = deadline
+        self.system_prompts = SUBMISSION_SYSTEM_PROMPTS
+        
+        # Targeted re-request for the structured fields that could not be repaired locally
+        self.structuring_repair_templates = {
+            "English": "You now act as an assistant that structures evaluation data.\n\n"
+                     "Evaluation:\n{evaluation}\n\n"
+                     "Respond only with a JSON object with these keys:\n{field_schema}",
+            "Español": "Ahora actúas como un asistente que estructura datos de evaluación.\n\n"
+                      "Evaluación:\n{evaluation}\n\n"
+                      "Responde solo con un objeto JSON con estas claves:\n{field_schema}"
+        }
+        
+        # Stage-specific suffixes, appended to SUBMISSION_PREFIX_TEMPLATES
+        self.prompt_part1_templates = {
+            "English": "Conversation Summary:\n{conversation_summary}\n\n"
+                     "Evaluate the student's work on the following criteria:\n"
+                     "1. Comprehension - How well does the student understand the core concepts?\n"
+                     "2. Authenticity - Is the work original and does it show the student's own thinking?\n\n"
+                     "For each criterion, provide:\n"
+                     "- A score (0-100, where 100 is excellent)\n"
+                     "- Specific examples from the work or conversation\n"
+                     "- Constructive feedback",
+                     
+            "Español": "Resumen de la conversación:\n{conversation_summary}\n\n"
+                      "Tiempos de respuesta: {response_times}\n\n"
+                      "Evalúa el trabajo del estudiante según los siguientes criterios:\n"
+                      "1. Comprensión (0-100) - ¿Qué tan bien comprende el estudiante los conceptos centrales?\n"
+                      "2. Autenticidad (0-100) - ¿Es el trabajo original y muestra el propio pensamiento del estudiante? Detecta si hay contenido copiado o plagiado.\n"
+                      "3. Habilidades relacionales (0-100) - ¿Cómo conecta el estudiante diferentes conceptos e ideas?\n"
+                      "4. Argumentación (0-100) - ¿Qué tan bien estructurados y fundamentados están sus argumentos?\n"
+                      "5. Uso de bibliografía (0-100) - ¿Cita o hace referencia a bibliografía adecuada?\n\n"
+                      "Para cada criterio, proporciona:\n"
+                      "- Una puntuación (0-100, donde 100 es excelente)\n"
+                      "- Ejemplos específicos del trabajo o la conversación\n"
+                      "- Retroalimentación constructiva\n\n"
+                      "Analiza también:\n"
+                      "- Consistencia entre el trabajo escrito y las respuestas en la conversación\n"
+                      "- Si los tiempos de respuesta son coherentes con la cantidad de contenido (respuestas muy elaboradas en tiempos muy cortos podrían indicar uso de contenido pregenerado)\n"
+                      "- Indica claramente si detectas copypaste o plagio, proporcionando evidencia"
+        }
+        
+        self.prompt_part2_templates = {
+            "English": "Conversation Summary:\n{conversation_summary}\n\n"
+                     "Evaluate how well the student's work achieves each of the learning objectives listed above. "
+                     "For each objective, provide:\n"
+                     "- A score (0-100, where 100 is excellent)\n" 
+                     "- Specific examples from the work or conversation\n"
+                     "- Constructive feedback",
+                     
+            "Español": "Resumen de la conversación:\n{conversation_summary}\n\n"
+                      "Conversación completa:\n{conversation_details}\n\n"
+                      "Evalúa qué tan bien el trabajo del estudiante logra cada uno de los objetivos de aprendizaje indicados arriba. "
+                      "Para cada objetivo, proporciona:\n"
+                      "- Una puntuación (0-100, donde 100 es excelente)\n"
+                      "- Ejemplos específicos del trabajo o la conversación\n"
+                      "- Retroalimentación constructiva"
+        }
+        
+        self.prompt_part3_templates = {
+            "English": "Evaluate the overall quality of the student's work, considering clarity, organization, and depth of thought.\n"
+                     "Provide:\n"
+                     "- A score (0-100, where 100 is excellent)\n"
+                     "- Specific examples from the work\n"
+                     "- Constructive feedback",
+                     
+            # Only the written work, like the English prompt, so it can run before the conversation ends;
+            # coherence with the conversation is analyzed in the comprehension stage
+            "Español": "Evalúa la calidad general del trabajo del estudiante, considerando claridad, organización y profundidad de pensamiento.\n"
+                      "Proporciona:\n"
+                      "- Una puntuación global (0-100, donde 100 es excelente)\n"
+                      "- Ejemplos específicos del trabajo\n"
+                      "- Retroalimentación constructiva\n\n"
+                      "Realiza también un análisis final sobre la originalidad del trabajo escrito."
+        }
+        
+        # Fan-out mode: one small call per learning objective instead of prompt_part2_templates
+        self.objective_templates = {
+            "English": "Conversation Summary:\n{conversation_summary}\n\n"
+                     "Evaluate only this learning objective: {objective}\n\n"
+                     "Respond only with a JSON object with the keys:\n"
+                     "- score: (number 0-100, where 100 is excellent)\n"
+                     "- examples: (specific examples from the work or conversation)\n"
+                     "- feedback: (constructive feedback)",
+                     
+            "Español": "Resumen de la conversación:\n{conversation_summary}\n\n"
+                      "Evalúa únicamente este objetivo de aprendizaje: {objective}\n\n"
+                      "Responde solo con un objeto JSON con las claves:\n"
+                      "- score: (número 0-100, donde 100 es excelente)\n"
+                      "- examples: (ejemplos específicos del trabajo o la conversación)\n"
+                      "- feedback: (retroalimentación constructiva)"
+        }
+        
+        self.max_objective_workers = 8
+        
+        # The learning objectives are in the shared prefix of every stage (for prompt caching),
+        # but these stages don't grade them, so editing the objectives keeps their memoized outputs
+        self.memo_ignored_inputs = {
+            "comprehension": {"learning_objectives"},
+            "overall": {"learning_objectives"},
+            "objective": {"learning_objectives"}
+        }
+        # Memo of this run ({stage: {key, output}}) and the stages it had to (re)compute
+        self.memo = {}
+        self.recomputed_stages = []
+        
+        self.section_headers = {
+            "English": {
+                "comprehension": "# Comprehension and Authenticity Evaluation",
+                "objectives": "# Learning Objectives Evaluation",
+                "overall": "# Overall Quality Evaluation"
+            },
+            "Español": {
+                "comprehension": "# Evaluación de comprensión, autenticidad y habilidades",
+                "objectives": "# Evaluación de objetivos de aprendizaje",
+                "overall": "# Evaluación de calidad general y análisis de originalidad"
+            }
+        }
+        
+        # Evaluation stages, keyed like the section headers, in report order
+        self.stage_templates = {
+            "comprehension": self.prompt_part1_templates,
+            "objectives": self.prompt_part2_templates,
+            "overall": self.prompt_part3_templates
+        }
+        
+        # Prompt inputs that are known as soon as the student submits, before any conversation
+        self.submission_inputs = {"assignment_text", "submission_text", "learning_objectives", "reference_digest"}
+        
+        # Approximate limit to avoid exceeding token limits
+        self.max_chars = PROMPT_TEXT_MAX_CHARS
+        
+    def _truncate(self, text):
+        """Truncate long inputs to avoid context length issues"""
+        if len(text) > self.max_chars:
+            return text[:self.max_chars] + "... [truncated]"
+        return text
+        
+    def _build_stage_prompt(self, stage, language):
+        """Build the prompt for one evaluation stage in the given language"""
+        templates = self.stage_templates[stage]
+        return build_submission_prompt(templates.get(language, templates["Español"]), language)
+        
+    def run_stage(self, stage, language, **inputs):
+        """Run a single evaluation stage, passing only the inputs its prompt uses"""
+        prompt = self._build_stage_prompt(stage, language)
+        return run_llm_stage(
+            self.llm, f"evaluation.{stage}", prompt, metrics=self.stage_metrics, deadline=self.deadline, **inputs
+        )
+        
+    def get_submission_only_stages(self, language):
+        """Stages whose prompt depends only on the assignment and the written submission"""
+        return [
+            stage for stage in self.stage_templates
+            if set(self._build_stage_prompt(stage, language).input_variables) <= self.submission_inputs
+        ]
+        
+    def get_stages_using(self, input_name, language):
+        """Stages whose prompt takes the given input"""
+        return [
+            stage for stage in self.stage_templates
+            if input_name in self._build_stage_prompt(stage, language).input_variables
+        ]
+        
+    def evaluate_submission_only_stages(self, assignment_text, submission_text, learning_objectives, language,
+                                        reference_digest=None, cancelled=None, on_stage_complete=None):
+        """Run the stages that do not need the conversation, e.g. while the student is still answering.
+        
+        Stops before the next stage once the cancelled event (a threading.Event) is set.
+        on_stage_complete(stage, output) is called as each stage finishes, so the
+        stages done so far can be used without waiting for the rest.
+        """
+        inputs = {
+            "assignment_text": self._truncate(assignment_text),
+            "submission_text": self._truncate(submission_text),
+            "learning_objectives": "\n".join([f"- {obj}" for obj in learning_objectives]),
+            "reference_digest": reference_digest_text(reference_digest, language)
+        }
+        
+        results = {}
+        for stage in self.get_submission_only_stages(language):
+            if cancelled is not None and cancelled.is_set():
+                break
+            try:
+                results[stage] = self.run_stage(stage, language, **inputs)
+            except Exception as e:
+                # The stage will simply be run again once the conversation is over
+                logging.error(f"Error en evaluación anticipada ({stage}): {e}")
+                continue
+            if on_stage_complete is not None:
+                on_stage_complete(stage, results[stage])
+        return results
+        
+    def _build_objective_prompt(self, language):
+        templates = self.objective_templates
+        return build_submission_prompt(templates.get(language, templates["Español"]), language)
+        
+    def evaluate_objective(self, objective, language, **inputs):
+        """Score a single learning objective; returns {objective, score, examples, feedback}"""
+        prompt = self._build_objective_prompt(language)
+        
+        response = run_llm_stage(
+            self.llm, "evaluation.objective", prompt, metrics=self.stage_metrics,
+            deadline=self.deadline, objective=objective, **inputs
+        )
+        
+        result = repair_json(response)
+        if result is None:
+            result = {"feedback": response}
+        score = _coerce_score(result.get("score"))
+        
+        return {
+            "objective": objective,
+            "score": 50 if score is None else score,
+            "examples": result.get("examples", "No disponible"),
+            "feedback": result.get("feedback", "No disponible")
+        }
+        
+    def evaluate_objectives_concurrently(self, objectives, language, stage_memo=None, dry_run=False, **inputs):
+        """Evaluate every learning objective in its own call, all at once, in objective order.
+        
+        Objectives whose result in stage_memo (under "objective:<objective>") is still
+        valid are reused; with dry_run the others are only listed in recomputed_stages.
+        Returns (results, failed_objectives); failed objectives get a placeholder result.
+        """
+        if not objectives:
+            return [], []
+        stage_memo = stage_memo or {}
+        prompt = self._build_objective_prompt(language)
+        placeholder = {"score": 50, "examples": "No disponible", "feedback": "No disponible"}
+        results, pending = {}, []
+        for objective in objectives:
+            name = f"objective:{objective}"
+            key = stage_memo_key(
+                self.llm, "evaluation.objective", prompt, {**inputs, "objective": objective},
+                self.memo_ignored_inputs["objective"]
+            )
+            if stage_memo.get(name, {}).get("key") == key:
+                results[objective] = stage_memo[name]["output"]
+                self.memo[name] = stage_memo[name]
+            else:
+                self.recomputed_stages.append(name)
+                pending.append((objective, key))
+        
+        failed, queued = [], False
+        if dry_run:
+            results.update({objective: {"objective": objective, **placeholder} for objective, _ in pending})
+            pending = []
+        if pending:
+            # A pool of its own: this usually runs on a background executor thread already
+            workers = min(len(pending), self.max_objective_workers)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(self.evaluate_objective, objective, language, **inputs)
+                    for objective, _ in pending
+                ]
+                for (objective, key), future in zip(pending, futures):
+                    try:
+                        results[objective] = future.result()
+                        self.memo[f"objective:{objective}"] = {"key": key, "output": results[objective]}
+                    except BatchPending:
+                        queued = True
+                    except Exception as e:
+                        logging.error(f"Error evaluando el objetivo '{objective}': {e}")
+                        failed.append(objective)
+                        results[objective] = {"objective": objective, **placeholder}
+        if queued:
+            # Every objective's request is queued before stopping
+            raise BatchPending("objective")
+        return [results[objective] for objective in objectives], failed
+        
+    def evaluate_submission(self, assignment_text, assignment_file_path, submission_text, 
+                          learning_objectives, conversation_data, precomputed_stages=None,
+                          objective_fanout=False, response_time_baseline=None, on_stage_complete=None,
+                          reference_digest=None, stage_memo=None, dry_run=False):
+        """Evaluate the student's submission against learning objectives.
+        
+        precomputed_stages maps stage names to outputs already produced by
+        evaluate_submission_only_stages (or by an earlier, interrupted run);
+        those stages are not run again. on_stage_complete(stage, output) is
+        called as each stage finishes, so its output can be persisted.
+        A stage that fails or misses its deadline is replaced by a placeholder and
+        listed in structured_evaluation["missing_stages"], with "partial" set.
+        With objective_fanout, each learning objective is scored by its own
+        concurrent call and the results replace the structured learning_objectives.
+        With a batch router, BatchPending is raised once every stage that can
+        run next has been queued.
+        response_time_baseline is the assignment's typing-speed history
+        (see analyze_response_times). reference_digest is the assignment's
+        reference document digest (see ReferenceDigestAgent), if it has one.
+        stage_memo is the memo of an earlier evaluation of the same submission
+        (evaluation_data["stage_memo"]): stages whose prompt, model and inputs
+        are unchanged reuse its outputs. With dry_run no stage is run; the ones
+        that would be are listed in recomputed_stages.
+        """
+        precomputed_stages = precomputed_stages or {}
+        stage_memo = stage_memo or {}
+        
+        # Get the language from conversation data
+        language = conversation_data.get("language", "Español")
+        
+        assignment_text = self._truncate(assignment_text)
+        submission_text = self._truncate(submission_text)
+        
+        # Response times are analyzed locally; the prompts only get the one-line verdict
+        response_time_analysis = analyze_response_times(conversation_data, response_time_baseline, language)
+        
+        # We'll do the evaluation in steps to avoid context length issues
+        
+        # Extract conversation details
+        conversation_details = "\n\n".join([
+            f"Pregunta: {item['question']}\nRespuesta: {normalize_whitespace(item['response'])}" 
+            for item in conversation_data["conversation_history"]
+        ])
+        
+        stage_inputs = {
+            "assignment_text": assignment_text,
+            "submission_text": submission_text,
+            "learning_objectives": "\n".join([f"- {obj}" for obj in learning_objectives]),
+            "reference_digest": reference_digest_text(reference_digest, language),
+            "conversation_summary": conversation_data["summary"],
+            "conversation_details": conversation_details,
+            "response_times": response_time_analysis["verdict"]
+        }
+        
+        missing_stages = []
+        # Stages queued in a batch; the independent stages of a wave are all queued before stopping
+        queued_stages = []
+        
+        def run_or_reuse(stage, placeholder):
+            key = stage_memo_key(
+                self.llm, f"evaluation.{stage}", self._build_stage_prompt(stage, language), stage_inputs,
+                self.memo_ignored_inputs.get(stage, ())
+            )
+            if stage in precomputed_stages:
+                output = precomputed_stages[stage]
+            elif stage_memo.get(stage, {}).get("key") == key:
+                output = stage_memo[stage]["output"]
+            else:
+                self.recomputed_stages.append(stage)
+                if dry_run:
+                    return placeholder
+                try:
+                    output = self.run_stage(stage, language, **stage_inputs)
+                except BatchPending:
+                    queued_stages.append(stage)
+                    return placeholder
+                except Exception as e:
+                    logging.error(f"Error en la etapa de evaluación {stage}: {e}")
+                    missing_stages.append(stage)
+                    return placeholder
+                if on_stage_complete is not None:
+                    on_stage_complete(stage, output)
+            self.memo[stage] = {"key": key, "output": output}
+            return output
+        
+        # Step 1: Evaluate comprehension, authenticity and other skills
+        evaluation_part1 = run_or_reuse("comprehension", "Error en evaluación de comprensión y autenticidad.")
+        
+        # Step 2: Evaluate learning objectives
+        objective_results = None
+        if objective_fanout:
+            try:
+                objective_results, failed_objectives = self.evaluate_objectives_concurrently(
+                    learning_objectives, language, stage_memo=stage_memo, dry_run=dry_run, **stage_inputs
+                )
+            except BatchPending:
+                queued_stages.append("objective")
+                objective_results, failed_objectives = [], []
+            missing_stages.extend(f"objective: {objective}" for objective in failed_objectives)
+            evaluation_part2 = "\n\n".join([
+                f"## {result['objective']}\n{result['score']}/100\n\n{result['examples']}\n\n{result['feedback']}"
+                for result in objective_results
+            ])
+        else:
+            evaluation_part2 = run_or_reuse("objectives", "Error en evaluación de objetivos de aprendizaje.")
+        
+        # Step 3: Evaluate overall quality
+        evaluation_part3 = run_or_reuse("overall", "Error en evaluación de calidad general.")
+        
+        if queued_stages:
+            raise BatchPending(", ".join(queued_stages))
+        
+        # Get section headers based on language
+        headers = self.section_headers.get(language, self.section_headers["Español"])
+        
+        # Combine all evaluations
+        evaluation = (
+            f"{headers['comprehension']}\n" + evaluation_part1 + 
+            f"\n\n{headers['objectives']}\n" + evaluation_part2 +
+            f"\n\n{headers['overall']}\n" + evaluation_part3
+        )
+        
+        
+        
+        # Generate a structured evaluation result
+        prompt_structured_templates = {
+            "English": "You now act as an assistant that structures evaluation data. "
+                     "Convert the following evaluation into a structured JSON format with the exact keys expected.\n\n"
+                     "Evaluation:\n{evaluation}\n\n"
+                     "Convert this into a JSON structure with the following keys:\n"
+                     "- comprehension: {{score: (number 0-100), examples: (text with examples), feedback: (constructive feedback)}}\n"
+                     "- authenticity: {{score: (number 0-100), examples: (text with examples), feedback: (constructive feedback)}}\n"
+                     "- relational_skills: {{score: (number 0-100), examples: (text with examples), feedback: (constructive feedback)}}\n"
+                     "- argumentation: {{score: (number 0-100), examples: (text with examples), feedback: (constructive feedback)}}\n"
+                     "- bibliography_use: {{score: (number 0-100), examples: (text with examples), feedback: (constructive feedback)}}\n"
+                     "- learning_objectives: [{{objective: (text of objective), score: (number 0-100), examples: (text with examples), feedback: (constructive feedback)}}]\n"
+                     "- overall_quality: {{score: (number 0-100), examples: (text with examples), feedback: (constructive feedback)}}\n"
+                     "- plagiarism_detected: (boolean true/false)\n"
+                     "- plagiarism_evidence: (text explaining evidence of plagiarism if detected)\n"
+                     "- summary: (A brief summary of the evaluation)",
+                     
+            "Español": "Ahora actúas como un asistente que estructura datos de evaluación. "
+                      "Convierte la siguiente evaluación en un formato JSON estructurado con las claves exactas esperadas.\n\n"
+                      "Evaluación:\n{evaluation}\n\n"
+                      "Convierte esto en una estructura JSON con las siguientes claves:\n"
+                      "- comprehension: {{score: (número 0-100), examples: (texto con ejemplos), feedback: (retroalimentación constructiva)}}\n"
+                      "- authenticity: {{score: (número 0-100), examples: (texto con ejemplos), feedback: (retroalimentación constructiva)}}\n"
+                      "- relational_skills: {{score: (número 0-100), examples: (texto con ejemplos), feedback: (retroalimentación constructiva)}}\n"
+                      "- argumentation: {{score: (número 0-100), examples: (texto con ejemplos), feedback: (retroalimentación constructiva)}}\n"
+                      "- bibliography_use: {{score: (número 0-100), examples: (texto con ejemplos), feedback: (retroalimentación constructiva)}}\n"
+                      "- learning_objectives: [{{objective: (texto del objetivo), score: (número 0-100), examples: (texto con ejemplos), feedback: (retroalimentación constructiva)}}]\n"
+                      "- overall_quality: {{score: (número 0-100), examples: (texto con ejemplos), feedback: (retroalimentación constructiva)}}\n"
+                      "- plagiarism_detected: (booleano true/false)\n"
+                      "- plagiarism_evidence: (texto explicando evidencia de plagio si se detectó)\n"
+                      "- summary: (Un breve resumen de la evaluación)"
+        }
+        
+        prompt_structured_template = prompt_structured_templates.get(language, prompt_structured_templates["Español"])
+        if objective_results is not None:
+            # Objectives are already structured; don't have them re-extracted from prose
+            prompt_structured_template = "\n".join([
+                line for line in prompt_structured_template.split("\n")
+                if not line.startswith("- learning_objectives:")
+            ])
+        prompt_structured = build_submission_prompt(prompt_structured_template, language)
+        
+        # Reused if the evaluation text (and so every stage before it) is unchanged
+        structuring_key = stage_memo_key(
+            self.llm, "evaluation.structuring", prompt_structured, {"evaluation": evaluation, **stage_inputs}
+        )
+        if stage_memo.get("structuring", {}).get("key") == structuring_key:
+            structured_evaluation = stage_memo["structuring"]["output"]
+            self.memo["structuring"] = stage_memo["structuring"]
+        elif dry_run:
+            self.recomputed_stages.append("structuring")
+            structured_evaluation = ""
+        else:
+            self.recomputed_stages.append("structuring")
+            try:
+                structured_evaluation = run_llm_stage(
+                    self.llm, "evaluation.structuring", prompt_structured, metrics=self.stage_metrics,
+                    deadline=self.deadline, evaluation=evaluation, **stage_inputs
+                )
+                self.memo["structuring"] = {"key": structuring_key, "output": structured_evaluation}
+            except BatchPending:
+                raise
+            except Exception as e:
+                # Falls through to the placeholder structure below
+                logging.error(f"Error estructurando la evaluación: {e}")
+                missing_stages.append("structuring")
+                structured_evaluation = ""
+        
+        required_keys = ["comprehension", "authenticity", "relational_skills", "argumentation", 
+                      "bibliography_use", "learning_objectives", "overall_quality", 
+                      "plagiarism_detected", "plagiarism_evidence", "summary"]
+        # Repair the JSON locally and keep every field that validates
+        parsed = repair_json(structured_evaluation)
+        if parsed is None:
+            parsed = salvage_json_fields(structured_evaluation, required_keys)
+        structured_data, invalid_fields = validate_structured_evaluation(
+            parsed, learning_objectives if objective_results is None else None
+        )
+        
+        # Only the fields that couldn't be recovered are asked for again
+        rerequested_fields = []
+        if invalid_fields and structured_evaluation:
+            field_schema = "\n".join([
+                line.replace("{{", "{").replace("}}", "}") for line in prompt_structured_template.split("\n")
+                if any(line.startswith(f"- {field}:") for field in invalid_fields)
+            ])
+            prompt_repair = build_submission_prompt(
+                self.structuring_repair_templates.get(language, self.structuring_repair_templates["Español"]), language
+            )
+            repair_inputs = {"evaluation": evaluation, "field_schema": field_schema, **stage_inputs}
+            repair_key = stage_memo_key(self.llm, "evaluation.structuring_repair", prompt_repair, repair_inputs)
+            repaired_evaluation = ""
+            if stage_memo.get("structuring_repair", {}).get("key") == repair_key:
+                repaired_evaluation = stage_memo["structuring_repair"]["output"]
+                self.memo["structuring_repair"] = stage_memo["structuring_repair"]
+            elif dry_run:
+                self.recomputed_stages.append("structuring_repair")
+            else:
+                self.recomputed_stages.append("structuring_repair")
+                try:
+                    repaired_evaluation = run_llm_stage(
+                        self.llm, "evaluation.structuring_repair", prompt_repair, metrics=self.stage_metrics,
+                        deadline=self.deadline, **repair_inputs
+                    )
+                    self.memo["structuring_repair"] = {"key": repair_key, "output": repaired_evaluation}
+                except BatchPending:
+                    raise
+                except Exception as e:
+                    logging.error(f"Error re-solicitando campos de la evaluación ({', '.join(invalid_fields)}): {e}")
+            repaired = repair_json(repaired_evaluation) or salvage_json_fields(repaired_evaluation, invalid_fields)
+            recovered, _ = validate_structured_evaluation(
+                repaired, learning_objectives if "learning_objectives" in invalid_fields else None
+            )
+            rerequested_fields = list(invalid_fields)
+            for field in invalid_fields:
+                if field in recovered:
+                    structured_data[field] = recovered[field]
+            invalid_fields = [field for field in invalid_fields if field not in recovered]
+        
+        if invalid_fields and not structured_data:
+            # Nothing could be recovered; keep the raw evaluation for the teacher
+            structured_data = {
+                "raw_evaluation": evaluation,
+                "comprehension": {"score": 50, "examples": "Error de formato de evaluación", "feedback": "Error de formato de evaluación"},
+                "authenticity": {"score": 50, "examples": "Error de formato de evaluación", "feedback": "Error de formato de evaluación"},
+                "relational_skills": {"score": 50, "examples": "Error de formato de evaluación", "feedback": "Error de formato de evaluación"},
+                "argumentation": {"score": 50, "examples": "Error de formato de evaluación", "feedback": "Error de formato de evaluación"},
+                "bibliography_use": {"score": 50, "examples": "Error de formato de evaluación", "feedback": "Error de formato de evaluación"},
+                "learning_objectives": [{"objective": obj, "score": 50, "examples": "Error de formato de evaluación", "feedback": "Error de formato de evaluación"} for obj in learning_objectives],
+                "overall_quality": {"score": 50, "examples": "Error de formato de evaluación", "feedback": "Error de formato de evaluación"},
+                "plagiarism_detected": False,
+                "plagiarism_evidence": "No se pudo evaluar el plagio debido a un error en el formato",
+                "summary": "Hubo un error en el formato de los resultados de la evaluación."
+            }
+        else:
+            # Placeholders for the fields still missing; the rest of the evaluation stands
+            for field in invalid_fields:
+                if field == "learning_objectives":
+                    structured_data[field] = [{"objective": obj, "score": 50, "examples": "Error de formato de evaluación", "feedback": "Error de formato de evaluación"} for obj in learning_objectives]
+                elif field == "plagiarism_detected":
+                    structured_data[field] = False
+                elif field in ["plagiarism_evidence", "summary"]:
+                    structured_data[field] = "No disponible"
+                else:
+                    structured_data[field] = {"score": 50, "examples": "Error de formato de evaluación", "feedback": "Error de formato de evaluación"}
+                if "structuring" not in missing_stages:
+                    missing_stages.append(f"structuring: {field}")
+        if rerequested_fields or invalid_fields:
+            structured_data["format_repair"] = {
+                "rerequested_fields": rerequested_fields,
+                "defaulted_fields": invalid_fields
+            }
+        
+        if objective_results is not None:
+            structured_data["learning_objectives"] = objective_results
+        structured_data["response_time_analysis"] = response_time_analysis
+        structured_data["partial"] = bool(missing_stages)
+        structured_data["missing_stages"] = missing_stages
+        
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "raw_evaluation": evaluation,
+            "structured_evaluation": structured_data,
+            "assignment_id": os.path.basename(assignment_file_path),
+            "learning_objectives": learning_objectives,
+            "conversation_data": conversation_data,
+            # Kept so a regrade analyzes response times (and so keys its stages) the same way
+            "response_time_baseline": response_time_baseline,
+            "stage_memo": self.memo,
+            # Inputs of the shared prompt prefix, reused by the report stage
+            "prompt_context": {
+                "assignment_text": assignment_text,
+                "learning_objectives": stage_inputs["learning_objectives"],
+                "reference_digest": stage_inputs["reference_digest"],
+                "submission_text": submission_text
+            }
+        }
+
+class ReportGenerator:
+    """Agent that generates a comprehensive report based on the evaluation"""
+    
+    def __init__(self, llm, metrics=None, deadline=None):
+        self.llm = llm
+        self.stage_metrics = metrics if metrics is not None else []
+        self.deadline = deadline
+        self.recomputed_stages = []
+        # The report shares the evaluation's system prompt and prefix (see build_submission_prompt),
+        # so the report generator's role is given at the start of the stage-specific suffix
+        self.task_descriptions = {
+            "English": "You now act as an expert educational report generator. "
+                     "Your task is to create clear, comprehensive, and constructive reports based on student evaluations. "
+                     "Focus on providing actionable feedback that will help the student improve.",
+            
+            "Español": "Ahora actúas como un experto generador de informes educativos. "
+                      "Tu tarea es crear informes claros, completos y constructivos basados en evaluaciones de estudiantes. "
+                      "Concéntrate en proporcionar retroalimentación procesable que ayude al estudiante a mejorar. "
+                      "Incluye análisis detallado sobre la originalidad del trabajo, la evidencia de posible plagio, "
+                      "y cómo los tiempos de respuesta se relacionan con la calidad y autenticidad del trabajo."
+        }
+        
+        self.prompt_templates = {
+            "English": "Evaluation Data:\n{evaluation_json}\n\n"
+                     "Generate a comprehensive educational assessment report with the following sections:\n"
+                     "1. Executive Summary - Brief overview of strengths and areas for improvement\n"
+                     "2. Assessment of Learning Objectives - Detailed evaluation for each objective\n"
+                     "3. Comprehension Analysis - Evaluation of conceptual understanding\n"
+                     "4. Authenticity Assessment - Evaluation of originality and personal engagement\n"
+                     "5. Overall Quality - General assessment of the work\n"
+                     "6. Recommendations - Specific, actionable suggestions for improvement\n\n"
+                     "The report should be professional but encouraging. Use specific examples from the student's work and responses.",
+                     
+            "Español": "Datos de evaluación:\n{evaluation_json}\n\n"
+                      "Genera un informe de evaluación educativa completo con las siguientes secciones:\n"
+                      "1. Resumen ejecutivo - Breve descripción de fortalezas y áreas de mejora\n"
+                      "2. Evaluación de objetivos de aprendizaje - Evaluación detallada para cada objetivo\n"
+                      "3. Análisis de comprensión - Evaluación de la comprensión conceptual\n"
+                      "4. Evaluación de autenticidad - Evaluación de originalidad y compromiso personal\n"
+                      "5. Análisis de habilidades relacionales - Evaluación de cómo el estudiante conecta ideas\n"
+                      "6. Evaluación de argumentación - Calidad de la estructura y fundamentación de argumentos\n"
+                      "7. Uso de bibliografía - Evaluación de referencias y fuentes utilizadas\n"
+                      "8. Análisis de tiempos de respuesta - Coherencia entre tiempo y calidad de respuestas\n"
+                      "9. Detección de plagio - Hallazgos sobre posible contenido no original\n"
+                      "10. Calidad general - Evaluación general del trabajo\n"
+                      "11. Recomendaciones - Sugerencias específicas y procesables para mejorar\n\n"
+                      "El informe debe ser profesional pero alentador. Usa ejemplos específicos del trabajo y las respuestas del estudiante."
+        }
+        
+    def generate_report(self, evaluation_data, stage_memo=None, dry_run=False):
+        """Generate a comprehensive report from evaluation data.
+        
+        The report of stage_memo (an earlier evaluation's memo) is reused if its
+        inputs are unchanged; with dry_run the report is not generated.
+        """
+        # Determine language from conversation data
+        language = evaluation_data.get("conversation_data", {}).get("language", "Español")
+        
+        task_description = self.task_descriptions.get(language, self.task_descriptions["Español"])
+        prompt_template = self.prompt_templates.get(language, self.prompt_templates["Español"])
+        prompt = build_submission_prompt(task_description + "\n\n" + prompt_template, language)
+        
+        evaluation_json = json.dumps(evaluation_data["structured_evaluation"], indent=2)
+        
+        # Same prefix inputs as the evaluation stages (empty for evaluations stored before they were kept)
+        prompt_context = evaluation_data.get("prompt_context") or {}
+        inputs = {
+            "evaluation_json": evaluation_json,
+            "assignment_text": prompt_context.get("assignment_text", ""),
+            "learning_objectives": prompt_context.get("learning_objectives", ""),
+            "reference_digest": prompt_context.get("reference_digest") or reference_digest_text(None, language),
+            "submission_text": prompt_context.get("submission_text", "")
+        }
+        
+        key = stage_memo_key(self.llm, "report.generate", prompt, inputs)
+        memo = evaluation_data.setdefault("stage_memo", {})
+        if (stage_memo or {}).get("report", {}).get("key") == key:
+            report = stage_memo["report"]["output"]
+            memo["report"] = stage_memo["report"]
+        elif dry_run:
+            self.recomputed_stages.append("report")
+            report = ""
+        else:
+            self.recomputed_stages.append("report")
+            try:
+                report = run_llm_stage(
+                    self.llm, "report.generate", prompt, metrics=self.stage_metrics,
+                    deadline=self.deadline, **inputs
+                )
+                memo["report"] = {"key": key, "output": report}
+            except BatchPending:
+                raise
+            except Exception as e:
+                logging.error(f"Error generando el informe: {e}")
+                report = "Error generando el informe."
+                structured_evaluation = evaluation_data["structured_evaluation"]
+                structured_evaluation["partial"] = True
+                structured_evaluation.setdefault("missing_stages", []).append("report")
+
+        
+        return {
+            "text_report": report,
+            "evaluation_data": evaluation_data,
+            "timestamp": datetime.now().isoformat(),
+            "language": language
+        }
+
+def fold_summary_in_background(llm, previous_future, question, response, language, metrics=None, cancelled=None):
+    """Background task: wait for the previous fold, then add one more answer to the summary.
+    
+    Returns {"summary": ..., "answers_folded": ...}, or None if any fold failed or
+    the cancelled event was set, in which case the summary is generated from the
+    full transcript at the end.
+    """
+    previous = {"summary": "", "answers_folded": 0}
+    if previous_future is not None:
+        try:
+            previous = previous_future.result()
+        except CancelledError:
+            return None
+        if previous is None:
+            return None
+    if cancelled is not None and cancelled.is_set():
+        return None
+    
+    try:
+        summary = ConversationAgent(llm, metrics).update_summary(previous["summary"], question, response, language)
+    except Exception as e:
+        logging.error(f"Error actualizando el resumen de conversación: {e}")
+        return None
+    
+    return {"summary": summary, "answers_folded": previous["answers_folded"] + 1}
+
+# Evaluation service: the assignment and student workflow, independent of the Streamlit UI.
+# Sessions are persisted under data/sessions so any worker process can serve them; background
+# work (speculative stages, summary folds, the evaluation itself) is tracked per process.
+SESSIONS_DIR = "data/sessions"
+
+# Wall-clock budget for everything after the conversation ends (summary, stages, report)
+EVALUATION_BUDGET_SECONDS = int(os.environ.get("EVALUATION_BUDGET_SECONDS", "300"))
+# How long the evaluation waits for a speculative stage still running before running it itself
+SPECULATIVE_WAIT_SECONDS = float(os.environ.get("SPECULATIVE_WAIT_SECONDS", "5"))
+
+# A session is evaluated by the worker that claimed it. The claim outlives the evaluation
+# budget, so another worker only takes a session over once its evaluator has died.
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+EVALUATION_LEASE_SECONDS = EVALUATION_BUDGET_SECONDS + 60
+EVALUATION_POLL_SECONDS = 0.5
+
+def new_evaluation_claim():
+    return {"worker": WORKER_ID, "expires_at": time.time() + EVALUATION_LEASE_SECONDS}
+
+_background_tasks = {}
+_background_lock = threading.Lock()
+_claim_lock = threading.Lock()
+_digest_tasks = {}  # assignment ID -> future of its background reference digest, guarded by _background_lock
+
+class EvaluationService:
+    """Creates assignments, runs evaluation conversations and produces reports"""
+    
+    def __init__(self, router, executor=None, record_cassettes=None):
+        self.router = router
+        self.executor = executor or get_background_executor()
+        if record_cassettes is None:
+            record_cassettes = os.environ.get("LLM_CASSETTE_MODE") == "record"
+        self.record_cassettes = record_cassettes
+        
+    def _tasks(self, session_id):
+        """Background futures and stage metrics of a session in this process"""
+        with _background_lock:
+            # "cancelled" tells background work the evaluation no longer waits for it
+            return _background_tasks.setdefault(session_id, {"metrics": [], "cancelled": threading.Event()})
+        
+    def _router_for(self, assignment, session_id):
+        """Router with the assignment's overrides, recording to the session's cassette if enabled"""
+        router = self.router.with_overrides(assignment.get("model_routes"))
+        if self.record_cassettes:
+            tasks = self._tasks(session_id)
+            if "cassette" not in tasks:
+                tasks["cassette"] = LLMCassette(os.path.join(CASSETTES_DIR, f"{session_id}.json"))
+            router = router.with_cassette(tasks["cassette"])
+        return router.with_usage_scopes(assignment.get("id"), session_id)
+        
+    def load_session(self, session_id):
+        """Load a persisted conversation session"""
+        session_path = os.path.join(SESSIONS_DIR, f"{session_id}.json")
+        if not os.path.exists(session_path):
+            raise KeyError(session_id)
+        with open(session_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+        
+    def _save_session(self, session):
+        # Write to a temporary file first so readers never see a partial session
+        session_path = os.path.join(SESSIONS_DIR, f"{session['id']}.json")
+        tmp_path = f"{session_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(session, f, indent=4)
+        os.replace(tmp_path, session_path)
+        
+    def list_assignments(self, shard=None):
+        """Assignments of one course shard, or of every course when shard is None"""
+        cache = get_shard_cache()
+        if shard is not None:
+            return cache.get(shard, "assignments")
+        assignments = {}
+        for course_shard in load_shard_catalog()["courses"]:
+            assignments.update(cache.get(course_shard, "assignments"))
+        return assignments
+        
+    def list_courses(self):
+        """Shard key -> {course, term} of every course with assignments"""
+        return load_shard_catalog()["courses"]
+        
+    def get_assignment(self, assignment_id):
+        assignments = get_shard_cache().get(find_assignment_shard(assignment_id), "assignments")
+        if assignment_id not in assignments:
+            raise KeyError(assignment_id)
+        return assignments[assignment_id]
+        
+    def _register_assignment(self, assignment_id, shard, course=None, term=None):
+        """Record (or remove, with shard=None) an assignment's course shard in the catalog"""
+        with file_lock(SHARD_CATALOG_FILE):
+            catalog = load_shard_catalog()
+            if shard is None:
+                catalog["assignments"].pop(assignment_id, None)
+            else:
+                catalog["courses"].setdefault(shard, {"course": course or DEFAULT_COURSE, "term": term})
+                catalog["assignments"][assignment_id] = shard
+            save_json(catalog, SHARD_CATALOG_FILE)
+        
+    def create_assignment(self, name, instructions, learning_objectives, num_questions=3,
+                          language="Español", file_path=None, model_routes=None, objective_fanout=False,
+                          course=None, term=None, batch_grading=False):
+        """Create and store a new assignment"""
+        learning_objectives = [obj for obj in learning_objectives if obj]
+        if not name or not instructions or not learning_objectives:
+            raise ValueError(get_text("fields_error", language))
+        
+        assignment_id = f"{uuid.uuid4()}"
+        assignment_data = {
+            "id": assignment_id,
+            "name": name,
+            "instructions": instructions,
+            "learning_objectives": learning_objectives,
+            "created_at": datetime.now().isoformat(),
+            "file_path": file_path,
+            "num_questions": num_questions,
+            "language": language,
+            "model_routes": model_routes,
+            "objective_fanout": objective_fanout,
+            "batch_grading": batch_grading,
+            "course": course or DEFAULT_COURSE,
+            "term": term or None
+        }
+        self._ensure_reference_digest(assignment_data)
+        shard = shard_key(course, term)
+        get_shard_cache().update(shard, "assignments", assignment_id, assignment_data)
+        self._register_assignment(assignment_id, shard, course, term)
+        return assignment_data
+        
+    def _reference_digest_due(self, assignment):
+        """Whether the assignment has a reference document without a digest, and no failed attempt is backing off"""
+        if not assignment.get("file_path") or "reference_digest" in assignment:
+            return False
+        failure = assignment.get("reference_digest_failure")
+        return failure is None or time.time() >= failure["retry_at"]
+        
+    def _ensure_reference_digest(self, assignment):
+        """Digest the assignment's reference document if it is due (see _reference_digest_due).
+        
+        A failed attempt is recorded in reference_digest_failure with the time of
+        the next one. Returns True if the assignment was changed and should be saved.
+        """
+        if not self._reference_digest_due(assignment):
+            return False
+        document = read_document(assignment["file_path"])
+        if not document or not document.strip():
+            # Unreadable documents are not retried
+            assignment["reference_digest"] = None
+            return True
+        try:
+            router = self.router.with_overrides(assignment.get("model_routes")).with_usage_scopes(assignment["id"])
+            digest = ReferenceDigestAgent(router).digest(
+                document, assignment["instructions"], assignment["learning_objectives"], assignment.get("language", "English")
+            )
+        except Exception as e:
+            logging.error(f"Error resumiendo el documento de referencia {assignment['file_path']}: {e}")
+            attempts = (assignment.get("reference_digest_failure") or {}).get("attempts", 0) + 1
+            backoff = min(REFERENCE_DIGEST_RETRY_SECONDS * 2 ** (attempts - 1), REFERENCE_DIGEST_MAX_RETRY_SECONDS)
+            assignment["reference_digest_failure"] = {"attempts": attempts, "error": str(e), "retry_at": time.time() + backoff}
+            return True
+        assignment.pop("reference_digest_failure", None)
+        assignment["reference_digest"] = digest
+        assignment["reference_digest_tokens"] = count_tokens(digest)
+        return True
+        
+    def _digest_in_background(self, assignment_id):
+        """Background task: digest an assignment's reference document, once across every process"""
+        try:
+            shard = find_assignment_shard(assignment_id)
+            # Whoever takes the lock first digests; the others find the digest (or its backoff) saved
+            with file_lock(os.path.join(SHARDS_DIR, shard, f"digest-{assignment_id}")):
+                assignment = dict(self.get_assignment(assignment_id))
+                if not self._ensure_reference_digest(assignment):
+                    return
+                # Only the digest fields: the assignment may have been edited during the call
+                current = dict(self.get_assignment(assignment_id))
+                current.pop("reference_digest_failure", None)
+                for key in ["reference_digest", "reference_digest_tokens", "reference_digest_failure"]:
+                    if key in assignment:
+                        current[key] = assignment[key]
+                get_shard_cache().update(shard, "assignments", assignment_id, current)
+        except KeyError:
+            # Deleted in the meantime
+            pass
+        finally:
+            with _background_lock:
+                _digest_tasks.pop(assignment_id, None)
+        
+    def _schedule_reference_digest(self, assignment):
+        """Start the assignment's reference digest in the background if it is due and not already running here"""
+        if not self._reference_digest_due(assignment):
+            return
+        with _background_lock:
+            if assignment["id"] not in _digest_tasks:
+                _digest_tasks[assignment["id"]] = self.executor.submit(self._digest_in_background, assignment["id"])
+        
+    def delete_assignment(self, assignment_id):
+        get_shard_cache().update(find_assignment_shard(assignment_id), "assignments", assignment_id, None)
+        self._register_assignment(assignment_id, None)
+        
+    def start_conversation(self, assignment_id, text_submission, file_path=None):
+        """Store a submission, start its submission-only stages and ask the first question"""
+        assignment = self.get_assignment(assignment_id)
+        language = assignment.get("language", "English")
+        if not text_submission and not file_path:
+            raise ValueError(get_text("submission_error", language))
+        
+        # Admission control: wait (up to QUOTA_MAX_WAIT_SECONDS) for quota room for the whole evaluation,
+        # and reserve it for this session until its evaluation finishes
+        session_id = f"{uuid.uuid4()}"
+        try:
+            get_usage_meter().admit(self.router.with_usage_scopes(assignment_id).usage_scopes, reservation_id=session_id)
+        except QuotaExceeded as e:
+            raise QuotaExceeded(e.scope, e.retry_after, get_text("quota_exceeded", language).format(
+                scope=e.scope.split(":")[0], minutes=max(1, math.ceil(e.retry_after / 60))
+            )) from e
+        
+        try:
+            return self._start_admitted_conversation(assignment, session_id, text_submission, file_path)
+        except Exception:
+            get_usage_meter().release(session_id)
+            raise
+        
+    def _start_admitted_conversation(self, assignment, session_id, text_submission, file_path):
+        """The rest of start_conversation, once the session has its quota reservation"""
+        assignment_id = assignment["id"]
+        language = assignment.get("language", "English")
+        # Assignments created before digests existed, or whose digest failed, get it in the background;
+        # submissions made meanwhile are evaluated without it
+        self._schedule_reference_digest(assignment)
+        
+        # Save submission
+        submission_id = f"{uuid.uuid4()}"
+        submission_data = {
+            "id": submission_id,
+            "assignment_id": assignment_id,
+            "text_submission": text_submission,
+            "file_path": file_path,
+            "submitted_at": datetime.now().isoformat()
+        }
+        # Normalized once and stored with the submission; every prompt reuses this text
+        submission_text, normalization = normalize_submission(submission_data)
+        get_shard_cache().update(find_assignment_shard(assignment_id), "submissions", submission_id, submission_data)
+        
+        router = self._router_for(assignment, session_id)
+        tasks = self._tasks(session_id)
+        
+        # Evaluate the submission-only stages in the background
+        # while questions are generated and answered (batch-graded assignments wait for the batch)
+        if not assignment.get("batch_grading"):
+            tasks["speculative_stages"] = {}
+            tasks["speculative"] = self.executor.submit(
+                EvaluationAgent(router, tasks["metrics"]).evaluate_submission_only_stages,
+                assignment["instructions"],
+                submission_text,
+                assignment["learning_objectives"],
+                language,
+                reference_digest=assignment.get("reference_digest"),
+                cancelled=tasks["cancelled"],
+                on_stage_complete=tasks["speculative_stages"].__setitem__
+            )
+        
+        questions = QuestionGeneratorAgent(router, tasks["metrics"]).generate_questions(
+            assignment["instructions"],
+            assignment["learning_objectives"],
+            num_questions=assignment.get("num_questions", 3),  # Default to 3 if not specified
+            language=language,  # Use the assignment's language
+            reference_digest=assignment.get("reference_digest")
+        )
+        if not questions:
+            raise RuntimeError("No se pudieron generar preguntas para la tarea.")
+        
+        session = {
+            "id": session_id,
+            "assignment_id": assignment_id,
+            "submission_id": submission_id,
+            "submitted_at": submission_data["submitted_at"],
+            "submission_text": submission_text,
+            "normalization": normalization,
+            "language": language,
+            "questions": questions,
+            "current_question_idx": 0,
+            "conversation_history": [],
+            "responses": {},
+            "timestamps": [datetime.now().isoformat()],
+            "rolling_summary": None,
+            "precomputed_stages": None,
+            "status": "in_progress",
+            "evaluation_id": None,
+            "error": None
+        }
+        self._save_session(session)
+        
+        conversation_agent = ConversationAgent(router)
+        return {
+            "session_id": session_id,
+            "message": conversation_agent.intro_messages.get(language, conversation_agent.intro_messages["English"]),
+            "question": questions[0],
+            "num_questions": len(questions),
+            "done": False
+        }
+        
+    def _checkpoint(self, session):
+        """Copy finished background results into the persisted session"""
+        tasks = self._tasks(session["id"])
+        future = tasks.get("summary")
+        if future is not None and future.done():
+            try:
+                session["rolling_summary"] = future.result()
+            except Exception as e:
+                logging.error(f"Error en tarea en segundo plano (summary): {e}")
+        # Speculative stages are kept as each one finishes, even if others are still running
+        speculative_stages = dict(tasks.get("speculative_stages") or {})
+        if speculative_stages:
+            session["precomputed_stages"] = {**(session.get("precomputed_stages") or {}), **speculative_stages}
+        
+    def submit_answer(self, session_id, response):
+        """Record the student's answer and return the next question, or start the evaluation"""
+        session = self.load_session(session_id)
+        if session["status"] != "in_progress":
+            raise ValueError("La conversación ya ha terminado.")
+        
+        try:
+            assignment = self.get_assignment(session["assignment_id"])
+        except KeyError:
+            assignment = {}
+        router = self._router_for(assignment, session_id)
+        # A session past its own quota (e.g. a runaway client) is not answered until it has room
+        blocked = get_usage_meter().check([f"session:{session_id}"])
+        if blocked is not None:
+            raise QuotaExceeded(blocked[0], blocked[1], get_text("quota_exceeded", session["language"]).format(
+                scope="session", minutes=max(1, math.ceil(blocked[1] / 60))
+            ))
+        tasks = self._tasks(session_id)
+        self._checkpoint(session)
+        
+        # Record response and timestamp
+        question = session["questions"][session["current_question_idx"]]
+        session["responses"][question] = response
+        session["conversation_history"].append({"question": question, "response": response})
+        session["timestamps"].append(datetime.now().isoformat())
+        session["current_question_idx"] += 1
+        
+        # Fold the answer into the rolling summary while the student reads the next question
+        tasks["summary"] = self.executor.submit(
+            fold_summary_in_background,
+            router,
+            tasks.get("summary"),
+            question,
+            response,
+            session["language"],
+            tasks["metrics"],
+            tasks["cancelled"]
+        )
+        
+        conversation_agent = ConversationAgent(router)
+        language = session["language"]
+        if session["current_question_idx"] < len(session["questions"]):
+            self._save_session(session)
+            return {
+                "message": conversation_agent.response_acknowledgments.get(
+                    language, conversation_agent.response_acknowledgments["English"]
+                ),
+                "question": session["questions"][session["current_question_idx"]],
+                "done": False
+            }
+        
+        session["conversation_completed_at"] = datetime.now().isoformat()
+        if assignment.get("batch_grading"):
+            # Graded later by batch_grading.py, which finds it in the shard's batch queue
+            session["status"] = "awaiting_batch"
+            self._save_session(session)
+            # Batch calls don't count against the live quotas, so nothing more is expected
+            get_usage_meter().release(session_id)
+            get_shard_cache().update(find_assignment_shard(assignment["id"]), "batch_queue", session_id, assignment["id"])
+        else:
+            # Held until the future is registered, so get_evaluation can't claim it in between
+            with _claim_lock:
+                session["status"] = "evaluating"
+                session["evaluation_claim"] = new_evaluation_claim()
+                self._save_session(session)
+                tasks["evaluation"] = self.executor.submit(self._run_evaluation, session_id)
+        return {
+            "message": conversation_agent.completion_messages.get(
+                language, conversation_agent.completion_messages["English"]
+            ),
+            "question": None,
+            "done": True
+        }
+        
+    def _normalization_savings(self, session, stage_metrics, evaluation_agent):
+        """Tokens that text normalization kept out of this evaluation's prompts"""
+        savings = dict(session["normalization"])
+        answers = [item["response"] for item in session["conversation_history"]]
+        savings["answer_tokens_before"] = sum(count_tokens(answer) for answer in answers)
+        savings["answer_tokens_after"] = sum(count_tokens(normalize_whitespace(answer)) for answer in answers)
+        
+        # The submission is in the shared prefix of every evaluation and report prompt; the
+        # whole transcript is in the final summary and the stages that take conversation_details
+        transcript_stages = {"conversation.summary"} | {
+            f"evaluation.{stage}" for stage in evaluation_agent.get_stages_using("conversation_details", session["language"])
+        }
+        stages = [m["stage"] for m in stage_metrics]
+        savings["submission_prompts"] = sum(1 for stage in stages if stage.split(".")[0] in ("evaluation", "report"))
+        savings["transcript_prompts"] = sum(1 for stage in stages if stage in transcript_stages)
+        savings["tokens_saved"] = (
+            (savings["prompt_tokens_before"] - savings["prompt_tokens_after"]) * savings["submission_prompts"]
+            + (savings["answer_tokens_before"] - savings["answer_tokens_after"]) * savings["transcript_prompts"]
+        )
+        return savings
+        
+    def _store_evaluation(self, evaluation_id, shard, report_data):
+        """Store an evaluation in its shard, with its report view and index entries"""
+        get_shard_cache().update(shard, "evaluations", evaluation_id, report_data)
+        
+        # Precompute the report view and list the evaluation in the shard's index
+        save_report_view(build_report_view(evaluation_id, report_data))
+        load_evaluation_index(shard)
+        get_shard_cache().update(shard, "index", evaluation_id, evaluation_index_entry(report_data, shard))
+        try:
+            index_evaluation(shard, evaluation_id, report_data)
+        except Exception as e:
+            # The index is rebuilt from the shard if it is lost, so a failure here is not fatal
+            logging.error(f"Error indexando la evaluación {evaluation_id}: {e}")
+        
+    def _run_evaluation(self, session_id, batch=None):
+        """Summarize, evaluate, report and store the evaluation of a finished conversation.
+        
+        With a batch, LLM calls are answered from / queued in it and BatchPending
+        is raised while any stage is still waiting.
+        """
+        session = self.load_session(session_id)
+        tasks = self._tasks(session_id)
+        metrics = tasks["metrics"]
+        if batch is not None:
+            # Calls answered in earlier waves
+            metrics.extend(session.get("batch_metrics") or [])
+        # Every stage must finish within the evaluation budget; slower stages are left out
+        deadline = time.monotonic() + EVALUATION_BUDGET_SECONDS
+        try:
+            assignment = self.get_assignment(session["assignment_id"])
+            router = self._router_for(assignment, session_id)
+            if batch is not None:
+                router = router.with_batch(batch)
+            
+            # Wait (within the budget) for the background work started during the conversation.
+            # A speculative stage still running is only waited for briefly: the evaluation runs
+            # it itself rather than let a slow call use up the budget
+            for name, wait_seconds in [("summary", EVALUATION_BUDGET_SECONDS), ("speculative", SPECULATIVE_WAIT_SECONDS)]:
+                if tasks.get(name) is not None:
+                    try:
+                        tasks[name].exception(timeout=max(0, min(deadline - time.monotonic(), wait_seconds)))
+                    except FutureTimeoutError:
+                        # Past its wait its result is not used: drop it if still queued, and stop
+                        # it before its next LLM call (a call already in flight can't be interrupted)
+                        tasks["cancelled"].set()
+                        tasks[name].cancel()
+                        logging.error(f"Tarea en segundo plano '{name}' sin terminar para la sesión {session_id}")
+            self._checkpoint(session)
+            
+            # Use the rolling summary if it covers every answer, otherwise summarize now
+            rolling_summary = None
+            folded = session.get("rolling_summary")
+            if folded is not None and folded["answers_folded"] == len(session["conversation_history"]):
+                rolling_summary = folded["summary"]
+            
+            conversation_agent = ConversationAgent(router, metrics, deadline=deadline)
+            conversation_agent.conversation_history = session["conversation_history"]
+            conversation_agent.student_responses = session["responses"]
+            conversation_agent.timestamps = session["timestamps"]
+            conversation_data = conversation_agent.get_conversation_summary(
+                language=session["language"],
+                rolling_summary=rolling_summary
+            )
+            if batch is not None and rolling_summary is None:
+                # Keep the batch summary so later waves don't look it up (and count it) again
+                session["rolling_summary"] = {
+                    "summary": conversation_data["summary"],
+                    "answers_folded": len(session["conversation_history"])
+                }
+                self._save_session(session)
+            if batch is not None and "response_time_baseline" in session:
+                # The same baseline in every wave, so the prompts (and their batch requests) don't change
+                response_time_baseline = session["response_time_baseline"]
+            else:
+                response_time_baseline = load_json(RESPONSE_TIME_STATS_FILE).get(assignment["id"])
+                if batch is not None:
+                    session["response_time_baseline"] = response_time_baseline
+            
+            if router.cassette is not None:
+                # Everything needed to rerun the evaluation offline from the cassette
+                router.cassette.inputs = {
+                    "assignment_text": assignment["instructions"],
+                    "assignment_id": assignment["id"],
+                    "submission_text": session["submission_text"],
+                    "learning_objectives": assignment["learning_objectives"],
+                    "conversation_data": conversation_data,
+                    "objective_fanout": assignment.get("objective_fanout", False),
+                    "response_time_baseline": response_time_baseline,
+                    "reference_digest": assignment.get("reference_digest")
+                }
+            
+            def persist_stage(stage, output):
+                # Completed stages survive a crash or restart and are reused on the next run
+                if session.get("precomputed_stages") is None:
+                    session["precomputed_stages"] = {}
+                session["precomputed_stages"][stage] = output
+                self._save_session(session)
+            
+            evaluation_agent = EvaluationAgent(router, metrics, deadline=deadline)
+            evaluation_data = evaluation_agent.evaluate_submission(
+                assignment["instructions"],
+                assignment["id"],
+                session["submission_text"],
+                assignment["learning_objectives"],
+                conversation_data,
+                precomputed_stages=session.get("precomputed_stages") or {},
+                objective_fanout=assignment.get("objective_fanout", False),
+                response_time_baseline=response_time_baseline,
+                on_stage_complete=persist_stage,
+                reference_digest=assignment.get("reference_digest")
+            )
+            
+            report_generator = ReportGenerator(router, metrics, deadline=deadline)
+            report_data = report_generator.generate_report(evaluation_data)
+            report_data["submission_id"] = session["submission_id"]
+            if router.cassette is not None:
+                report_data["cassette"] = router.cassette.path
+                router.cassette.outputs = {
+                    "structured_evaluation": evaluation_data["structured_evaluation"],
+                    "text_report": report_data["text_report"]
+                }
+            
+            # Record per-stage latency, tokens and cost for this evaluation
+            now = datetime.now()
+            report_data["performance"] = summarize_stage_metrics(metrics)
+            if batch is None:
+                # Sizes the admission estimate for new submissions
+                get_usage_meter().record_evaluation(
+                    report_data["performance"]["prompt_tokens"] + report_data["performance"]["completion_tokens"],
+                    report_data["performance"]["calls"]
+                )
+            report_data["performance"]["post_conversation_seconds"] = round(
+                (now - datetime.fromisoformat(session["conversation_completed_at"])).total_seconds(), 3
+            )
+            report_data["performance"]["submission_to_report_seconds"] = round(
+                (now - datetime.fromisoformat(session["submitted_at"])).total_seconds(), 3
+            )
+            if session.get("normalization"):
+                report_data["performance"]["normalization"] = self._normalization_savings(
+                    session, report_data["performance"]["stages"], evaluation_agent
+                )
+            
+            evaluation_id = f"{uuid.uuid4()}"
+            self._store_evaluation(evaluation_id, find_assignment_shard(assignment["id"]), report_data)
+            
+            # Add this student's typing speeds to the assignment's baseline
+            with file_lock(RESPONSE_TIME_STATS_FILE):
+                stats = load_json(RESPONSE_TIME_STATS_FILE)
+                stats[assignment["id"]] = update_response_time_baseline(
+                    stats.get(assignment["id"]), evaluation_data["structured_evaluation"]["response_time_analysis"]
+                )
+                save_json(stats, RESPONSE_TIME_STATS_FILE)
+            
+            session["status"] = "complete"
+            session["evaluation_id"] = evaluation_id
+            self._save_session(session)
+            if batch is not None:
+                get_shard_cache().update(find_assignment_shard(assignment["id"]), "batch_queue", session_id, None)
+            return evaluation_id
+        except BatchPending:
+            # Stages finished so far are saved in the session; it stays in the batch
+            session["batch_metrics"] = list(metrics)
+            self._save_session(session)
+            raise
+        except Exception as e:
+            logging.error(f"Error evaluando la sesión {session_id}: {e}")
+            session["status"] = "failed"
+            session["error"] = str(e)
+            self._save_session(session)
+            raise
+        finally:
+            cassette = tasks.get("cassette")
+            if cassette is not None:
+                cassette.save()
+            if batch is None:
+                # Reconcile: what the evaluation used is already metered, so its reservation goes
+                get_usage_meter().release(session_id)
+            with _background_lock:
+                _background_tasks.pop(session_id, None)
+        
+    def _claim_evaluation(self, session_id):
+        """Claim a session's evaluation for this worker.
+        
+        False if the session is no longer waiting for its evaluation, or if another
+        worker holds a claim whose lease has not expired.
+        """
+        with file_lock(os.path.join(SESSIONS_DIR, f"{session_id}.json")):
+            session = self.load_session(session_id)
+            claim = session.get("evaluation_claim")
+            if session["status"] != "evaluating":
+                return False
+            if claim and claim["worker"] != WORKER_ID and claim["expires_at"] > time.time():
+                return False
+            session["evaluation_claim"] = new_evaluation_claim()
+            self._save_session(session)
+            return True
+        
+    def get_evaluation(self, session_id, timeout=None):
+        """Get the evaluation status of a session, waiting up to timeout seconds for it to finish.
+        
+        If the session is being evaluated but no worker is running it (e.g. its
+        worker was restarted and its claim has expired), it is claimed and the
+        evaluation is started here. A session claimed by another worker (another
+        process sharing the data directory) is polled until it is stored.
+        """
+        session = self.load_session(session_id)
+        give_up = None if timeout is None else time.monotonic() + timeout
+        while session["status"] == "evaluating":
+            remaining = None if give_up is None else max(0, give_up - time.monotonic())
+            with _claim_lock:
+                with _background_lock:
+                    future = _background_tasks.get(session_id, {}).get("evaluation")
+                if future is None and self._claim_evaluation(session_id):
+                    future = self._tasks(session_id)["evaluation"] = self.executor.submit(self._run_evaluation, session_id)
+            if future is not None:
+                try:
+                    future.exception(timeout=remaining)
+                except FutureTimeoutError:
+                    pass
+                session = self.load_session(session_id)
+                break
+            if remaining == 0:
+                break
+            time.sleep(EVALUATION_POLL_SECONDS if remaining is None else min(EVALUATION_POLL_SECONDS, remaining))
+            session = self.load_session(session_id)
+        
+        result = {"session_id": session_id, "status": session["status"], "evaluation_id": session["evaluation_id"]}
+        if session["status"] == "complete":
+            shard = load_shard_catalog()["assignments"].get(session["assignment_id"])
+            result["report"] = self.get_stored_evaluation(session["evaluation_id"], shard)
+        elif session["status"] == "failed":
+            result["error"] = session["error"]
+        return result
+        
+    def get_stored_evaluation(self, evaluation_id, shard=None):
+        return load_stored_evaluation(evaluation_id, shard)
+        
+    def regrade_evaluation(self, evaluation_id, dry_run=False):
+        """Grade a stored evaluation again with its assignment's current instructions, objectives and prompts.
+        
+        The conversation is not repeated, and every stage whose memoized output is
+        still valid (same prompt, model and inputs) is reused, so e.g. editing the
+        learning objectives reruns only the objectives stage, structuring and the
+        report. The evaluation is replaced in place. With dry_run nothing is run
+        or stored. Returns {evaluation_id, recomputed_stages, reused_stages}.
+        """
+        report_data = load_stored_evaluation(evaluation_id)
+        evaluation_data = report_data["evaluation_data"]
+        assignment = self.get_assignment(evaluation_data["assignment_id"])
+        shard = find_assignment_shard(assignment["id"])
+        
+        submission = get_shard_cache().get(shard, "submissions").get(report_data.get("submission_id"))
+        if submission is not None:
+            submission_text, _ = normalize_submission(submission)
+        else:
+            submission_text = (evaluation_data.get("prompt_context") or {}).get("submission_text", "")
+        
+        router = self.router.with_overrides(assignment.get("model_routes")).with_usage_scopes(assignment["id"])
+        metrics = []
+        evaluation_agent = EvaluationAgent(router, metrics)
+        new_evaluation_data = evaluation_agent.evaluate_submission(
+            assignment["instructions"],
+            assignment["id"],
+            submission_text,
+            assignment["learning_objectives"],
+            evaluation_data["conversation_data"],
+            objective_fanout=assignment.get("objective_fanout", False),
+            response_time_baseline=evaluation_data.get("response_time_baseline"),
+            reference_digest=assignment.get("reference_digest"),
+            stage_memo=evaluation_data.get("stage_memo"),
+            dry_run=dry_run
+        )
+        report_generator = ReportGenerator(router, metrics)
+        new_report_data = report_generator.generate_report(
+            new_evaluation_data, stage_memo=evaluation_data.get("stage_memo"), dry_run=dry_run
+        )
+        recomputed = evaluation_agent.recomputed_stages + report_generator.recomputed_stages
+        result = {
+            "evaluation_id": evaluation_id,
+            "recomputed_stages": recomputed,
+            "reused_stages": [stage for stage in new_evaluation_data["stage_memo"] if stage not in recomputed]
+        }
+        if dry_run:
+            return result
+        
+        new_report_data["submission_id"] = report_data.get("submission_id")
+        new_report_data["performance"] = summarize_stage_metrics(metrics)
+        # Timings and savings of the original grading, which a regrade doesn't measure again
+        for field in ["post_conversation_seconds", "submission_to_report_seconds", "normalization"]:
+            if field in report_data.get("performance", {}):
+                new_report_data["performance"][field] = report_data["performance"][field]
+        new_report_data["first_graded_at"] = report_data.get("first_graded_at") or report_data.get("timestamp")
+        self._store_evaluation(evaluation_id, shard, new_report_data)
+        return result
+        
+    def _load_batch_queue(self, shard):
+        """Session ID -> assignment ID of the shard's conversations queued for batch grading"""
+        cache = get_shard_cache()
+        if not cache.exists(shard, "batch_queue"):
+            # Shards from before the queue existed: find their waiting sessions once
+            queued = {}
+            assignments = cache.get(shard, "assignments")
+            for name in sorted(os.listdir(SESSIONS_DIR)):
+                if not name.endswith(".json"):
+                    continue
+                session = self.load_session(name[:-len(".json")])
+                if session["assignment_id"] in assignments and session["status"] == "awaiting_batch":
+                    queued[session["id"]] = session["assignment_id"]
+            cache.update_many(shard, "batch_queue", queued)
+        return cache.get(shard, "batch_queue")
+        
+    def list_batch_sessions(self, assignment_id):
+        """IDs of the assignment's finished conversations waiting for batch grading"""
+        shard = find_assignment_shard(assignment_id)
+        session_ids, graded = [], {}
+        for session_id, queued_assignment_id in sorted(self._load_batch_queue(shard).items()):
+            if queued_assignment_id != assignment_id:
+                continue
+            try:
+                status = self.load_session(session_id)["status"]
+            except KeyError:
+                status = None
+            if status == "awaiting_batch":
+                session_ids.append(session_id)
+            else:
+                graded[session_id] = None
+        if graded:
+            # Sessions graded (or failed, or deleted) since the last run leave the queue
+            get_shard_cache().update_many(shard, "batch_queue", graded)
+        return session_ids
+        
+    def evaluate_in_batch(self, session_id, batch):
+        """Advance a batch-graded session by one wave.
+        
+        Returns the evaluation ID once every stage has been answered, or raises
+        BatchPending after queueing the stages that can run next in batch.
+        """
+        session = self.load_session(session_id)
+        if session["status"] == "complete":
+            # Already stored by an ingest that was interrupted before it could record it
+            return session["evaluation_id"]
+        return self._run_evaluation(session_id, batch=batch)
+
+# Session state: large values (the chat messages, the student's answers) are spilled to disk
+# under SESSION_SPILL_DIR and st.session_state only keeps a small handle. Idle sessions are
+# evicted after SESSION_TTL_SECONDS, so server memory stays bounded with many students.
+SESSION_SPILL_DIR = "data/session_spill"
+SESSION_SPILL_BYTES = int(os.environ.get("SESSION_SPILL_BYTES", "2048"))
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", "3600"))
+
+class SpilledValue:
+    """Handle kept in st.session_state for a value stored on disk"""
+    __slots__ = ("path", "size")
+    
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+class SessionStateManager:
+    """Spills large per-session values to disk, evicts idle sessions and reports their memory"""
+    
+    def __init__(self, spill_dir=SESSION_SPILL_DIR, spill_bytes=SESSION_SPILL_BYTES, ttl_seconds=SESSION_TTL_SECONDS):
+        self.spill_dir = spill_dir
+        self.spill_bytes = spill_bytes
+        self.ttl_seconds = ttl_seconds
+        self._sessions = {}  # session key -> {"last_seen", "inline_bytes" (None until measured), "spilled_bytes"}
+        self._lock = threading.Lock()
+        self._last_eviction = 0
+        
+    def _session(self, session_key):
+        return self._sessions.setdefault(session_key, {"last_seen": time.time(), "inline_bytes": None, "spilled_bytes": {}})
+        
+    def put(self, session_key, name, value):
+        """Return what to keep in session state for value: the value itself, or a SpilledValue"""
+        encoded = json.dumps(value, default=str)
+        with self._lock:
+            spilled = self._session(session_key)["spilled_bytes"]
+            if len(encoded) < self.spill_bytes:
+                spilled.pop(name, None)
+                return value
+            spilled[name] = len(encoded)
+        
+        path = os.path.join(self.spill_dir, session_key, f"{name}.json")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(encoded)
+        return SpilledValue(path, len(encoded))
+        
+    def get(self, value, default=None):
+        """Resolve a session state value, reading it back from disk if it was spilled"""
+        if not isinstance(value, SpilledValue):
+            return value
+        if not os.path.exists(value.path):
+            # Only closed sessions are evicted, so this means the spill file was removed from outside
+            logging.error(f"Falta el valor de sesión volcado a disco: {value.path}")
+            return default
+        with open(value.path, "r", encoding="utf-8") as f:
+            return json.load(f)
+        
+    def touch(self, session_key):
+        """Mark a session as active; cheap enough to call on every rerun, fragment reruns included"""
+        with self._lock:
+            self._session(session_key)["last_seen"] = time.time()
+        
+    def measure(self, session_key, state):
+        """Measure what a session keeps in memory; only done when the memory report is shown"""
+        inline_bytes = 0
+        for key in list(state.keys()):
+            value = state[key]
+            if not isinstance(value, SpilledValue):
+                inline_bytes += len(json.dumps(value, default=str))
+        with self._lock:
+            self._session(session_key)["inline_bytes"] = inline_bytes
+        
+    def discard(self, session_key):
+        """Drop a session's spilled values"""
+        shutil.rmtree(os.path.join(self.spill_dir, session_key), ignore_errors=True)
+        with self._lock:
+            self._sessions.pop(session_key, None)
+        
+    def evict_idle(self, interval_seconds=60):
+        """Evict sessions Streamlit has closed and that have been idle for longer than the TTL; runs at most once per interval"""
+        now = time.time()
+        with self._lock:
+            if now - self._last_eviction < interval_seconds:
+                return 0
+            self._last_eviction = now
+            idle = [key for key, session in self._sessions.items() if now - session["last_seen"] > self.ttl_seconds]
+        
+        # Spill directories left behind by a previous server process are evicted too
+        if os.path.isdir(self.spill_dir):
+            for session_key in os.listdir(self.spill_dir):
+                path = os.path.join(self.spill_dir, session_key)
+                if session_key not in self._sessions and now - os.path.getmtime(path) > self.ttl_seconds:
+                    idle.append(session_key)
+        
+        # A session whose tab is still open is never evicted, however long it has been idle
+        closed = [session_key for session_key in idle if not streamlit_session_active(session_key)]
+        for session_key in closed:
+            self.discard(session_key)
+        evicted_tasks = evict_idle_background_tasks(self.ttl_seconds)
+        if closed or evicted_tasks:
+            logging.info(f"Sesiones cerradas eliminadas: {len(closed)} (tareas en segundo plano: {evicted_tasks})")
+        return len(closed)
+        
+    def report(self):
+        """Memory per session, largest first; inline_kb is as of the session's last measurement"""
+        now = time.time()
+        with self._lock:
+            rows = [
+                {
+                    "session": key[:8],
+                    "inline_kb": None if session["inline_bytes"] is None else round(session["inline_bytes"] / 1024, 1),
+                    "spilled_kb": round(sum(session["spilled_bytes"].values()) / 1024, 1),
+                    "idle_seconds": round(now - session["last_seen"])
+                }
+                for key, session in self._sessions.items()
+            ]
+        return sorted(rows, key=lambda row: (row["inline_kb"] or 0) + row["spilled_kb"], reverse=True)
+
+def streamlit_session_active(session_key):
+    """Whether Streamlit still has the session open; True when there is no runtime to ask (scripts, AppTest)"""
+    try:
+        from streamlit import runtime
+        if not runtime.exists():
+            return True
+        return runtime.get_instance().is_active_session(session_key)
+    except Exception as e:
+        logging.warning(f"No se pudo consultar el estado de la sesión {session_key[:8]}: {e}")
+        return True
+
+def current_streamlit_session_id():
+    """The ID Streamlit gives this browser session, or None outside a script run"""
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx()
+    except ImportError:
+        return None
+    return ctx.session_id if ctx is not None else None
+
+@st.cache_resource(show_spinner=False)
+def get_session_state_manager():
+    return SessionStateManager()
+
+def evict_idle_background_tasks(ttl_seconds):
+    """Forget the background work of conversations abandoned for longer than ttl_seconds"""
+    now = time.time()
+    evicted = 0
+    with _background_lock:
+        for session_id, tasks in list(_background_tasks.items()):
+            futures = [task for task in tasks.values() if hasattr(task, "done")]
+            session_path = os.path.join(SESSIONS_DIR, f"{session_id}.json")
+            last_activity = os.path.getmtime(session_path) if os.path.exists(session_path) else 0
+            if all(future.done() for future in futures) and now - last_activity > ttl_seconds:
+                del _background_tasks[session_id]
+                evicted += 1
+    return evicted
+
+def set_session_value(name, value):
+    """Store a possibly large value in session state, spilling it to disk if needed"""
+    st.session_state[name] = get_session_state_manager().put(st.session_state.state_session_key, name, value)
+
+def get_session_value(name, default=None):
+    return get_session_state_manager().get(st.session_state.get(name, default), default)
+
+# Initialize session state variables if they don't exist
+def init_session_state():
+    if "state_session_key" not in st.session_state:
+        # Keyed by Streamlit's own session ID so eviction can ask the runtime whether the session is closed
+        st.session_state.state_session_key = current_streamlit_session_id() or f"{uuid.uuid4()}"
+    if "messages" not in st.session_state:
+        st.session_state.messages = []
+    if "learning_objectives" not in st.session_state:
+        st.session_state.learning_objectives = [""]
+    if "current_question_idx" not in st.session_state:
+        st.session_state.current_question_idx = 0
+    if "conversation_complete" not in st.session_state:
+        st.session_state.conversation_complete = False
+    if "evaluation_complete" not in st.session_state:
+        st.session_state.evaluation_complete = False
+    if "current_question" not in st.session_state:
+        st.session_state.current_question = None
+    if "student_responses" not in st.session_state:
+        st.session_state.student_responses = {}
+
+# Report view models: computed once when an evaluation is saved and cached by evaluation ID,
+# so viewing a report does not re-parse the evaluation store. The lightweight index lists
+# evaluations without loading them.
+EVALUATION_VIEWS_DIR = "data/evaluations"
+
+SCORE_CRITERIA = [
+    "comprehension", "authenticity", "relational_skills", "argumentation",
+    "bibliography_use", "overall_quality"
+]
+
+def truncate_tree(value, max_chars=300, max_items=10, max_depth=4, _depth=0):
+    """Copy of a JSON value with long strings, long lists and deep nesting cut short"""
+    if isinstance(value, dict):
+        if _depth >= max_depth:
+            return "{...}"
+        return {key: truncate_tree(item, max_chars, max_items, max_depth, _depth + 1) for key, item in value.items()}
+    if isinstance(value, list):
+        if _depth >= max_depth:
+            return "[...]"
+        items = [truncate_tree(item, max_chars, max_items, max_depth, _depth + 1) for item in value[:max_items]]
+        if len(value) > max_items:
+            items.append(f"... ({len(value) - max_items} more)")
+        return items
+    if isinstance(value, str) and len(value) > max_chars:
+        return value[:max_chars] + "..."
+    return value
+
+def split_markdown_sections(markdown_text):
+    """Split a markdown report into sections at its headings"""
+    sections = []
+    current = {"title": None, "lines": []}
+    for line in markdown_text.split("\n"):
+        if line.lstrip().startswith("#") and current["lines"]:
+            sections.append(current)
+            current = {"title": None, "lines": []}
+        if line.lstrip().startswith("#") and current["title"] is None:
+            current["title"] = line.lstrip("# ").strip()
+        current["lines"].append(line)
+    if current["lines"]:
+        sections.append(current)
+    return [{"title": section["title"], "markdown": "\n".join(section["lines"]).strip()} for section in sections]
+
+def build_report_view(evaluation_id, report_data):
+    """Precompute what the report viewers display for one stored evaluation"""
+    evaluation_data = report_data.get("evaluation_data", {})
+    structured = evaluation_data.get("structured_evaluation", {})
+    
+    scores = {}
+    for criterion in SCORE_CRITERIA:
+        value = structured.get(criterion)
+        if isinstance(value, dict) and isinstance(value.get("score"), (int, float)):
+            scores[criterion] = value["score"]
+    objective_scores = [
+        {"objective": obj.get("objective"), "score": obj.get("score")}
+        for obj in structured.get("learning_objectives", []) if isinstance(obj, dict)
+    ]
+    
+    return {
+        "evaluation_id": evaluation_id,
+        "assignment_id": evaluation_data.get("assignment_id"),
+        "timestamp": report_data.get("timestamp"),
+        "sections": split_markdown_sections(report_data.get("text_report", "")),
+        "score_card": {
+            "scores": scores,
+            "objectives": objective_scores,
+            "plagiarism_detected": bool(structured.get("plagiarism_detected", False)),
+            "summary": structured.get("summary"),
+            "missing_stages": structured.get("missing_stages", [])
+        },
+        "detail_tree": truncate_tree(evaluation_data)
+    }
+
+def save_report_view(view):
+    save_json(view, os.path.join(EVALUATION_VIEWS_DIR, f"{view['evaluation_id']}.view.json"))
+
+def load_report_view(evaluation_id):
+    """Load the precomputed view of an evaluation, building it for evaluations saved before views existed"""
+    view_path = os.path.join(EVALUATION_VIEWS_DIR, f"{evaluation_id}.view.json")
+    # Cached per version of the view file, which a regrade replaces
+    return _load_report_view(evaluation_id, os.stat(view_path).st_mtime_ns if os.path.exists(view_path) else None)
+
+# Older versions of a regraded view are never asked for again, so only the most recent views are kept
+@st.cache_data(show_spinner=False, max_entries=128)
+def _load_report_view(evaluation_id, view_mtime):
+    view_path = os.path.join(EVALUATION_VIEWS_DIR, f"{evaluation_id}.view.json")
+    if os.path.exists(view_path):
+        with open(view_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    view = build_report_view(evaluation_id, load_stored_evaluation(evaluation_id))
+    save_report_view(view)
+    return view
+
+def render_report_view(view, language, report_label, detail_label, key):
+    """Show a report view; the full evaluation data is only loaded when requested"""
+    score_card = view["score_card"]
+    if score_card["scores"]:
+        columns = st.columns(len(score_card["scores"]))
+        for column, (criterion, score) in zip(columns, score_card["scores"].items()):
+            column.metric(criterion.replace("_", " ").capitalize(), score)
+    if score_card["plagiarism_detected"]:
+        st.warning(get_text("plagiarism_flag", language))
+    if score_card.get("missing_stages"):
+        st.warning(get_text("partial_report_warning", language).format(stages=", ".join(score_card["missing_stages"])))
+    
+    with st.expander(report_label, expanded=True):
+        for section in view["sections"]:
+            st.markdown(section["markdown"])
+    
+    with st.expander(detail_label, expanded=False):
+        if st.toggle(get_text("load_detail_label", language), key=f"{key}_full_detail"):
+            st.json(load_stored_evaluation(view["evaluation_id"])["evaluation_data"])
+        else:
+            st.json(view["detail_tree"], expanded=False)
+
+# Full-text search over the evaluations of a course shard: an inverted index (BM25 ranking) over
+# the report text, the feedback and evidence in structured_evaluation and the student's answers.
+# It is updated as each evaluation is saved and stored next to the shard's evaluations.
+SEARCH_STOPWORDS = {
+    "the", "and", "for", "with", "that", "this", "are", "was", "from", "not", "but", "has", "have",
+    "los", "las", "del", "que", "con", "por", "para", "una", "uno", "como", "más", "mas", "sus",
+    "este", "esta", "son", "sin", "sobre", "entre", "muy", "también", "tambien"
+}
+
+SEARCH_FIELD_WEIGHTS = {"report": 1, "feedback": 1, "evidence": 2, "answers": 1}
+
+def fold_text(text):
+    """Lowercase without accents, character by character so positions are kept"""
+    return "".join(unicodedata.normalize("NFKD", c.lower())[:1] for c in text)
+
+def tokenize(text):
+    """Words for the search index, so "Evaluación" also matches "evaluacion" """
+    return [word for word in re.findall(r"\w+", fold_text(text)) if len(word) > 2 and word not in SEARCH_STOPWORDS]
+
+def searchable_fields(report_data):
+    """Texts of one stored evaluation by search field"""
+    evaluation_data = report_data.get("evaluation_data", {})
+    structured = evaluation_data.get("structured_evaluation", {})
+    feedback = []
+    for value in list(structured.values()) + list(structured.get("learning_objectives", [])):
+        if isinstance(value, dict):
+            feedback.extend(str(value.get(key, "")) for key in ["objective", "examples", "feedback"])
+    return {
+        "report": report_data.get("text_report", ""),
+        "feedback": "\n".join(feedback + [str(structured.get("summary", ""))]),
+        "evidence": str(structured.get("plagiarism_evidence", "")),
+        "answers": "\n".join(
+            item.get("response", "") for item in evaluation_data.get("conversation_data", {}).get("conversation_history", [])
+        )
+    }
+
+class SearchIndex:
+    """Inverted index of one course shard's evaluations, ranked with BM25"""
+    
+    def __init__(self, path, k1=1.2, b=0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.docs = {}  # evaluation_id -> {assignment_id, timestamp, length, terms}
+        self.postings = {}  # term -> {evaluation_id: weighted term frequency}
+        self.version = file_version(path)
+        if self.version is not None:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.docs, self.postings = data["docs"], data["postings"]
+        
+    def add(self, evaluation_id, report_data):
+        """Index (or re-index) one evaluation"""
+        self.remove(evaluation_id)
+        frequencies = {}
+        for field, text in searchable_fields(report_data).items():
+            for term in tokenize(text):
+                frequencies[term] = frequencies.get(term, 0) + SEARCH_FIELD_WEIGHTS[field]
+        for term, frequency in frequencies.items():
+            self.postings.setdefault(term, {})[evaluation_id] = frequency
+        self.docs[evaluation_id] = {
+            "assignment_id": report_data.get("evaluation_data", {}).get("assignment_id"),
+            "timestamp": report_data.get("timestamp"),
+            "length": sum(frequencies.values()),
+            "terms": sorted(frequencies)
+        }
+        
+    def remove(self, evaluation_id):
+        doc = self.docs.pop(evaluation_id, None)
+        if doc is None:
+            return
+        # Only the evaluation's own terms (indexes saved before "terms" existed scan them all)
+        for term in doc.get("terms", list(self.postings)):
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+            postings.pop(evaluation_id, None)
+            if not postings:
+                del self.postings[term]
+        
+    def save(self):
+        """Write the index; callers hold its file lock (see index_evaluation)"""
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"docs": self.docs, "postings": self.postings}, f)
+        os.replace(tmp_path, self.path)
+        self.version = file_version(self.path)
         
-        # Step 3: Evaluate overall quality
-        prompt_part3 = ChatPromptTemplate.from_messages([
-            SystemMessagePromptTemplate.from_template(system_prompt),
-            HumanMessagePromptTemplate.from_template(
-                self.prompt_part3_templates.get(language, self.prompt_part3_templates["Español"])
-            )
-        ])
+    def search(self, query, assignment_id=None, date_from=None, date_to=None, limit=20):
+        """Rank evaluations for a query; returns [(evaluation_id, score)], best first.
         
-        chain_part3 = LLMChain(llm=self.llm, prompt=prompt_part3)
-        evaluation_part3 = chain_part3.run(
-            assignment_text=assignment_text,
-            submission_text=submission_text,
-            conversation_details=conversation_details
-        )
+        Words in double quotes must all appear. Dates are ISO strings (YYYY-MM-DD)
+        compared against the evaluation timestamp.
+        """
+        required = set(tokenize(" ".join(re.findall(r'"([^"]*)"', query))))
+        terms = set(tokenize(query))
+        if not terms or not self.docs:
+            return []
         
-        # Get section headers based on language
-        headers = self.section_headers.get(language, self.section_headers["Español"])
+        def included(evaluation_id):
+            doc = self.docs[evaluation_id]
+            timestamp = (doc["timestamp"] or "")[:10]
+            return (
+                (assignment_id is None or doc["assignment_id"] == assignment_id)
+                and (date_from is None or timestamp >= date_from)
+                and (date_to is None or timestamp <= date_to)
+                and all(evaluation_id in self.postings.get(term, {}) for term in required)
+            )
         
-        # Combine all evaluations
-        evaluation = (
-            f"{headers['comprehension']}\n" + evaluation_part1 + 
-            f"\n\n{headers['objectives']}\n" + evaluation_part2 +
-            f"\n\n{headers['overall']}\n" + evaluation_part3
-        )
+        average_length = sum(doc["length"] for doc in self.docs.values()) / len(self.docs) or 1
+        scores = {}
+        for term in terms:
+            postings = self.postings.get(term, {})
+            idf = math.log(1 + (len(self.docs) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for evaluation_id, frequency in postings.items():
+                length = self.docs[evaluation_id]["length"]
+                scores[evaluation_id] = scores.get(evaluation_id, 0) + idf * frequency * (self.k1 + 1) / (
+                    frequency + self.k1 * (1 - self.b + self.b * length / average_length)
+                )
         
+        ranked = sorted(
+            ((evaluation_id, score) for evaluation_id, score in scores.items() if included(evaluation_id)),
+            key=lambda item: item[1], reverse=True
+        )
+        return [(evaluation_id, round(score, 3)) for evaluation_id, score in ranked[:limit]]
+
+_search_indexes = {}
+_search_lock = threading.Lock()
+
+def _current_search_index(shard, path):
+    """The shard's index as last saved by any process, built if missing; call with _search_lock and its file lock"""
+    index = _search_indexes.get(shard)
+    if index is None or index.version != file_version(path):
+        index = SearchIndex(path)
+        if index.version is None:
+            for evaluation_id, report_data in get_shard_cache().get(shard, "evaluations").items():
+                index.add(evaluation_id, report_data)
+            index.save()
+        _search_indexes[shard] = index
+    return index
+
+def get_search_index(shard):
+    """The search index of a course shard, built from its evaluations the first time"""
+    path = os.path.join(SHARDS_DIR, shard, "search_index.json")
+    with _search_lock:
+        index = _search_indexes.get(shard)
+        if index is not None and index.version == file_version(path):
+            return index
+        with file_lock(path):
+            return _current_search_index(shard, path)
+
+def index_evaluation(shard, evaluation_id, report_data):
+    """Add a newly saved evaluation to its shard's search index"""
+    path = os.path.join(SHARDS_DIR, shard, "search_index.json")
+    # Re-read under the file lock if another process saved since, so its additions are kept
+    with _search_lock, file_lock(path):
+        index = _current_search_index(shard, path)
+        index.add(evaluation_id, report_data)
+        index.save()
+
+def search_snippet(view, query, width=160):
+    """A short piece of the report around the first query word it contains"""
+    terms = tokenize(query)
+    for section in view["sections"]:
+        text = section["markdown"]
+        folded = fold_text(text)
+        positions = [folded.find(term) for term in terms if term in folded]
+        if positions:
+            start = max(0, min(positions) - width // 2)
+            return ("..." if start else "") + text[start:start + width].replace("\n", " ") + "..."
+    return ""
+
+# Independently rerunning parts of the page (st.fragment): interacting with them only
+# re-executes the fragment instead of the whole script
+
+@st.fragment
+def teacher_search_fragment(language, shard):
+    """Search box over the course's evaluations, with assignment and date filters"""
+    with profile_fragment("fragment:teacher_search"):
+        query = st.text_input(get_text("search_label", language), key="report_search_query")
+        if not query.strip():
+            return
         
+        assignments = get_shard_cache().get(shard, "assignments")
+        filter_col, date_col = st.columns(2)
+        with filter_col:
+            assignment_filter = st.selectbox(
+                get_text("select_assignment", language),
+                options=[None] + list(assignments.keys()),
+                format_func=lambda x: get_text("all_assignments", language) if x is None else assignments[x]["name"],
+                key="report_search_assignment"
+            )
+        with date_col:
+            date_range = st.date_input(get_text("search_dates_label", language), value=(), key="report_search_dates")
         
-        # Generate a structured evaluation result
-        prompt_structured_templates = {
-            "English": "Evaluation:\n{evaluation}\n\n"
-                     "Convert this into a JSON structure with the following keys:\n"
-                     "- comprehension: {{score: (number 0-100), examples: (text with examples), feedback: (constructive feedback)}}\n"
-                     "- authenticity: {{score: (number 0-100), examples: (text with examples), feedback: (constructive feedback)}}\n"
-                     "- relational_skills: {{score: (number 0-100), examples: (text with examples), feedback: (constructive feedback)}}\n"
-                     "- argumentation: {{score: (number 0-100), examples: (text with examples), feedback: (constructive feedback)}}\n"
-                     "- bibliography_use: {{score: (number 0-100), examples: (text with examples), feedback: (constructive feedback)}}\n"
-                     "- learning_objectives: [{{objective: (text of objective), score: (number 0-100), examples: (text with examples), feedback: (constructive feedback)}}]\n"
-                     "- overall_quality: {{score: (number 0-100), examples: (text with examples), feedback: (constructive feedback)}}\n"
-                     "- plagiarism_detected: (boolean true/false)\n"
-                     "- plagiarism_evidence: (text explaining evidence of plagiarism if detected)\n"
-                     "- response_time_analysis: (text analyzing if response times are consistent with content)\n"
-                     "- summary: (A brief summary of the evaluation)",
-                     
-            "Español": "Evaluación:\n{evaluation}\n\n"
-                      "Convierte esto en una estructura JSON con las siguientes claves:\n"
-                      "- comprehension: {{score: (número 0-100), examples: (texto con ejemplos), feedback: (retroalimentación constructiva)}}\n"
-                      "- authenticity: {{score: (número 0-100), examples: (texto con ejemplos), feedback: (retroalimentación constructiva)}}\n"
-                      "- relational_skills: {{score: (número 0-100), examples: (texto con ejemplos), feedback: (retroalimentación constructiva)}}\n"
-                      "- argumentation: {{score: (número 0-100), examples: (texto con ejemplos), feedback: (retroalimentación constructiva)}}\n"
-                      "- bibliography_use: {{score: (número 0-100), examples: (texto con ejemplos), feedback: (retroalimentación constructiva)}}\n"
-                      "- learning_objectives: [{{objective: (texto del objetivo), score: (número 0-100), examples: (texto con ejemplos), feedback: (retroalimentación constructiva)}}]\n"
-                      "- overall_quality: {{score: (número 0-100), examples: (texto con ejemplos), feedback: (retroalimentación constructiva)}}\n"
-                      "- plagiarism_detected: (booleano true/false)\n"
-                      "- plagiarism_evidence: (texto explicando evidencia de plagio si se detectó)\n"
-                      "- response_time_analysis: (texto analizando si los tiempos de respuesta son consistentes con el contenido)\n"
-                      "- summary: (Un breve resumen de la evaluación)"
-        }
+        date_from = date_to = None
+        if len(date_range) == 2:
+            date_from, date_to = date_range[0].isoformat(), date_range[1].isoformat()
         
-        system_prompt_structured = {
-            "English": "You are an AI assistant that structures evaluation data. Convert the following evaluation into a structured JSON format with the exact keys expected.",
-            "Español": "Eres un asistente de IA que estructura datos de evaluación. Convierte la siguiente evaluación en un formato JSON estructurado con las claves exactas esperadas."
-        }
+        start = time.perf_counter()
+        results = get_search_index(shard).search(query, assignment_filter, date_from, date_to)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        st.caption(get_text("search_results", language).format(count=len(results), ms=f"{elapsed_ms:.1f}"))
         
-        prompt_structured = ChatPromptTemplate.from_messages([
-            SystemMessagePromptTemplate.from_template(
-                system_prompt_structured.get(language, system_prompt_structured["Español"])
-            ),
-            HumanMessagePromptTemplate.from_template(
-                prompt_structured_templates.get(language, prompt_structured_templates["Español"])
+        if results:
+            evaluations = load_evaluation_index(shard)
+            result_select = st.radio(
+                get_text("search_results_label", language),
+                options=[evaluation_id for evaluation_id, _ in results],
+                format_func=lambda x: (
+                    f"{assignments.get(evaluations.get(x, {}).get('assignment_id'), {}).get('name', 'Unknown Assignment')} · "
+                    f"{evaluations.get(x, {}).get('timestamp', '')[:16]} — {search_snippet(load_report_view(x), query)}"
+                ),
+                key="report_search_result"
             )
-        ])
+            render_report_view(
+                load_report_view(result_select),
+                language,
+                get_text("eval_report_label", language),
+                get_text("detailed_eval_label", language),
+                key="search_report"
+            )
+
+@st.fragment
+def teacher_usage_fragment(language, shard):
+    """Metered usage of one course's assignments and their sessions against the quotas"""
+    with profile_fragment("fragment:teacher_usage"):
+        st.subheader(get_text("usage_title", language))
+        meter = get_usage_meter()
+        stats = meter.stats()
+        columns = st.columns(4)
+        columns[0].metric(get_text("usage_admitted", language), stats["admitted"])
+        columns[1].metric(get_text("usage_queued", language), stats["queued"])
+        columns[2].metric(get_text("usage_rejected", language), stats["rejected"])
+        columns[3].metric(get_text("usage_mean_wait", language), stats["mean_wait_seconds"] or 0)
         
-        chain_structured = LLMChain(llm=self.llm, prompt=prompt_structured)
-        structured_evaluation = chain_structured.run(evaluation=evaluation)
+        # Only this course's assignments and their sessions; API keys are shared across courses
+        assignments = get_shard_cache().get(shard, "assignments")
+        rows = meter.report(set(assignments))
+        if not rows:
+            st.info(get_text("usage_empty", language))
+            return
+        # Show assignment names instead of their IDs
+        for row in rows:
+            kind, _, scope_id = row["scope"].partition(":")
+            if kind == "assignment":
+                row["scope"] = f"assignment: {assignments[scope_id]['name']}"
+        st.dataframe(rows, hide_index=True)
+
+@st.fragment
+def teacher_reports_fragment(language, shard):
+    """Teacher report viewer for one course shard, rerun on its own when a selection changes"""
+    with profile_fragment("fragment:teacher_reports"):
+        st.subheader(get_text("view_evals_title", language))
         
-        # Try to parse the JSON from the response
-        try:
-            # Sometimes the response might include markdown code blocks, try to extract just the JSON
-            json_text = structured_evaluation
+        evaluations = load_evaluation_index(shard)
+        if not evaluations:
+            st.info(get_text("no_evals", language))
+        else:
+            # Group evaluations by assignment
+            evaluations_by_assignment = {}
+            for eval_id, eval_data in evaluations.items():
+                assignment_id = eval_data["assignment_id"]
+                if assignment_id not in evaluations_by_assignment:
+                    evaluations_by_assignment[assignment_id] = []
+                evaluations_by_assignment[assignment_id].append((eval_id, eval_data))
             
-            # If the response includes a code block with json, extract just the JSON
-            if "```json" in structured_evaluation:
-                json_blocks = structured_evaluation.split("```json")
-                if len(json_blocks) > 1:
-                    json_content = json_blocks[1].split("```")[0].strip()
-                    json_text = json_content
-            elif "```" in structured_evaluation:
-                json_blocks = structured_evaluation.split("```")
-                if len(json_blocks) > 1:
-                    json_content = json_blocks[1].strip()
-                    json_text = json_content
+            # Load assignments for names
+            assignments = get_shard_cache().get(shard, "assignments")
             
-            structured_data = json.loads(json_text)
+            # Create a selectbox for assignments with evaluations
+            assignment_options = list(evaluations_by_assignment.keys())
+            assignment_names = [
+                assignments.get(a_id, {}).get("name", f"Unknown Assignment ({a_id})") 
+                for a_id in assignment_options
+            ]
             
-            # Ensure the required keys exist
-            required_keys = ["comprehension", "authenticity", "relational_skills", "argumentation", 
-                          "bibliography_use", "learning_objectives", "overall_quality", 
-                          "plagiarism_detected", "plagiarism_evidence", "response_time_analysis", "summary"]
+            assignment_select = st.selectbox(
+                get_text("select_assignment", language),
+                options=assignment_options,
+                format_func=lambda x: assignments.get(x, {}).get("name", f"Unknown Assignment ({x})"),
+                key="view_reports_assignment_select"
+            )
             
-            for key in required_keys:
-                if key not in structured_data:
-                    if key in ["plagiarism_detected"]:
-                        structured_data[key] = False
-                    elif key in ["plagiarism_evidence", "response_time_analysis", "summary"]:
-                        structured_data[key] = "No disponible"
-                    else:
-                        structured_data[key] = {"score": 50, "examples": "No disponible", "feedback": "No disponible"}
-                    
-            # Ensure each objective has required fields
-            for obj in structured_data.get("learning_objectives", []):
-                for field in ["objective", "score", "examples", "feedback"]:
-                    if field not in obj:
-                        obj[field] = "No disponible" if field != "score" else 50
-                        
-        except json.JSONDecodeError:
-            # If parsing fails, create a simpler structure
-            structured_data = {
-                "raw_evaluation": evaluation,
-                "comprehension": {"score": 50, "examples": "Error de formato de evaluación", "feedback": "Error de formato de evaluación"},
-                "authenticity": {"score": 50, "examples": "Error de formato de evaluación", "feedback": "Error de formato de evaluación"},
-                "relational_skills": {"score": 50, "examples": "Error de formato de evaluación", "feedback": "Error de formato de evaluación"},
-                "argumentation": {"score": 50, "examples": "Error de formato de evaluación", "feedback": "Error de formato de evaluación"},
-                "bibliography_use": {"score": 50, "examples": "Error de formato de evaluación", "feedback": "Error de formato de evaluación"},
-                "learning_objectives": [{"objective": obj, "score": 50, "examples": "Error de formato de evaluación", "feedback": "Error de formato de evaluación"} for obj in learning_objectives],
-                "overall_quality": {"score": 50, "examples": "Error de formato de evaluación", "feedback": "Error de formato de evaluación"},
-                "plagiarism_detected": False,
-                "plagiarism_evidence": "No se pudo evaluar el plagio debido a un error en el formato",
-                "response_time_analysis": "No se pudo analizar los tiempos de respuesta debido a un error en el formato",
-                "summary": "Hubo un error en el formato de los resultados de la evaluación."
-            }
-        
-        return {
-            "timestamp": datetime.now().isoformat(),
-            "raw_evaluation": evaluation,
-            "structured_evaluation": structured_data,
-            "assignment_id": os.path.basename(assignment_file_path),
-            "learning_objectives": learning_objectives,
-            "conversation_data": conversation_data
-        }
+            if assignment_select:
+                st.markdown(f"### {get_text('reports_for', language)}{assignments.get(assignment_select, {}).get('name', 'Unknown Assignment')}")
+                
+                # List evaluations for the selected assignment
+                evals_for_assignment = evaluations_by_assignment[assignment_select]
+                eval_options = [e[0] for e in evals_for_assignment]
+                eval_select = st.selectbox(
+                    get_text("select_eval", language),
+                    options=eval_options,
+                    format_func=lambda x: f"{get_text('report_from', language)}{evaluations[x]['timestamp']}",
+                    key="view_reports_eval_select"
+                )
+                
+                if eval_select:
+                    render_report_view(
+                        load_report_view(eval_select),
+                        language,
+                        get_text("eval_report_label", language),
+                        get_text("detailed_eval_label", language),
+                        key="teacher_report"
+                    )
 
-class ReportGenerator:
-    """Agent that generates a comprehensive report based on the evaluation"""
-    
-    def __init__(self, llm):
-        self.llm = llm
-        self.system_prompts = {
-            "English": """You are an expert educational report generator.
-            Your task is to create clear, comprehensive, and constructive reports based on student evaluations.
-            Focus on providing actionable feedback that will help the student improve.""",
-            
-            "Español": """Eres un experto generador de informes educativos.
-            Tu tarea es crear informes claros, completos y constructivos basados en evaluaciones de estudiantes.
-            Concéntrate en proporcionar retroalimentación procesable que ayude al estudiante a mejorar.
-            Incluye análisis detallado sobre la originalidad del trabajo, la evidencia de posible plagio, 
-            y cómo los tiempos de respuesta se relacionan con la calidad y autenticidad del trabajo."""
-        }
+@st.fragment
+def evaluation_chat_fragment(service):
+    """Student evaluation chat, rerun on its own when the student answers"""
+    with profile_fragment("fragment:evaluation_chat"):
+        st.subheader("Evaluation Conversation")
         
-        self.prompt_templates = {
-            "English": "Evaluation Data:\n{evaluation_json}\n\n"
-                     "Generate a comprehensive educational assessment report with the following sections:\n"
-                     "1. Executive Summary - Brief overview of strengths and areas for improvement\n"
-                     "2. Assessment of Learning Objectives - Detailed evaluation for each objective\n"
-                     "3. Comprehension Analysis - Evaluation of conceptual understanding\n"
-                     "4. Authenticity Assessment - Evaluation of originality and personal engagement\n"
-                     "5. Overall Quality - General assessment of the work\n"
-                     "6. Recommendations - Specific, actionable suggestions for improvement\n\n"
-                     "The report should be professional but encouraging. Use specific examples from the student's work and responses.",
-                     
-            "Español": "Datos de evaluación:\n{evaluation_json}\n\n"
-                      "Genera un informe de evaluación educativa completo con las siguientes secciones:\n"
-                      "1. Resumen ejecutivo - Breve descripción de fortalezas y áreas de mejora\n"
-                      "2. Evaluación de objetivos de aprendizaje - Evaluación detallada para cada objetivo\n"
-                      "3. Análisis de comprensión - Evaluación de la comprensión conceptual\n"
-                      "4. Evaluación de autenticidad - Evaluación de originalidad y compromiso personal\n"
-                      "5. Análisis de habilidades relacionales - Evaluación de cómo el estudiante conecta ideas\n"
-                      "6. Evaluación de argumentación - Calidad de la estructura y fundamentación de argumentos\n"
-                      "7. Uso de bibliografía - Evaluación de referencias y fuentes utilizadas\n"
-                      "8. Análisis de tiempos de respuesta - Coherencia entre tiempo y calidad de respuestas\n"
-                      "9. Detección de plagio - Hallazgos sobre posible contenido no original\n"
-                      "10. Calidad general - Evaluación general del trabajo\n"
-                      "11. Recomendaciones - Sugerencias específicas y procesables para mejorar\n\n"
-                      "El informe debe ser profesional pero alentador. Usa ejemplos específicos del trabajo y las respuestas del estudiante."
-        }
+        # Display the conversation history (kept on disk once it grows, see SessionStateManager)
+        messages = get_session_value("messages", [])
+        for message in messages:
+            with st.chat_message(message["role"]):
+                st.write(message["content"])
         
-    def generate_report(self, evaluation_data):
-        """Generate a comprehensive report from evaluation data"""
-        # Determine language from conversation data
-        language = evaluation_data.get("conversation_data", {}).get("language", "Español")
+        # If the conversation is not complete, show the current question
+        if not st.session_state.conversation_complete:
+            if st.session_state.current_question:
+                # Display the current question from the assistant
+                with st.chat_message("assistant"):
+                    current_question = st.session_state.current_question
+                    st.write(current_question)
+                    # Add to messages if it's not already there
+                    if len(messages) == 0 or messages[-1]["content"] != current_question:
+                        messages.append({"role": "assistant", "content": current_question})
+                        set_session_value("messages", messages)
+                
+                # Get user response with chat input
+                user_response = st.chat_input("Your response")
+                if user_response:
+                    # Add user response to messages
+                    messages.append({"role": "user", "content": user_response})
+                    set_session_value("messages", messages)
+                    
+                    # Save the response and move to the next question
+                    student_responses = get_session_value("student_responses", {})
+                    student_responses[current_question] = user_response
+                    set_session_value("student_responses", student_responses)
+                    try:
+                        reply = service.submit_answer(st.session_state.service_session_id, user_response)
+                    except QuotaExceeded as e:
+                        # The answer was not recorded; the student can send it again later
+                        messages.pop()
+                        set_session_value("messages", messages)
+                        st.warning(str(e))
+                        st.stop()
+                    st.session_state.current_question_idx += 1
+                    st.session_state.current_question = reply["question"]
+                    
+                    # Check if we've reached the end of questions
+                    if reply["done"]:
+                        st.session_state.conversation_complete = True
+                        
+                        # Add final message
+                        messages.append({
+                            "role": "assistant", 
+                            "content": reply["message"]
+                        })
+                        set_session_value("messages", messages)
+                        
+                        # Wait for the evaluation started by the service
+                        with st.spinner("Generating evaluation..."):
+                            result = service.get_evaluation(st.session_state.service_session_id)
+                        
+                        if result["status"] == "complete":
+                            # Store for display
+                            st.session_state.evaluation_complete = True
+                            # Only the ID is kept; the report is read from its cached view
+                            st.session_state.evaluation_id = result["evaluation_id"]
+                        elif result["status"] == "awaiting_batch":
+                            st.session_state.evaluation_deferred = True
+                        else:
+                            st.session_state.evaluation_error = result.get("error", result["status"])
+                    
+                    # Rerun only the chat while answering; once the evaluation is done,
+                    # rerun the whole page so the evaluation lists include it
+                    if st.session_state.conversation_complete:
+                        st.rerun()
+                    try:
+                        st.rerun(scope="fragment")
+                    except StreamlitAPIException:
+                        # The answer came in a full-page run (e.g. from AppTest), not a fragment rerun
+                        st.rerun()
         
-        system_prompt = self.system_prompts.get(language, self.system_prompts["Español"])
-        prompt_template = self.prompt_templates.get(language, self.prompt_templates["Español"])
+        if st.session_state.get("evaluation_error"):
+            st.error(f"Evaluation failed: {st.session_state.evaluation_error}")
         
-        prompt = ChatPromptTemplate.from_messages([
-            SystemMessagePromptTemplate.from_template(system_prompt),
-            HumanMessagePromptTemplate.from_template(prompt_template)
-        ])
+        # Batch-graded assignments are evaluated later
+        if st.session_state.get("evaluation_deferred"):
+            st.info(get_text("evaluation_deferred", st.session_state.interface_language))
         
-        evaluation_json = json.dumps(evaluation_data["structured_evaluation"], indent=2)
+        # Show evaluation results if complete
+        if st.session_state.evaluation_complete:
+            st.success("Evaluation complete! Here's your assessment report:")
+            
+            with st.expander("Evaluation Report", expanded=True):
+                for section in load_report_view(st.session_state.evaluation_id)["sections"]:
+                    st.markdown(section["markdown"])
         
-        chain = LLMChain(llm=self.llm, prompt=prompt)
-        try:
-            report = chain.run(evaluation_json=evaluation_json)
-        except Exception as e:
-            logging.error(f"Error generando el informe: {e}")
-            report = "Error generando el informe."
+        if st.session_state.evaluation_complete or st.session_state.get("evaluation_deferred"):
+            if st.button("Start a New Submission"):
+                # Reset all conversation and evaluation state
+                for key in ["conversation_started", "conversation_complete", 
+                           "evaluation_complete", "evaluation_id", "service_session_id",
+                           "current_assignment_id", "messages", "current_question", 
+                           "student_responses", "current_question_idx",
+                           "evaluation_error", "evaluation_deferred"]:
+                    if key in st.session_state:
+                        del st.session_state[key]
+                st.rerun()
 
+@st.fragment
+def student_evaluations_fragment(language, shard):
+    """Student report viewer for one course shard, rerun on its own when a selection changes"""
+    with profile_fragment("fragment:student_evaluations"):
+        st.subheader("View Your Evaluations")
         
-        return {
-            "text_report": report,
-            "evaluation_data": evaluation_data,
-            "timestamp": datetime.now().isoformat(),
-            "language": language
-        }
-
-# Initialize session state variables if they don't exist
-def init_session_state():
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
-    if "learning_objectives" not in st.session_state:
-        st.session_state.learning_objectives = [""]
-    if "current_question_idx" not in st.session_state:
-        st.session_state.current_question_idx = 0
-    if "conversation_complete" not in st.session_state:
-        st.session_state.conversation_complete = False
-    if "evaluation_complete" not in st.session_state:
-        st.session_state.evaluation_complete = False
-    if "questions" not in st.session_state:
-        st.session_state.questions = []
-    if "student_responses" not in st.session_state:
-        st.session_state.student_responses = {}
+        # This would normally be filtered by student ID
+        # For demo purposes, we'll show all evaluations of the course
+        evaluations = load_evaluation_index(shard)
+        
+        if not evaluations:
+            st.info("No evaluations available yet. Submit an assignment to get evaluated.")
+        else:
+            # Load assignments for names
+            assignments = get_shard_cache().get(shard, "assignments")
+            
+            eval_options = list(evaluations.keys())
+            eval_select = st.selectbox(
+                get_text("select_eval", language),
+                options=eval_options,
+                format_func=lambda x: (
+                    f"{get_text('report_for', language)}{assignments.get(evaluations[x]['assignment_id'], {}).get('name', 'Unknown Assignment')} "
+                    f"{get_text('report_from', language)}{evaluations[x]['timestamp']}"
+                ),
+                key="student_view_eval_select"
+            )
+            
+            if eval_select:
+                assignment_id = evaluations[eval_select]["assignment_id"]
+                assignment_name = assignments.get(assignment_id, {}).get("name", "Unknown Assignment")
+                
+                st.markdown(f"## Evaluation Report for {assignment_name}")
+                
+                render_report_view(
+                    load_report_view(eval_select),
+                    language,
+                    "Report",
+                    "Detailed Evaluation Data",
+                    key="student_report"
+                )
 
 # Application interface
 def run_app():
+    profile_lap("setup")
     setup_directories()
     init_session_state()
     
+    # Track this session's memory and evict sessions that have gone idle
+    session_state_manager = get_session_state_manager()
+    session_state_manager.touch(st.session_state.state_session_key)
+    session_state_manager.evict_idle()
+    
     # Set Spanish as the default language
     if "interface_language" not in st.session_state:
         st.session_state.interface_language = "Español"
@@ -822,43 +4694,79 @@ def run_app():
     st.title(get_text("app_title", language))
     
     # Sidebar for OpenAI API Key
+    profile_lap("sidebar")
     with st.sidebar:
-        openai_api_key = st.text_input(get_text("api_key_label", language), type="password")
-        if not openai_api_key:
-            st.warning(get_text("api_key_warning", language))
+        openai_api_key = configured_llm_api_key()
+        if openai_api_key is None:
+            openai_api_key = st.text_input(get_text("api_key_label", language), type="password")
+            if not openai_api_key:
+                st.warning(get_text("api_key_warning", language))
+        else:
+            st.caption(get_text("llm_backend_caption", language).format(
+                backend=os.environ.get("LLM_BASE_URL") or os.environ.get("LLM_BACKEND")
+            ))
         
         st.subheader(get_text("user_role_label", language))
         user_role = st.radio(
             get_text("user_role_label", language), 
             [get_text("teacher_role", language), get_text("student_role", language)]
         )
+        
+        if profiling_enabled() and st.checkbox(get_text("profile_summary_label", language)):
+            profile_summary = summarize_rerun_profiles()
+            st.caption(f"{profile_summary['reruns']} reruns")
+            st.dataframe(profile_summary["sections"][:15], hide_index=True)
+            st.dataframe(profile_summary["sessions"][:15], hide_index=True)
+            if hedging_enabled():
+                st.json(get_hedging_policy().stats())
+        
+        if profiling_enabled() and st.checkbox(get_text("session_memory_label", language)):
+            session_state_manager.measure(st.session_state.state_session_key, st.session_state)
+            st.dataframe(session_state_manager.report()[:25], hide_index=True)
     
     if not openai_api_key:
         st.info(get_text("api_key_info", language))
         return
     
-    # Initialize LLM
-    llm = ChatOpenAI(
-        model_name="gpt-3.5-turbo-16k",  # Using a model with larger context window
-        temperature=0.2,
-        openai_api_key=openai_api_key
-    )
+    # Initialize the model router (one model per agent stage, see DEFAULT_MODEL_ROUTES)
+    profile_lap("agent_construction")
+    router = ModelRouter(openai_api_key)
+    service = EvaluationService(router)
+    
+    # Only the selected course's shard is loaded
+    courses = service.list_courses() or {shard_key(DEFAULT_COURSE): {"course": DEFAULT_COURSE, "term": None}}
+    with st.sidebar:
+        course_shard = st.selectbox(
+            get_text("course_label", language),
+            options=list(courses.keys()),
+            format_func=lambda x: " · ".join(part for part in [courses[x]["course"], courses[x].get("term")] if part),
+            key="course_select"
+        )
     
     # Teacher Interface
     if user_role == get_text("teacher_role", language):
         st.header(get_text("teacher_dashboard", language))
         
-        tab1, tab2, tab3 = st.tabs([
+        tab1, tab2, tab3, tab4 = st.tabs([
             get_text("create_tab", language), 
             get_text("view_tab", language), 
-            get_text("reports_tab", language)
+            get_text("reports_tab", language),
+            get_text("usage_tab", language)
         ])
         
         with tab1:
+            profile_lap("teacher.create_tab")
             st.subheader(get_text("create_new", language))
             
             # Assignment details
             assignment_name = st.text_input(get_text("assignment_name", language))
+            
+            # Course and term, which decide the shard the assignment is stored in
+            course_col, term_col = st.columns(2)
+            with course_col:
+                assignment_course = st.text_input(get_text("course_label", language), value=courses[course_shard]["course"])
+            with term_col:
+                assignment_term = st.text_input(get_text("term_label", language), value=courses[course_shard].get("term") or "")
             assignment_instructions = st.text_area(get_text("assignment_instructions", language), height=200)
             
             # Number of questions
@@ -904,33 +4812,66 @@ def run_app():
             # Upload assignment file (optional)
             uploaded_file = st.file_uploader(get_text("upload_label", language), type=["pdf", "docx", "txt"])
             
+            objective_fanout = st.checkbox(
+                get_text("objective_fanout_label", language),
+                value=False,
+                help=get_text("objective_fanout_help", language),
+                key="objective_fanout_input"
+            )
+            
+            batch_grading = st.checkbox(
+                get_text("batch_grading_label", language),
+                value=False,
+                help=get_text("batch_grading_help", language),
+                key="batch_grading_input"
+            )
+            
+            # Per-stage model overrides for this assignment (optional)
+            with st.expander(get_text("model_routes_label", language), expanded=False):
+                model_routes_text = st.text_area(
+                    get_text("model_routes_label", language),
+                    value="",
+                    placeholder='{"evaluation.objectives": {"model": "gpt-4o", "max_tokens": 1500, "timeout": 90}}',
+                    help=get_text("model_routes_help", language),
+                    key="model_routes_input"
+                )
+            
             if st.button(get_text("create_btn", language)):
+                model_routes = None
+                model_routes_valid = True
+                if model_routes_text.strip():
+                    try:
+                        model_routes = json.loads(model_routes_text)
+                        model_routes_valid = isinstance(model_routes, dict) and all(
+                            isinstance(route, dict) for route in model_routes.values()
+                        )
+                    except json.JSONDecodeError:
+                        model_routes_valid = False
+                
                 if not assignment_name or not assignment_instructions or not st.session_state.learning_objectives[0]:
                     st.error(get_text("fields_error", language))
+                elif not model_routes_valid:
+                    st.error(get_text("model_routes_error", language))
                 else:
-                    # Create assignment data
-                    assignment_id = f"{uuid.uuid4()}"
-                    assignment_data = {
-                        "id": assignment_id,
-                        "name": assignment_name,
-                        "instructions": assignment_instructions,
-                        "learning_objectives": [obj for obj in st.session_state.learning_objectives if obj],
-                        "created_at": datetime.now().isoformat(),
-                        "file_path": None,
-                        "num_questions": num_questions,
-                        "language": assignment_language
-                    }
-                    
                     # Save uploaded file if provided
+                    file_path = None
                     if uploaded_file:
                         file_path = save_uploaded_file(uploaded_file, "data/assignments")
-                        assignment_data["file_path"] = file_path
                     
-                    # Save assignment data
-                    assignments_file = "data/assignments.json"
-                    assignments = load_json(assignments_file)
-                    assignments[assignment_id] = assignment_data
-                    save_json(assignments, assignments_file)
+                    # Create and save assignment data
+                    service.create_assignment(
+                        assignment_name,
+                        assignment_instructions,
+                        st.session_state.learning_objectives,
+                        num_questions=num_questions,
+                        language=assignment_language,
+                        file_path=file_path,
+                        model_routes=model_routes,
+                        objective_fanout=objective_fanout,
+                        course=assignment_course.strip() or None,
+                        term=assignment_term.strip() or None,
+                        batch_grading=batch_grading
+                    )
                     
                     success_msg = get_text("created_success", language).format(name=assignment_name)
                     st.success(success_msg)
@@ -939,9 +4880,10 @@ def run_app():
                     st.session_state.learning_objectives = [""]
         
         with tab2:
+            profile_lap("teacher.view_tab")
             st.subheader(get_text("view_tab", language))
             
-            assignments = load_json("data/assignments.json")
+            assignments = service.list_assignments(course_shard)
             if not assignments:
                 st.info(get_text("no_assignments", language))
             else:
@@ -967,6 +4909,11 @@ def run_app():
                     if assignment["file_path"]:
                         with st.expander(get_text("file_label", language), expanded=True):
                             st.write(f"{get_text('file_prefix', language)}{os.path.basename(assignment['file_path'])}")
+                            if assignment.get("reference_digest"):
+                                st.caption(get_text("reference_digest_label", language).format(
+                                    tokens=assignment.get("reference_digest_tokens", "?")
+                                ))
+                                st.markdown(assignment["reference_digest"])
                     
                     st.markdown(f"#### {get_text('id_label', language)}")
                     st.code(assignment["id"])
@@ -975,64 +4922,18 @@ def run_app():
                     st.write(assignment["created_at"])
                     
                     if st.button(get_text("delete_btn", language)):
-                        del assignments[assignment_select]
-                        save_json(assignments, "data/assignments.json")
+                        service.delete_assignment(assignment_select)
                         st.success(get_text("deleted_success", language))
                         st.rerun()
         
         with tab3:
-            st.subheader(get_text("view_evals_title", language))
-            
-            evaluations = load_json("data/evaluations.json") if os.path.exists("data/evaluations.json") else {}
-            if not evaluations:
-                st.info(get_text("no_evals", language))
-            else:
-                # Group evaluations by assignment
-                evaluations_by_assignment = {}
-                for eval_id, eval_data in evaluations.items():
-                    assignment_id = eval_data["evaluation_data"]["assignment_id"]
-                    if assignment_id not in evaluations_by_assignment:
-                        evaluations_by_assignment[assignment_id] = []
-                    evaluations_by_assignment[assignment_id].append((eval_id, eval_data))
-                
-                # Load assignments for names
-                assignments = load_json("data/assignments.json")
-                
-                # Create a selectbox for assignments with evaluations
-                assignment_options = list(evaluations_by_assignment.keys())
-                assignment_names = [
-                    assignments.get(a_id, {}).get("name", f"Unknown Assignment ({a_id})") 
-                    for a_id in assignment_options
-                ]
-                
-                assignment_select = st.selectbox(
-                    get_text("select_assignment", language),
-                    options=assignment_options,
-                    format_func=lambda x: assignments.get(x, {}).get("name", f"Unknown Assignment ({x})"),
-                    key="view_reports_assignment_select"
-                )
-                
-                if assignment_select:
-                    st.markdown(f"### {get_text('reports_for', language)}{assignments.get(assignment_select, {}).get('name', 'Unknown Assignment')}")
-                    
-                    # List evaluations for the selected assignment
-                    evals_for_assignment = evaluations_by_assignment[assignment_select]
-                    eval_options = [e[0] for e in evals_for_assignment]
-                    eval_select = st.selectbox(
-                        get_text("select_eval", language),
-                        options=eval_options,
-                        format_func=lambda x: f"{get_text('report_from', language)}{evaluations[x]['timestamp']}",
-                        key="view_reports_eval_select"
-                    )
-                    
-                    if eval_select:
-                        report_data = evaluations[eval_select]
-                        
-                        with st.expander(get_text("eval_report_label", language), expanded=True):
-                            st.markdown(report_data["text_report"])
-                        
-                        with st.expander(get_text("detailed_eval_label", language), expanded=False):
-                            st.json(report_data["evaluation_data"])
+            profile_lap("teacher.reports_tab")
+            teacher_search_fragment(language, course_shard)
+            teacher_reports_fragment(language, course_shard)
+        
+        with tab4:
+            profile_lap("teacher.usage_tab")
+            teacher_usage_fragment(language, course_shard)
     
     # Student Interface
     else:
@@ -1044,129 +4945,17 @@ def run_app():
         ])
         
         with tab1:
+            profile_lap("student.submit_tab")
             # If we're in the middle of a conversation, show the chat interface
             if "conversation_started" in st.session_state and st.session_state.conversation_started:
-                st.subheader("Evaluation Conversation")
-                
-                # Display the conversation history
-                for message in st.session_state.messages:
-                    with st.chat_message(message["role"]):
-                        st.write(message["content"])
-                
-                # If the conversation is not complete, show the current question
-                if not st.session_state.conversation_complete:
-                    if st.session_state.current_question_idx < len(st.session_state.questions):
-                        # Display the current question from the assistant
-                        with st.chat_message("assistant"):
-                            current_question = st.session_state.questions[st.session_state.current_question_idx]
-                            st.write(current_question)
-                            # Add to messages if it's not already there
-                            if len(st.session_state.messages) == 0 or st.session_state.messages[-1]["content"] != current_question:
-                                st.session_state.messages.append({"role": "assistant", "content": current_question})
-                        
-                        # Get user response with chat input
-                        user_response = st.chat_input("Your response")
-                        if user_response:
-                            # Add user response to messages
-                            st.session_state.messages.append({"role": "user", "content": user_response})
-                            
-                            # Save the response
-                            st.session_state.student_responses[current_question] = user_response
-                            
-                            # Move to next question
-                            st.session_state.current_question_idx += 1
-                            
-                            # Check if we've reached the end of questions
-                            if st.session_state.current_question_idx >= len(st.session_state.questions):
-                                st.session_state.conversation_complete = True
-                                
-                                # Add final message
-                                st.session_state.messages.append({
-                                    "role": "assistant", 
-                                    "content": "Thank you for answering all the questions. I'll now analyze your responses."
-                                })
-                                
-                                # Get conversation data for evaluation
-                                conversation_history = []
-                                for i, question in enumerate(st.session_state.questions):
-                                    if question in st.session_state.student_responses:
-                                        conversation_history.append({
-                                            "question": question,
-                                            "response": st.session_state.student_responses[question]
-                                        })
-                                
-                                # Generate conversation summary
-                                conversation_agent = ConversationAgent(llm)
-                                conversation_agent.conversation_history = conversation_history
-                                conversation_agent.student_responses = st.session_state.student_responses
-                                conversation_data = conversation_agent.get_conversation_summary(
-                                    language=st.session_state.current_assignment.get("language", "English")
-                                )
-                                
-                                # Start evaluation
-                                with st.spinner("Generating evaluation..."):
-                                    # Get submission text
-                                    submission_text = st.session_state.current_submission["text_submission"]
-                                    if st.session_state.current_submission["file_path"]:
-                                        try:
-                                            file_content = read_file(st.session_state.current_submission["file_path"])
-                                            submission_text += f"\n\n[Uploaded File Content]:\n{file_content}"
-                                        except:
-                                            submission_text += "\n\n[Uploaded File: Could not read content]"
-                                    
-                                    # Initialize evaluation agent
-                                    evaluation_agent = EvaluationAgent(llm)
-                                    evaluation_data = evaluation_agent.evaluate_submission(
-                                        st.session_state.current_assignment["instructions"],
-                                        st.session_state.current_assignment["id"],
-                                        submission_text,
-                                        st.session_state.current_assignment["learning_objectives"],
-                                        conversation_data
-                                    )
-                                    
-                                    # Generate report
-                                    report_generator = ReportGenerator(llm)
-                                    report_data = report_generator.generate_report(evaluation_data)
-                                    
-                                    # Save evaluation
-                                    evaluation_id = f"{uuid.uuid4()}"
-                                    evaluations_file = "data/evaluations.json"
-                                    evaluations = load_json(evaluations_file)
-                                    evaluations[evaluation_id] = report_data
-                                    save_json(evaluations, evaluations_file)
-                                    
-                                    # Store for display
-                                    st.session_state.evaluation_complete = True
-                                    st.session_state.evaluation_id = evaluation_id
-                                    st.session_state.evaluation_report = report_data
-                            
-                            # Rerun to update the UI
-                            st.rerun()
-                
-                # Show evaluation results if complete
-                if st.session_state.evaluation_complete:
-                    st.success("Evaluation complete! Here's your assessment report:")
-                    
-                    with st.expander("Evaluation Report", expanded=True):
-                        st.markdown(st.session_state.evaluation_report["text_report"])
-                    
-                    if st.button("Start a New Submission"):
-                        # Reset all conversation and evaluation state
-                        for key in ["conversation_started", "conversation_complete", 
-                                   "evaluation_complete", "evaluation_id", "current_submission",
-                                   "current_assignment", "messages", "questions", 
-                                   "student_responses", "current_question_idx",
-                                   "evaluation_report"]:
-                            if key in st.session_state:
-                                del st.session_state[key]
-                        st.rerun()
+                evaluation_chat_fragment(service)
             
             # If not in a conversation, show the submission form
             else:
                 st.subheader("Submit Assignment")
                 
                 # Load available assignments
-                assignments = load_json("data/assignments.json")
+                assignments = service.list_assignments(course_shard)
                 if not assignments:
                     st.info("No assignments available for submission.")
                 else:
@@ -1209,102 +4998,48 @@ def run_app():
                             if not submission_text and not uploaded_file:
                                 st.error("Please either write your submission or upload a file.")
                             else:
-                                # Save submission
-                                submission_id = f"{uuid.uuid4()}"
-                                submission_data = {
-                                    "id": submission_id,
-                                    "assignment_id": assignment_select,
-                                    "text_submission": submission_text,
-                                    "file_path": None,
-                                    "submitted_at": datetime.now().isoformat()
-                                }
-                                
                                 # Save uploaded file if provided
+                                file_path = None
                                 if uploaded_file:
                                     file_path = save_uploaded_file(uploaded_file, "data/submissions")
-                                    submission_data["file_path"] = file_path
-                                
-                                # Save submission data
-                                submissions_file = "data/submissions.json"
-                                submissions = load_json(submissions_file)
-                                submissions[submission_id] = submission_data
-                                save_json(submissions, submissions_file)
-                                
-                                # Initialize conversation
-                                question_generator = QuestionGeneratorAgent(llm)
-                                questions = question_generator.generate_questions(
-                                    assignment["instructions"],
-                                    assignment["learning_objectives"],
-                                    num_questions=assignment.get("num_questions", 3),  # Default to 3 if not specified
-                                    language=assignment.get("language", "English")  # Use the assignment's language
-                                )
                                 
-                                # Store data in session state
-                                st.session_state.current_submission = submission_data
-                                st.session_state.current_assignment = assignment
-                                st.session_state.conversation_started = True
-                                st.session_state.conversation_complete = False
-                                st.session_state.evaluation_complete = False
-                                st.session_state.questions = questions
-                                st.session_state.current_question_idx = 0
-                                st.session_state.student_responses = {}
+                                # Save the submission and initialize the conversation
+                                try:
+                                    reply = service.start_conversation(assignment_select, submission_text, file_path)
+                                except Exception as e:
+                                    logging.error(f"Error iniciando la conversación: {e}")
+                                    st.error(str(e))
+                                    reply = None
                                 
-                                # Initialize the first message based on language
-                                language = assignment.get("language", "English")
-                                intro_messages = {
-                                    "English": "I'd like to ask you a few questions about your assignment to understand your thought process better.",
-                                    "Español": "Me gustaría hacerte algunas preguntas sobre tu tarea para entender mejor tu proceso de pensamiento."
-                                }
-                                
-                                intro_message = intro_messages.get(language, intro_messages["English"])
-                                
-                                st.session_state.messages = [
-                                    {
-                                        "role": "assistant", 
-                                        "content": intro_message
-                                    }
-                                ]
-                                
-                                st.success("Assignment submitted successfully! Let's begin the evaluation conversation.")
-                                st.rerun()
+                                if reply:
+                                    # Store data in session state
+                                    st.session_state.service_session_id = reply["session_id"]
+                                    st.session_state.current_assignment_id = assignment_select
+                                    st.session_state.conversation_started = True
+                                    st.session_state.conversation_complete = False
+                                    st.session_state.evaluation_complete = False
+                                    st.session_state.current_question = reply["question"]
+                                    st.session_state.current_question_idx = 0
+                                    set_session_value("student_responses", {})
+                                    set_session_value("messages", [
+                                        {
+                                            "role": "assistant", 
+                                            "content": reply["message"]
+                                        }
+                                    ])
+                                    
+                                    st.success("Assignment submitted successfully! Let's begin the evaluation conversation.")
+                                    st.rerun()
         
         with tab2:
-            st.subheader("View Your Evaluations")
-            
-            # This would normally be filtered by student ID
-            # For demo purposes, we'll show all evaluations
-            evaluations = load_json("data/evaluations.json") if os.path.exists("data/evaluations.json") else {}
-            
-            if not evaluations:
-                st.info("No evaluations available yet. Submit an assignment to get evaluated.")
-            else:
-                # Load assignments for names
-                assignments = load_json("data/assignments.json")
-                
-                eval_options = list(evaluations.keys())
-                eval_select = st.selectbox(
-                    get_text("select_eval", language),
-                    options=eval_options,
-                    format_func=lambda x: (
-                        f"{get_text('report_for', language)}{assignments.get(evaluations[x]['evaluation_data']['assignment_id'], {}).get('name', 'Unknown Assignment')} "
-                        f"{get_text('report_from', language)}{evaluations[x]['timestamp']}"
-                    ),
-                    key="student_view_eval_select"
-                )
-                
-                if eval_select:
-                    report_data = evaluations[eval_select]
-                    
-                    assignment_id = report_data["evaluation_data"]["assignment_id"]
-                    assignment_name = assignments.get(assignment_id, {}).get("name", "Unknown Assignment")
-                    
-                    st.markdown(f"## Evaluation Report for {assignment_name}")
-                    
-                    with st.expander("Report", expanded=True):
-                        st.markdown(report_data["text_report"])
-                    
-                    with st.expander("Detailed Evaluation Data", expanded=False):
-                        st.json(report_data["evaluation_data"])
+            profile_lap("student.evaluations_tab")
+            student_evaluations_fragment(language, course_shard)
 
 if __name__ == "__main__":
-    run_app()
\ No newline at end of file
+    if "profiling_session_id" not in st.session_state:
+        st.session_state.profiling_session_id = f"{uuid.uuid4()}"
+    start_rerun_profile(st.session_state.profiling_session_id)
+    try:
+        run_app()
+    finally:
+        finish_rerun_profile()
\ No newline at end of file
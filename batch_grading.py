@@ -0,0 +1,282 @@
+"""Grade an assignment's submissions offline through JSONL batch files.
+
+Conversations of assignments created with batch grading are not evaluated
+when they end; they wait for this tool. Grading runs in waves: each wave
+renders the prompts of every stage whose inputs are already known into a
+JSONL request file (OpenAI Batch API format). Ingesting the wave's results
+stores the evaluations that are finished and writes the next wave, since the
+structuring stage needs the evaluation stages and the report needs the
+structuring. Progress is saved after every session, so an interrupted
+ingest can simply be run again.
+
+Usage:
+    python batch_grading.py export --assignment <assignment_id>
+    python batch_grading.py submit data/batches/<batch_id>                    # local stand-in endpoint
+    python batch_grading.py submit data/batches/<batch_id> --endpoint openai
+    python batch_grading.py ingest data/batches/<batch_id>
+    python batch_grading.py status data/batches/<batch_id>
+"""
+import argparse
+import json
+import logging
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from app import (
+    BATCHES_DIR, BatchPending, EvaluationService, LLMBatch, ModelRouter, UsageCallbackHandler, configured_llm_api_key,
+    setup_directories
+)
+
+MESSAGE_TYPES = {"system": SystemMessage, "user": HumanMessage, "assistant": AIMessage}
+
+def load_manifest(batch_dir):
+    with open(os.path.join(batch_dir, "batch.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(batch_dir, manifest):
+    path = os.path.join(batch_dir, "batch.json")
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(f"{path}.tmp", path)
+
+def read_results(path):
+    """custom_id -> result of a results file; a truncated last line is ignored"""
+    results = {}
+    if not os.path.exists(path):
+        return results
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                custom_id, result = LLMBatch.parse_result(line)
+            except (json.JSONDecodeError, KeyError):
+                continue
+            results[custom_id] = result
+    return results
+
+def load_results(batch_dir, manifest):
+    """Every response ingested so far; later waves win for a repeated request"""
+    results = {}
+    for wave in manifest["waves"]:
+        if wave["status"] == "ingested":
+            results.update(read_results(os.path.join(batch_dir, wave["results_file"])))
+    return results
+
+def advance(service, batch_dir, manifest):
+    """Run every pending session as far as the ingested results allow and write the next wave.
+
+    Returns the number of requests in the new wave (0 once every session is graded).
+    """
+    batch = LLMBatch(load_results(batch_dir, manifest))
+    for session_id, entry in manifest["sessions"].items():
+        if entry["status"] != "pending":
+            continue
+        try:
+            entry["evaluation_id"] = service.evaluate_in_batch(session_id, batch)
+            entry["status"] = "complete"
+            entry.pop("waiting_on", None)
+        except BatchPending as e:
+            entry["waiting_on"] = str(e)
+        except Exception as e:
+            logging.error(f"Error en la evaluación por lotes de la sesión {session_id}: {e}")
+            entry["status"] = "failed"
+            entry["error"] = str(e)
+        save_manifest(batch_dir, manifest)
+
+    if not batch.requests:
+        return 0
+    number = len(manifest["waves"]) + 1
+    requests_file = f"requests-{number}.jsonl"
+    with open(os.path.join(batch_dir, requests_file), "w", encoding="utf-8") as f:
+        for request in batch.requests.values():
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+    manifest["waves"].append({
+        "wave": number,
+        "requests_file": requests_file,
+        "results_file": f"results-{number}.jsonl",
+        "requests": len(batch.requests),
+        "status": "exported",
+        "provider_batch_id": None
+    })
+    save_manifest(batch_dir, manifest)
+    return len(batch.requests)
+
+def sessions_in_open_batches(batches_dir=BATCHES_DIR):
+    """Sessions still pending in an earlier batch, which a new batch must not grade twice"""
+    session_ids = set()
+    if not os.path.isdir(batches_dir):
+        return session_ids
+    for name in os.listdir(batches_dir):
+        if os.path.exists(os.path.join(batches_dir, name, "batch.json")):
+            manifest = load_manifest(os.path.join(batches_dir, name))
+            session_ids.update(s for s, entry in manifest["sessions"].items() if entry["status"] == "pending")
+    return session_ids
+
+def export_batch(service, assignment_id, batches_dir=BATCHES_DIR):
+    """Start a batch with every conversation of the assignment waiting for grading; returns its directory"""
+    assignment = service.get_assignment(assignment_id)
+    in_progress = sessions_in_open_batches(batches_dir)
+    batch_id = f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    batch_dir = os.path.join(batches_dir, batch_id)
+    os.makedirs(batch_dir)
+    manifest = {
+        "id": batch_id,
+        "assignment_id": assignment["id"],
+        "created_at": datetime.now().isoformat(),
+        "sessions": {
+            session_id: {"status": "pending", "evaluation_id": None}
+            for session_id in service.list_batch_sessions(assignment["id"])
+            if session_id not in in_progress
+        },
+        "waves": []
+    }
+    save_manifest(batch_dir, manifest)
+    advance(service, batch_dir, manifest)
+    return batch_dir
+
+def current_wave(manifest):
+    if not manifest["waves"] or manifest["waves"][-1]["status"] == "ingested":
+        return None
+    return manifest["waves"][-1]
+
+def run_local_batch(requests_path, results_path, router, workers=4):
+    """Local stand-in for a batch endpoint: answer every request and write the results file.
+
+    Requests already answered in results_path are skipped, so an interrupted run can resume.
+    """
+    done = set(read_results(results_path))
+    with open(requests_path, "r", encoding="utf-8") as f:
+        requests = [json.loads(line) for line in f if line.strip()]
+    requests = [request for request in requests if request["custom_id"] not in done]
+
+    def answer(request):
+        body = request["body"]
+        stage = request["custom_id"].split(":")[0]
+        model = router.with_overrides({stage: {"model": body["model"], "max_tokens": body.get("max_tokens")}}).for_stage(stage)
+        usage = UsageCallbackHandler()
+        try:
+            message = model.invoke(
+                [MESSAGE_TYPES[m["role"]](content=m["content"]) for m in body["messages"]],
+                config={"callbacks": [usage]}
+            )
+        except Exception as e:
+            return {"custom_id": request["custom_id"], "response": None, "error": {"message": str(e)}}
+        return {
+            "id": f"local-{uuid.uuid4().hex[:12]}",
+            "custom_id": request["custom_id"],
+            "response": {
+                "status_code": 200,
+                "body": {
+                    "model": body["model"],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": message.content}}],
+                    "usage": {
+                        "prompt_tokens": usage.prompt_tokens,
+                        "completion_tokens": usage.completion_tokens,
+                        "prompt_tokens_details": {"cached_tokens": usage.cached_prompt_tokens}
+                    }
+                }
+            },
+            "error": None
+        }
+
+    with open(results_path, "a", encoding="utf-8") as f, ThreadPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(answer, requests):
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+            f.flush()
+    return len(requests)
+
+def submit_wave(batch_dir, manifest, endpoint, router, workers=4):
+    """Send the current wave's request file to the batch endpoint"""
+    wave = current_wave(manifest)
+    if wave is None:
+        raise ValueError("There is no wave waiting to be submitted")
+    requests_path = os.path.join(batch_dir, wave["requests_file"])
+    if endpoint == "local":
+        run_local_batch(requests_path, os.path.join(batch_dir, wave["results_file"]), router, workers)
+        wave["status"] = "completed"
+    else:
+        from openai import OpenAI
+        client = OpenAI(api_key=router.openai_api_key)
+        with open(requests_path, "rb") as f:
+            input_file = client.files.create(file=f, purpose="batch")
+        provider_batch = client.batches.create(
+            input_file_id=input_file.id, endpoint="/v1/chat/completions", completion_window="24h"
+        )
+        wave["provider_batch_id"] = provider_batch.id
+        wave["status"] = "submitted"
+    save_manifest(batch_dir, manifest)
+    return wave
+
+def fetch_wave(batch_dir, wave, router):
+    """Download a submitted wave's results from the provider; returns False while it is still running"""
+    from openai import OpenAI
+    client = OpenAI(api_key=router.openai_api_key)
+    provider_batch = client.batches.retrieve(wave["provider_batch_id"])
+    if provider_batch.status != "completed":
+        print(f"Batch {provider_batch.id} is {provider_batch.status}")
+        return False
+    with open(os.path.join(batch_dir, wave["results_file"]), "w", encoding="utf-8") as f:
+        # Failed requests are in the error file, in the same format
+        for file_id in [provider_batch.output_file_id, provider_batch.error_file_id]:
+            if file_id:
+                f.write(client.files.content(file_id).text.rstrip("\n") + "\n")
+    return True
+
+def ingest_batch(service, batch_dir):
+    """Ingest the current wave's results and write the next wave; returns the manifest"""
+    manifest = load_manifest(batch_dir)
+    wave = current_wave(manifest)
+    if wave is not None:
+        if wave["status"] == "submitted" and not fetch_wave(batch_dir, wave, service.router):
+            return manifest
+        if wave["status"] == "exported":
+            raise ValueError(f"Wave {wave['wave']} has not been submitted yet")
+        wave["status"] = "ingested"
+        save_manifest(batch_dir, manifest)
+    # Also resumes an ingest that was interrupted after its wave was marked as ingested
+    advance(service, batch_dir, manifest)
+    return manifest
+
+def print_status(manifest):
+    counts = {}
+    for entry in manifest["sessions"].values():
+        counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+    print(f"Batch {manifest['id']} for assignment {manifest['assignment_id']}: "
+          + ", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+    for wave in manifest["waves"]:
+        print(f"  wave {wave['wave']}: {wave['requests']} requests, {wave['status']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Grade submissions offline through batch files")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="Write the first wave of an assignment's waiting submissions")
+    export_parser.add_argument("--assignment", required=True)
+    submit_parser = subparsers.add_parser("submit", help="Send the current wave to the batch endpoint")
+    submit_parser.add_argument("batch_dir")
+    submit_parser.add_argument("--endpoint", choices=["local", "openai"], default="local")
+    submit_parser.add_argument("--workers", type=int, default=4, help="Concurrent calls of the local endpoint")
+    ingest_parser = subparsers.add_parser("ingest", help="Ingest the current wave's results and write the next wave")
+    ingest_parser.add_argument("batch_dir")
+    status_parser = subparsers.add_parser("status", help="Show the progress of a batch")
+    status_parser.add_argument("batch_dir")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    setup_directories()
+    service = EvaluationService(ModelRouter(configured_llm_api_key() or os.environ.get("OPENAI_API_KEY")))
+
+    if args.command == "export":
+        batch_dir = export_batch(service, args.assignment)
+        print(f"Batch written to {batch_dir}")
+        print_status(load_manifest(batch_dir))
+    elif args.command == "submit":
+        manifest = load_manifest(args.batch_dir)
+        wave = submit_wave(args.batch_dir, manifest, args.endpoint, service.router, args.workers)
+        print(f"Wave {wave['wave']} {wave['status']}")
+    elif args.command == "ingest":
+        print_status(ingest_batch(service, args.batch_dir))
+    else:
+        print_status(load_manifest(args.batch_dir))
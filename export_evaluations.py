@@ -0,0 +1,381 @@
+"""Export stored evaluations to columnar files for offline analysis.
+
+Evaluations are streamed one at a time from each course shard's
+evaluations.json (data/courses/*/evaluations.json), so the whole store is
+never loaded into memory. Two tables are written:
+
+* evaluations: one row per evaluation with the per-criterion scores
+* objective_scores: one row per evaluation and learning objective
+
+Usage:
+    python export_evaluations.py --format csv --output exports
+    python export_evaluations.py --format parquet --output exports --full
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+from datetime import datetime
+
+SHARDS_DIR = "data/courses"
+
+# Criteria stored in structured_evaluation as {score, examples, feedback}
+CRITERIA = [
+    "comprehension", "authenticity", "relational_skills", "argumentation",
+    "bibliography_use", "overall_quality"
+]
+
+EVALUATION_COLUMNS = [
+    "evaluation_id", "assignment_id", "report_timestamp", "evaluation_timestamp", "language",
+    *[f"{criterion}_score" for criterion in CRITERIA],
+    "plagiarism_detected", "format_error", "partial", "cost_usd", "prompt_tokens", "cached_prompt_tokens",
+    "normalization_tokens_saved", "submission_to_report_seconds", "median_chars_per_second", "paste_like_count"
+]
+
+OBJECTIVE_COLUMNS = [
+    "evaluation_id", "assignment_id", "report_timestamp", "objective_index", "objective", "score"
+]
+
+def iter_json_object(file_path, chunk_size=65536):
+    """Yield (key, value) pairs of a top-level JSON object without loading the whole file"""
+    decoder = json.JSONDecoder()
+    with open(file_path, "r", encoding="utf-8") as f:
+        buffer = ""
+        eof = False
+
+        def fill(min_size=1):
+            # Read more data; returns False once the file is exhausted
+            nonlocal buffer, eof
+            if eof:
+                return False
+            data = f.read(max(chunk_size, min_size))
+            if not data:
+                eof = True
+                return False
+            buffer += data
+            return True
+
+        def skip_whitespace():
+            nonlocal buffer
+            while True:
+                buffer = buffer.lstrip()
+                if buffer or not fill():
+                    return
+
+        def decode():
+            # Decode the next JSON value, reading more data until it is complete
+            nonlocal buffer
+            read_size = chunk_size
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer)
+                    buffer = buffer[end:]
+                    return value
+                except json.JSONDecodeError:
+                    if not fill(read_size):
+                        raise
+                    read_size *= 2
+
+        skip_whitespace()
+        if not buffer:
+            return
+        if buffer[0] != "{":
+            raise ValueError(f"{file_path} does not contain a JSON object")
+        buffer = buffer[1:]
+
+        while True:
+            skip_whitespace()
+            if buffer.startswith("}"):
+                return
+            key = decode()
+            skip_whitespace()
+            if not buffer.startswith(":"):
+                raise ValueError(f"Malformed JSON object in {file_path}")
+            buffer = buffer[1:]
+            skip_whitespace()
+            value = decode()
+            yield key, value
+            skip_whitespace()
+            if buffer.startswith(","):
+                buffer = buffer[1:]
+
+def _score(value):
+    """Coerce a stored score (number, numeric string or criterion dict) to float"""
+    if isinstance(value, dict):
+        value = value.get("score")
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def flatten_evaluation(evaluation_id, report_data):
+    """Flatten one stored evaluation into an evaluations row and its objective rows"""
+    evaluation_data = report_data.get("evaluation_data", {})
+    structured = evaluation_data.get("structured_evaluation", {})
+    performance = report_data.get("performance", {})
+    # A numeric dict since response times are analyzed locally; free text in older evaluations
+    response_times = structured.get("response_time_analysis")
+    if not isinstance(response_times, dict):
+        response_times = {}
+
+    row = {
+        "evaluation_id": evaluation_id,
+        "assignment_id": evaluation_data.get("assignment_id"),
+        "report_timestamp": report_data.get("timestamp"),
+        "evaluation_timestamp": evaluation_data.get("timestamp"),
+        "language": report_data.get("language"),
+        "plagiarism_detected": bool(structured.get("plagiarism_detected", False)),
+        "format_error": "raw_evaluation" in structured,
+        "partial": bool(structured.get("partial", False)),
+        "cost_usd": performance.get("cost_usd"),
+        "prompt_tokens": performance.get("prompt_tokens"),
+        "cached_prompt_tokens": performance.get("cached_prompt_tokens"),
+        "normalization_tokens_saved": (performance.get("normalization") or {}).get("tokens_saved"),
+        "submission_to_report_seconds": performance.get("submission_to_report_seconds"),
+        "median_chars_per_second": response_times.get("median_chars_per_second"),
+        "paste_like_count": response_times.get("paste_like_count")
+    }
+    for criterion in CRITERIA:
+        row[f"{criterion}_score"] = _score(structured.get(criterion))
+
+    objective_rows = []
+    for i, objective in enumerate(structured.get("learning_objectives", [])):
+        if not isinstance(objective, dict):
+            continue
+        objective_rows.append({
+            "evaluation_id": evaluation_id,
+            "assignment_id": row["assignment_id"],
+            "report_timestamp": row["report_timestamp"],
+            "objective_index": i + 1,
+            "objective": objective.get("objective"),
+            "score": _score(objective.get("score"))
+        })
+
+    return row, objective_rows
+
+class CsvTableWriter:
+    """Writes rows to a CSV file, appending to it or (mode="w") starting a new one"""
+
+    def __init__(self, file_path, columns, mode="a"):
+        is_new = mode == "w" or not os.path.exists(file_path) or os.path.getsize(file_path) == 0
+        self.file = open(file_path, mode, encoding="utf-8", newline="")
+        self.writer = csv.DictWriter(self.file, fieldnames=columns)
+        if is_new:
+            self.writer.writeheader()
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+def copy_csv_rows(file_path, writer, keep_ids, batch_size=1000):
+    """Stream the rows of an exported CSV file whose evaluation_id is in keep_ids into writer"""
+    if not os.path.exists(file_path):
+        return
+    with open(file_path, "r", encoding="utf-8", newline="") as f:
+        rows = []
+        for row in csv.DictReader(f):
+            if row.get("evaluation_id") in keep_ids:
+                rows.append(row)
+            if len(rows) >= batch_size:
+                writer.write(rows)
+                rows = []
+        writer.write(rows)
+
+class ParquetTableWriter:
+    """Writes rows to a new Parquet part file, one row group per batch"""
+
+    def __init__(self, file_path, columns, types):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Parquet export requires pyarrow (pip install pyarrow)")
+        self.pa = pa
+        self.columns = columns
+        self.schema = pa.schema([(column, types[column]) for column in columns])
+        self.writer = pq.ParquetWriter(file_path, self.schema)
+
+    def write(self, rows):
+        if rows:
+            table = self.pa.Table.from_pylist(rows, schema=self.schema)
+            self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
+
+def _parquet_types():
+    import pyarrow as pa
+    types = {column: pa.string() for column in EVALUATION_COLUMNS + OBJECTIVE_COLUMNS}
+    for criterion in CRITERIA:
+        types[f"{criterion}_score"] = pa.float64()
+    types.update({
+        "plagiarism_detected": pa.bool_(),
+        "format_error": pa.bool_(),
+        "partial": pa.bool_(),
+        "cost_usd": pa.float64(),
+        "prompt_tokens": pa.int64(),
+        "cached_prompt_tokens": pa.int64(),
+        "normalization_tokens_saved": pa.int64(),
+        "submission_to_report_seconds": pa.float64(),
+        "median_chars_per_second": pa.float64(),
+        "paste_like_count": pa.int64(),
+        "objective_index": pa.int32(),
+        "score": pa.float64()
+    })
+    return types
+
+TABLE_COLUMNS = {"evaluations": EVALUATION_COLUMNS, "objective_scores": OBJECTIVE_COLUMNS}
+
+def load_export_state(output_dir):
+    """State of the last export: exported evaluation IDs (with the timestamp exported), the
+    columns written and the IDs of an export that didn't finish. None if the state predates
+    ID tracking (a timestamp watermark)."""
+    state_path = os.path.join(output_dir, "export_state.json")
+    if not os.path.exists(state_path):
+        return {"exported": {}, "columns": TABLE_COLUMNS, "pending": []}
+    with open(state_path, "r", encoding="utf-8") as f:
+        state = json.load(f)
+    if "exported" not in state:
+        return None
+    return state
+
+def save_export_state(output_dir, state):
+    # Replaced in one step, so a crash never leaves a partial state file
+    state_path = os.path.join(output_dir, "export_state.json")
+    with open(f"{state_path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=4)
+    os.replace(f"{state_path}.tmp", state_path)
+
+def scan_evaluations(evaluations_files):
+    """evaluation_id -> timestamp of every stored evaluation"""
+    stored = {}
+    for evaluations_file in evaluations_files:
+        for evaluation_id, report_data in iter_json_object(evaluations_file):
+            stored[evaluation_id] = report_data.get("timestamp")
+    return stored
+
+def find_evaluation_files(shards_dir=SHARDS_DIR):
+    """evaluations.json of every course shard"""
+    if not os.path.isdir(shards_dir):
+        return []
+    return sorted(
+        os.path.join(shards_dir, shard, "evaluations.json") for shard in os.listdir(shards_dir)
+        if os.path.exists(os.path.join(shards_dir, shard, "evaluations.json"))
+    )
+
+def export_evaluations(evaluations_files=None, output_dir="exports", file_format="csv",
+                       full=False, batch_size=1000):
+    """Export evaluations that are new or changed since the last export (or all of them with full=True).
+
+    evaluations_files defaults to every course shard's evaluations file. Exported
+    evaluations are tracked by ID, so one stored late with an earlier timestamp is
+    still exported, and a regraded one (a new timestamp) replaces its earlier rows.
+    New rows are appended; the files are rewritten when rows are replaced, when an
+    earlier export was interrupted or when the columns have changed.
+
+    Returns the number of evaluations exported.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if evaluations_files is None:
+        evaluations_files = find_evaluation_files()
+
+    state = load_export_state(output_dir)
+    if state is None or state.get("columns") != TABLE_COLUMNS:
+        # Rows written with other columns (or tracked only by a watermark) are not reused
+        full = True
+    exported = {} if full else dict(state["exported"])
+    stored = scan_evaluations(evaluations_files)
+    changed = {evaluation_id for evaluation_id, timestamp in stored.items() if exported.get(evaluation_id) != timestamp}
+    # Rows of regraded evaluations, and of an export that may have been cut short, are replaced
+    replaced = {evaluation_id for evaluation_id in changed if evaluation_id in exported}
+    replaced.update(state["pending"] if state else [])
+    rewrite = full or bool(replaced)
+    if rewrite and file_format == "parquet":
+        # Parquet part files can't be edited, so every row is written again
+        full = True
+        exported = {}
+        changed = set(stored)
+
+    if file_format == "csv":
+        paths = {table: os.path.join(output_dir, f"{table}.csv") for table in TABLE_COLUMNS}
+        if rewrite:
+            # Kept rows are copied to new files, which then replace the old ones
+            writers = {table: CsvTableWriter(f"{path}.tmp", TABLE_COLUMNS[table], mode="w") for table, path in paths.items()}
+            if not full:
+                keep_ids = set(stored) - changed
+                for table, path in paths.items():
+                    copy_csv_rows(path, writers[table], keep_ids, batch_size)
+        else:
+            writers = {table: CsvTableWriter(path, TABLE_COLUMNS[table]) for table, path in paths.items()}
+    elif file_format == "parquet":
+        part = datetime.now().strftime("%Y%m%dT%H%M%S")
+        types = _parquet_types()
+        paths = {}
+        for table in TABLE_COLUMNS:
+            os.makedirs(os.path.join(output_dir, table), exist_ok=True)
+            paths[table] = os.path.join(output_dir, table, f"part-{part}.parquet")
+        writers = {table: ParquetTableWriter(path, TABLE_COLUMNS[table], types) for table, path in paths.items()}
+    else:
+        raise ValueError(f"Unsupported export format: {file_format}")
+
+    # Recorded before writing: if the export is interrupted, the next one replaces these rows
+    save_export_state(output_dir, {
+        "exported": exported, "columns": TABLE_COLUMNS, "pending": sorted(changed),
+        "exported_at": (state or {}).get("exported_at")
+    })
+
+    count = 0
+    evaluation_rows, objective_rows = [], []
+    try:
+        for evaluations_file in evaluations_files:
+            for evaluation_id, report_data in iter_json_object(evaluations_file):
+                if evaluation_id not in changed:
+                    continue
+
+                row, objectives = flatten_evaluation(evaluation_id, report_data)
+                evaluation_rows.append(row)
+                objective_rows.extend(objectives)
+                exported[evaluation_id] = report_data.get("timestamp")
+                count += 1
+
+                if len(evaluation_rows) >= batch_size:
+                    writers["evaluations"].write(evaluation_rows)
+                    writers["objective_scores"].write(objective_rows)
+                    evaluation_rows, objective_rows = [], []
+
+        writers["evaluations"].write(evaluation_rows)
+        writers["objective_scores"].write(objective_rows)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    if file_format == "csv" and rewrite:
+        for path in paths.values():
+            os.replace(f"{path}.tmp", path)
+    elif file_format == "parquet" and full:
+        # The new part holds every row; older parts are dropped
+        for table, path in paths.items():
+            table_dir = os.path.dirname(path)
+            for name in os.listdir(table_dir):
+                if name.endswith(".parquet") and os.path.join(table_dir, name) != path:
+                    os.remove(os.path.join(table_dir, name))
+
+    save_export_state(output_dir, {
+        "exported": exported, "columns": TABLE_COLUMNS, "pending": [], "exported_at": datetime.now().isoformat()
+    })
+    logging.info(f"Exportadas {count} evaluaciones a {output_dir}")
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export evaluations to CSV or Parquet")
+    parser.add_argument("--input", nargs="*", help="evaluations.json files (default: every course shard)")
+    parser.add_argument("--output", default="exports", help="Output directory")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--full", action="store_true", help="Export everything instead of only new or changed evaluations")
+    args = parser.parse_args()
+
+    count = export_evaluations(args.input, args.output, args.format, args.full)
+    print(f"Exported {count} evaluations to {args.output}")
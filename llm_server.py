@@ -0,0 +1,204 @@
+"""Local stand-in for an OpenAI-compatible chat completions API.
+
+Answers every agent stage with a canned response of the right format (numbered
+questions, the structuring JSON, a report...), so the full app, the service
+and the load test can run on an isolated machine. The app tells the server
+which stage a call belongs to with the X-Agent-Stage header. Latency and
+throughput are configurable, to capacity-test the app's concurrency features
+(background stages, hedging, deadlines, admission control) against a slow or
+saturated provider.
+
+Usage:
+    python llm_server.py --port 8001 --latency 0.5 --tokens-per-second 50 --max-concurrency 8 --rpm 600
+    LLM_BASE_URL=http://127.0.0.1:8001/v1 streamlit run app.py
+
+Endpoints:
+    POST /v1/chat/completions   Chat completion (non-streaming)
+    GET  /v1/models             The models of the default routes
+    GET  /stats                 Requests served, rejected and in flight
+"""
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from app import DEFAULT_MODEL_ROUTES, fake_llm_response
+
+class ServerLimits:
+    """Latency, generation speed and admission limits of the stand-in server"""
+
+    def __init__(self, latency=0.5, jitter=0.0, tokens_per_second=None, max_concurrency=None,
+                 max_queue=None, rpm=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.rpm = rpm
+        self.max_queue = max_queue
+        self._slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self._lock = threading.Lock()
+        self._request_times = deque()
+        self.waiting = 0
+        self.in_flight = 0
+        self.served = 0
+        self.rate_limited = 0
+        self.overloaded = 0
+
+    def admit(self):
+        """None if the request may proceed, else (status, seconds the client should wait)"""
+        now = time.monotonic()
+        with self._lock:
+            if self.rpm:
+                while self._request_times and self._request_times[0] < now - 60:
+                    self._request_times.popleft()
+                if len(self._request_times) >= self.rpm:
+                    self.rate_limited += 1
+                    return 429, self._request_times[0] + 60 - now
+            if self.max_queue is not None and self._slots is not None and self.waiting >= self.max_queue:
+                self.overloaded += 1
+                return 503, 1.0
+            if self.rpm:
+                self._request_times.append(now)
+            self.waiting += 1
+        return None
+
+    def run(self, completion_tokens):
+        """Hold a concurrency slot for the time the response takes to generate"""
+        if self._slots is not None:
+            self._slots.acquire()
+        with self._lock:
+            self.waiting -= 1
+            self.in_flight += 1
+        try:
+            seconds = self.latency + random.uniform(0, self.jitter)
+            if self.tokens_per_second:
+                seconds += completion_tokens / self.tokens_per_second
+            time.sleep(seconds)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.served += 1
+            if self._slots is not None:
+                self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "served": self.served,
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "rate_limited": self.rate_limited,
+                "overloaded": self.overloaded
+            }
+
+class ChatCompletionsHandler(BaseHTTPRequestHandler):
+    """Serves the subset of the OpenAI API that the app's chat models use"""
+
+    limits = None
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message, error_type, headers=None):
+        self._send_json(status, {"error": {"message": message, "type": error_type, "code": None}}, headers)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/v1/models":
+            models = sorted({route["model"] for route in DEFAULT_MODEL_ROUTES.values()})
+            return self._send_json(200, {"object": "list", "data": [
+                {"id": model, "object": "model", "owned_by": "local"} for model in models
+            ]})
+        if self.path.rstrip("/") == "/stats":
+            return self._send_json(200, self.limits.stats())
+        self._send_error(404, f"Unknown path {self.path}", "invalid_request_error")
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            return self._send_error(404, f"Unknown path {self.path}", "invalid_request_error")
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length).decode("utf-8"))
+            messages = body["messages"]
+        except (ValueError, KeyError) as e:
+            return self._send_error(400, f"Invalid request: {e}", "invalid_request_error")
+        if body.get("stream"):
+            return self._send_error(400, "Streaming is not supported by the stand-in server", "invalid_request_error")
+
+        rejected = self.limits.admit()
+        if rejected is not None:
+            status, retry_after = rejected
+            message = "Rate limit reached" if status == 429 else "The server is overloaded"
+            return self._send_error(
+                status, message, "rate_limit_error" if status == 429 else "server_error",
+                {"Retry-After": str(max(1, round(retry_after)))}
+            )
+
+        content = fake_llm_response(self.headers.get("X-Agent-Stage") or "default")
+        # Same estimate as the fake in-process model: about four characters per token
+        prompt_tokens = sum(len(str(message.get("content", ""))) for message in messages) // 4
+        completion_tokens = len(content) // 4
+        if body.get("max_tokens"):
+            completion_tokens = min(completion_tokens, body["max_tokens"])
+        self.limits.run(completion_tokens)
+
+        self._send_json(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "local"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": 0}
+            }
+        })
+
+    def log_message(self, format, *args):
+        # One line per request is too much under load
+        pass
+
+def run_server(host="127.0.0.1", port=8001, limits=None):
+    """Serve the stand-in API until interrupted"""
+    ChatCompletionsHandler.limits = limits or ServerLimits()
+    server = ThreadingHTTPServer((host, port), ChatCompletionsHandler)
+    logging.info(f"Servidor LLM local escuchando en http://{host}:{port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible stand-in server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds before the first token")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra random latency, up to this many seconds")
+    parser.add_argument("--tokens-per-second", type=float, help="Generation speed (default: instant)")
+    parser.add_argument("--max-concurrency", type=int, help="Requests generated at once; the rest wait")
+    parser.add_argument("--max-queue", type=int, help="Waiting requests beyond which new ones get 503")
+    parser.add_argument("--rpm", type=int, help="Requests per minute beyond which new ones get 429")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    run_server(args.host, args.port, ServerLimits(
+        args.latency, args.jitter, args.tokens_per_second, args.max_concurrency, args.max_queue, args.rpm
+    ))
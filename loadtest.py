@@ -0,0 +1,254 @@
+"""Load test the Streamlit app with concurrent simulated students.
+
+Each simulated student drives the real app script through Streamlit's AppTest:
+it selects the assignment, submits, answers every question and waits for its
+report. The LLM is replaced by the fake local model (LLM_BACKEND=fake), whose
+latency is set with --latency, or by an OpenAI-compatible server at --base-url
+(e.g. llm_server.py with its own latency and throughput limits). Every
+student runs in its own process, all sharing one data directory, so their
+reruns really overlap. For every number of students the tool reports
+p50/p95/p99 rerun latency, time from submission to report, CPU and memory.
+
+Usage:
+    python loadtest.py --students 1 5 10 --latency 0.5 --save-baseline loadtest_baseline.json
+    python loadtest.py --students 1 5 10 --latency 0.5 --compare loadtest_baseline.json
+    python loadtest.py --students 10 25 --base-url http://127.0.0.1:8001/v1
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))], 3)
+
+class ResourceSampler:
+    """Samples the CPU usage and resident memory of this process and its students' processes while a level runs"""
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.rss_samples = []
+        self._stop = threading.Event()
+        try:
+            import psutil
+            self.process = psutil.Process()
+        except ImportError:
+            # Without psutil only the peak RSS (from getrusage) is reported
+            self.process = None
+
+    def _rss(self):
+        processes = [self.process] + self.process.children(recursive=True)
+        rss = 0
+        for process in processes:
+            try:
+                rss += process.memory_info().rss
+            except Exception:
+                # The process exited between listing and sampling
+                pass
+        return rss / 1024 / 1024
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.rss_samples.append(self._rss())
+
+    @staticmethod
+    def _cpu_seconds():
+        # Children's CPU time is counted once they have exited and been waited for
+        times = os.times()
+        return times.user + times.system + times.children_user + times.children_system
+
+    def __enter__(self):
+        self.start_wall = time.perf_counter()
+        self.start_cpu = self._cpu_seconds()
+        if self.process is not None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        wall = time.perf_counter() - self.start_wall
+        self.cpu_percent = round((self._cpu_seconds() - self.start_cpu) / wall * 100, 1) if wall > 0 else None
+        if self.rss_samples:
+            self.peak_rss_mb = round(max(self.rss_samples), 1)
+        else:
+            # ru_maxrss is in KB on Linux; for children it is the largest single student process
+            self.peak_rss_mb = round(sum(
+                resource.getrusage(who).ru_maxrss for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]
+            ) / 1024, 1)
+        self.mean_rss_mb = round(sum(self.rss_samples) / len(self.rss_samples), 1) if self.rss_samples else None
+
+def drop_stale_widgets(block):
+    """Remove widgets whose state Streamlit has already dropped from an AppTest element tree.
+
+    Older AppTest versions (e.g. 1.40) keep the elements of a run that
+    st.rerun() interrupted, such as the submission form once the conversation
+    starts. Their widget state is gone, so sending it on the next run raises
+    a KeyError.
+    """
+    from streamlit.testing.v1.element_tree import Block, Widget
+
+    for index, child in list(block.children.items()):
+        if isinstance(child, Block):
+            drop_stale_widgets(child)
+        elif isinstance(child, Widget):
+            try:
+                child.value
+            except KeyError:
+                del block.children[index]
+
+def simulate_student(student_index, timeout):
+    """Drive one student through submission, conversation and report; returns its timings.
+
+    Runs in a process of its own: each AppTest run installs (and then removes) a
+    process-wide mock Streamlit runtime, so two students' runs can't overlap in
+    one process.
+    """
+    from streamlit.testing.v1 import AppTest
+    from app import get_text
+
+    rerun_seconds = []
+
+    def timed(action):
+        start = time.perf_counter()
+        action.run()
+        rerun_seconds.append(time.perf_counter() - start)
+        drop_stale_widgets(at.main)
+        drop_stale_widgets(at.sidebar)
+
+    # The backend is configured through the environment, so there is no API key to enter
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    timed(at)
+    at.sidebar.radio[0].set_value(get_text("student_role", "Español"))
+    timed(at)
+
+    next(t for t in at.text_area if t.label == "Enter your assignment response here").input(
+        f"Student {student_index} submission. " * 40
+    )
+    submitted_at = time.perf_counter()
+    next(b for b in at.button if b.label == "Submit Assignment").click()
+    timed(at)
+
+    answers = 0
+    while not at.session_state["conversation_complete"]:
+        if at.exception:
+            raise RuntimeError(at.exception[0].message)
+        at.chat_input[0].set_value(f"Answer {answers + 1} from student {student_index}. " * 10)
+        timed(at)
+        answers += 1
+
+    if not at.session_state["evaluation_complete"]:
+        raise RuntimeError(f"Evaluation did not complete: {at.session_state['evaluation_error']}")
+    return {
+        "rerun_seconds": rerun_seconds,
+        "time_to_report_seconds": time.perf_counter() - submitted_at,
+        "answers": answers
+    }
+
+def run_level(students, timeout):
+    """Run `students` simulated students at once and summarize the level"""
+    results, errors = [], []
+    with ResourceSampler() as sampler:
+        # Spawned, not forked: the parent has already imported the app and its thread pools
+        with ProcessPoolExecutor(max_workers=students, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [executor.submit(simulate_student, i, timeout) for i in range(students)]
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    errors.append(str(e))
+
+    reruns = [seconds for result in results for seconds in result["rerun_seconds"]]
+    reports = [result["time_to_report_seconds"] for result in results]
+    return {
+        "students": students,
+        "completed": len(results),
+        "errors": errors[:5],
+        "reruns": len(reruns),
+        "rerun_p50": percentile(reruns, 50),
+        "rerun_p95": percentile(reruns, 95),
+        "rerun_p99": percentile(reruns, 99),
+        "report_p50": percentile(reports, 50),
+        "report_p95": percentile(reports, 95),
+        "report_p99": percentile(reports, 99),
+        "cpu_percent": sampler.cpu_percent,
+        "mean_rss_mb": sampler.mean_rss_mb,
+        "peak_rss_mb": sampler.peak_rss_mb
+    }
+
+def print_comparison(summary, baseline):
+    """Print each metric next to its baseline value"""
+    for level in summary:
+        base = baseline.get(str(level["students"]))
+        if base is None:
+            continue
+        print(f"\n{level['students']} students vs baseline:")
+        for metric in ["rerun_p50", "rerun_p95", "rerun_p99", "report_p95", "cpu_percent", "peak_rss_mb"]:
+            current, previous = level.get(metric), base.get(metric)
+            if current is None or not previous:
+                continue
+            change = (current - previous) / previous * 100
+            print(f"  {metric:<12} {previous:>10} -> {current:<10} ({change:+.1f}%)")
+
+def create_load_test_assignment():
+    from app import EvaluationService, ModelRouter, setup_directories
+    setup_directories()
+    EvaluationService(ModelRouter("fake-key")).create_assignment(
+        "Load test assignment",
+        "Write a short essay about a topic of your choice.",
+        ["Explain the main concepts", "Support arguments with evidence"],
+        num_questions=3,
+        language="English",
+        course="loadtest"
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the app with concurrent simulated students")
+    parser.add_argument("--students", type=int, nargs="+", default=[1, 5, 10], help="Concurrent students per level")
+    parser.add_argument("--latency", type=float, default=0.5, help="Fake LLM latency per call in seconds")
+    parser.add_argument("--base-url", help="OpenAI-compatible server to use instead of the fake model")
+    parser.add_argument("--timeout", type=float, default=600, help="Timeout of a single app rerun in seconds")
+    parser.add_argument("--workdir", help="Directory for the test's data/ (default: a temporary directory)")
+    parser.add_argument("--save-baseline", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare the results with a saved baseline")
+    args = parser.parse_args()
+
+    if args.base_url:
+        os.environ["LLM_BASE_URL"] = args.base_url
+    else:
+        os.environ["LLM_BACKEND"] = "fake"
+        os.environ["FAKE_LLM_LATENCY"] = str(args.latency)
+    baseline_path = os.path.abspath(args.save_baseline) if args.save_baseline else None
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+
+    # The app stores everything under ./data, so the test runs in its own directory
+    os.chdir(args.workdir or tempfile.mkdtemp(prefix="loadtest-"))
+    create_load_test_assignment()
+
+    summary = []
+    for students in args.students:
+        level = run_level(students, args.timeout)
+        summary.append(level)
+        print(json.dumps(level))
+
+    if baseline_path:
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "latency": args.latency,
+                **{str(level["students"]): level for level in summary}
+            }, f, indent=4)
+        print(f"Baseline saved to {baseline_path}")
+
+    if compare_path:
+        with open(compare_path, "r", encoding="utf-8") as f:
+            print_comparison(summary, json.load(f))
@@ -0,0 +1,35 @@
+"""Split the single-file stores into per-course shards.
+
+Moves <data-dir>/assignments.json, submissions.json and evaluations.json (data/
+by default)
+into <data-dir>/courses/<course>[__<term>]/, records each assignment's shard
+in <data-dir>/courses/catalog.json and renames the old files to *.migrated.
+The app runs the same migration once on startup; this script lets it be
+done (or previewed with --dry-run) ahead of time.
+
+Usage:
+    python migrate_shards.py --dry-run
+    python migrate_shards.py
+    python migrate_shards.py --data-dir /srv/old-data
+"""
+import argparse
+import logging
+import os
+
+from app import migrate_legacy_stores
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split the data stores into per-course shards")
+    parser.add_argument("--data-dir", default="data", help="Directory with the legacy JSON stores")
+    parser.add_argument("--dry-run", action="store_true", help="Only print how records would be split")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    counts = migrate_legacy_stores(args.data_dir, dry_run=args.dry_run)
+    if not counts:
+        print("Nothing to migrate")
+    for shard, kinds in sorted(counts.items()):
+        summary = ", ".join(f"{count} {kind}" for kind, count in sorted(kinds.items()))
+        print(f"{os.path.join(args.data_dir, 'courses', shard)}: {summary}")
+    if args.dry_run:
+        print("Dry run: nothing was written")
@@ -0,0 +1,58 @@
+"""Grade stored evaluations again after an assignment or a prompt changed.
+
+Each evaluation keeps the output of every stage keyed by a hash of the stage's
+prompt template, model and inputs. A regrade reuses the conversation and every
+stage whose key is unchanged, so editing an assignment's learning objectives
+reruns only the objectives stage, structuring and the report, and a prompt
+change reruns that stage and the ones that depend on it.
+
+Usage:
+    python regrade_evaluations.py --assignment <assignment_id> --dry-run
+    python regrade_evaluations.py --assignment <assignment_id>
+    python regrade_evaluations.py --evaluation <evaluation_id> [<evaluation_id> ...]
+"""
+import argparse
+import logging
+import os
+from collections import Counter
+
+from app import (
+    EvaluationService, ModelRouter, configured_llm_api_key, find_assignment_shard, load_evaluation_index,
+    setup_directories
+)
+
+def regrade(service, evaluation_ids, dry_run=False):
+    """Regrade (or plan the regrade of) each evaluation; returns how often each stage is recomputed"""
+    recomputed = Counter()
+    for evaluation_id in evaluation_ids:
+        try:
+            result = service.regrade_evaluation(evaluation_id, dry_run=dry_run)
+        except Exception as e:
+            logging.error(f"Error reevaluando {evaluation_id}: {e}")
+            continue
+        # Per-objective stages are counted together
+        recomputed.update(stage.split(":")[0] for stage in result["recomputed_stages"])
+        print(f"{evaluation_id}: {'would recompute' if dry_run else 'recomputed'} "
+              f"{', '.join(result['recomputed_stages']) or 'nothing'}; "
+              f"reused {', '.join(result['reused_stages']) or 'nothing'}")
+    return recomputed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Regrade stored evaluations, recomputing only the stages that changed")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--assignment", help="Regrade every evaluation of this assignment")
+    target.add_argument("--evaluation", nargs="+", help="Regrade these evaluations")
+    parser.add_argument("--dry-run", action="store_true", help="Only show which stages would be recomputed")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    setup_directories()
+    service = EvaluationService(ModelRouter(configured_llm_api_key() or os.environ.get("OPENAI_API_KEY")))
+
+    evaluation_ids = args.evaluation or [
+        evaluation_id for evaluation_id, entry in load_evaluation_index(find_assignment_shard(args.assignment)).items()
+        if entry.get("assignment_id") == args.assignment
+    ]
+    recomputed = regrade(service, evaluation_ids, args.dry_run)
+    print(f"{len(evaluation_ids)} evaluations; stage recomputations: "
+          + (", ".join(f"{stage} {count}" for stage, count in sorted(recomputed.items())) or "none"))
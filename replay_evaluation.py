@@ -0,0 +1,79 @@
+"""Rerun a recorded evaluation offline from its LLM cassette.
+
+Evaluations recorded with LLM_CASSETTE_MODE=record can be replayed without
+calling the API, to profile prompt rendering, parsing and post-processing or
+to check that a code change still produces the same structured evaluation.
+
+Usage:
+    python replay_evaluation.py data/cassettes/<session_id>.json
+    python replay_evaluation.py data/cassettes/<session_id>.json --latency original --profile
+"""
+import argparse
+import cProfile
+import io
+import json
+import pstats
+import sys
+import time
+
+from app import EvaluationAgent, LLMCassette, ModelRouter, ReportGenerator, summarize_stage_metrics
+
+def replay_evaluation(cassette_path, replay_latency="zero"):
+    """Run the evaluation and report stages against a cassette; returns (report_data, cassette)"""
+    cassette = LLMCassette(cassette_path, mode="replay", replay_latency=replay_latency)
+    if not cassette.inputs:
+        raise ValueError(f"{cassette_path} has no recorded evaluation inputs")
+
+    router = ModelRouter(None).with_cassette(cassette)
+    metrics = []
+    inputs = cassette.inputs
+    evaluation_data = EvaluationAgent(router, metrics).evaluate_submission(
+        inputs["assignment_text"],
+        inputs["assignment_id"],
+        inputs["submission_text"],
+        inputs["learning_objectives"],
+        inputs["conversation_data"],
+        objective_fanout=inputs.get("objective_fanout", False),
+        response_time_baseline=inputs.get("response_time_baseline"),
+        reference_digest=inputs.get("reference_digest")
+    )
+    report_data = ReportGenerator(router, metrics).generate_report(evaluation_data)
+    report_data["performance"] = summarize_stage_metrics(metrics)
+    return report_data, cassette
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recorded evaluation")
+    parser.add_argument("cassette", help="Path to the cassette file")
+    parser.add_argument("--latency", choices=["zero", "original"], default="zero",
+                        help="Replay with no delay or with the recorded latency of each call")
+    parser.add_argument("--profile", action="store_true", help="Print the slowest functions")
+    args = parser.parse_args()
+
+    profiler = cProfile.Profile() if args.profile else None
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    report_data, cassette = replay_evaluation(args.cassette, args.latency)
+    if profiler:
+        profiler.disable()
+    elapsed = time.perf_counter() - start
+
+    recorded_llm_seconds = sum(entry["latency_seconds"] for entry in cassette.entries)
+    print(f"Replayed {len(cassette.entries)} calls in {elapsed:.3f}s "
+          f"(recorded LLM time {recorded_llm_seconds:.3f}s)")
+
+    if profiler:
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(25)
+        print(output.getvalue())
+
+    # Regression check against the outputs produced when the cassette was recorded
+    expected = cassette.outputs.get("structured_evaluation")
+    actual = report_data["evaluation_data"]["structured_evaluation"]
+    if expected is not None and json.dumps(expected, sort_keys=True) != json.dumps(actual, sort_keys=True):
+        print("Structured evaluation differs from the recorded one")
+        sys.exit(1)
+    if cassette.outputs.get("text_report") not in (None, report_data["text_report"]):
+        print("Report differs from the recorded one")
+        sys.exit(1)
+    print("Outputs match the recording")
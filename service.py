@@ -0,0 +1,139 @@
+"""Headless HTTP API for the evaluation agents.
+
+Exposes the same EvaluationService used by the Streamlit app, so evaluation
+workers can be scaled and load-tested independently of the UI. Sessions are
+persisted under data/sessions, so several instances can share the data
+directory.
+
+Usage:
+    OPENAI_API_KEY=... python service.py --host 0.0.0.0 --port 8000
+
+Endpoints:
+    GET  /assignments                           List assignments (?course=&term= for one course)
+    POST /assignments                           Create an assignment
+    POST /conversations                         Submit work and get the first question
+    POST /conversations/<session_id>/answers    Submit an answer, get the next question
+    GET  /conversations/<session_id>/evaluation Evaluation status/report (?wait=seconds)
+    GET  /evaluations/<evaluation_id>           A stored evaluation report
+
+Submissions beyond the usage quotas get 429 with a Retry-After header.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from app import (
+    EvaluationService, ModelRouter, QuotaExceeded, configured_llm_api_key, setup_directories, shard_key
+)
+
+class EvaluationRequestHandler(BaseHTTPRequestHandler):
+    """Maps the REST endpoints onto EvaluationService methods"""
+
+    service = None
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode("utf-8"))
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        query = parse_qs(url.query)
+
+        try:
+            if method == "GET" and parts == ["assignments"]:
+                course = query.get("course", [None])[0]
+                shard = shard_key(course, query.get("term", [None])[0]) if course else None
+                return self._send_json(200, self.service.list_assignments(shard))
+
+            if method == "POST" and parts == ["assignments"]:
+                body = self._read_json()
+                assignment = self.service.create_assignment(
+                    body.get("name"),
+                    body.get("instructions"),
+                    body.get("learning_objectives", []),
+                    num_questions=body.get("num_questions", 3),
+                    language=body.get("language", "Español"),
+                    model_routes=body.get("model_routes"),
+                    objective_fanout=body.get("objective_fanout", False),
+                    course=body.get("course"),
+                    term=body.get("term"),
+                    batch_grading=body.get("batch_grading", False)
+                )
+                return self._send_json(201, assignment)
+
+            if method == "POST" and parts == ["conversations"]:
+                body = self._read_json()
+                reply = self.service.start_conversation(body.get("assignment_id"), body.get("text_submission", ""))
+                return self._send_json(201, reply)
+
+            if method == "POST" and len(parts) == 3 and parts[0] == "conversations" and parts[2] == "answers":
+                body = self._read_json()
+                return self._send_json(200, self.service.submit_answer(parts[1], body.get("response", "")))
+
+            if method == "GET" and len(parts) == 3 and parts[0] == "conversations" and parts[2] == "evaluation":
+                wait = float(query.get("wait", ["0"])[0])
+                return self._send_json(200, self.service.get_evaluation(parts[1], timeout=wait))
+
+            if method == "GET" and len(parts) == 2 and parts[0] == "evaluations":
+                return self._send_json(200, self.service.get_stored_evaluation(parts[1]))
+
+            return self._send_json(404, {"error": "Not found"})
+        except QuotaExceeded as e:
+            retry_after = max(1, math.ceil(e.retry_after))
+            return self._send_json(
+                429, {"error": str(e), "scope": e.scope, "retry_after": retry_after}, {"Retry-After": str(retry_after)}
+            )
+        except KeyError as e:
+            return self._send_json(404, {"error": f"Not found: {e}"})
+        except (ValueError, json.JSONDecodeError) as e:
+            return self._send_json(400, {"error": str(e)})
+        except Exception as e:
+            logging.error(f"Error procesando {method} {self.path}: {e}")
+            return self._send_json(500, {"error": str(e)})
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+def run_service(host="127.0.0.1", port=8000, openai_api_key=None):
+    """Serve the evaluation API until interrupted"""
+    setup_directories()
+    EvaluationRequestHandler.service = EvaluationService(
+        ModelRouter(openai_api_key or configured_llm_api_key() or os.environ.get("OPENAI_API_KEY"))
+    )
+    server = ThreadingHTTPServer((host, port), EvaluationRequestHandler)
+    logging.info(f"Servicio de evaluación escuchando en http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless evaluation service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    run_service(args.host, args.port)